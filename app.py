@@ -5,12 +5,9 @@ import tempfile
 import shutil
 from PIL import Image
 import subprocess
-import openai
-import google.generativeai as genai
 import base64
-import cv2
-import numpy as np
 import io
+import uuid
 from dotenv import load_dotenv
 
 # 認証・課金モジュールをインポート
@@ -24,12 +21,34 @@ from payment import (
     init_payment_session, verify_premium_access,
     manage_subscription
 )
+from image_cache import PreprocessCache, make_cache_key
+from vision_budget import summarize_reports
+from ocr_cache import OCRResultCache, bytes_digest, image_digest, make_ocr_cache_key
+from phash_cache import SharedPageCache
+from image_processing import (
+    PREPROCESS_PARAMS, preprocess_images_parallel
+)
+from ocr_engine import (
+    OCR_PAGE_SEPARATOR, cascade_stats, coalesced_call_stats, is_complete_ocr_result, plan_incremental_ocr, run_ocr
+)
+from failover import FAILOVER_MODELS, HedgedStream, failover_stats
+from jobs import ERROR, JobManager, JobQueueFull
+from singleflight import fingerprint
+from prompts import PROMPT_VERSION
+from providers import get_openai_client, release_gemini_cache
+from rate_limiter import get_rate_limiter
+from scheduler import caller_context, get_scheduler
+from resilience import call_with_retry, resilience_stats
+from call_metrics import token_usage_stats
+from model_router import chat_models, default_ocr_model, get_model_router
+from chat_context import CHAT_MAX_TOKENS, build_chat_context, summarize_context_report
+from reference_index import ReferenceIndex
 
 # 環境変数読み込み
 load_dotenv()
 
-# Gemini API設定
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# サービスの状態（ブレーカー・送信枠・待ち時間など）を表示する管理者のメールアドレス（カンマ区切り）
+ADMIN_EMAILS = {email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
 
 # ページ設定
 st.set_page_config(
@@ -146,7 +165,7 @@ def show_plan_info_main():
         if plan == 'free':
             ocr_count = st.session_state.get('ocr_usage_count', 0)
             question_count = st.session_state.get('question_usage_count', 0)
-            usage_text = f"OCR: {ocr_count}/20回 | 質問: {question_count}/20回 | 状態は1日でリセットされます。" 
+            usage_text = f"OCR: {ocr_count}/20ページ | 質問: {question_count}/20回 | 状態は1日でリセットされます。" 
         else:
             usage_text = "無制限利用可能"
         
@@ -201,6 +220,12 @@ def show_main_content():
         value=True,
         help="画像を処理し、見やすくします。"
     )
+    enable_auto_crop = st.checkbox(
+        "余白の自動トリミング・傾き補正",
+        value=False,
+        disabled=not enable_preprocessing,
+        help="机や手などの余白を切り取り、傾いたページをまっすぐにします。"
+    )
     
     if uploaded_files:
         # アップロードされた画像を表示
@@ -210,12 +235,26 @@ def show_main_content():
         processed_images = []
         
         if enable_preprocessing:
+            cache = get_preprocess_cache()
+            stats_before = cache.stats()
+            preprocess_params = {**PREPROCESS_PARAMS, "auto_crop": enable_auto_crop}
             with st.spinner("🔧 画像前処理中..."):
-                for uploaded_file in uploaded_files:
-                    processed_img, success = preprocess_image(uploaded_file)
+                results = preprocess_images_batch(uploaded_files, preprocess_params)
+                for uploaded_file, (processed_img, success) in zip(uploaded_files, results):
                     processed_images.append(processed_img)
                     if not success:
                         st.warning(f"{uploaded_file.name} の前処理に失敗しました")
+            crop_reports = [img.info["crop_report"] for img in processed_images if "crop_report" in img.info]
+            if crop_reports:
+                avg_ratio = sum(r["crop_ratio"] for r in crop_reports) / len(crop_reports)
+                total_ms = sum(r["elapsed_ms"] for r in crop_reports)
+                st.caption(f"自動トリミング: 平均 {avg_ratio:.0%} の画素に削減（{total_ms:.0f}ms）")
+            stats_after = cache.stats(get_session_id())
+            st.caption(
+                f"前処理キャッシュ: ヒット {stats_after['hits'] - stats_before['hits']}件 / "
+                f"ミス {stats_after['misses'] - stats_before['misses']}件 "
+                f"(累計ヒット率 {stats_after['hit_rate']:.0%})"
+            )
         
         # 画像表示（前処理が有効な場合は前処理済みのみ、無効な場合は元画像のみ）
         if enable_preprocessing and processed_images:
@@ -239,38 +278,76 @@ def show_main_content():
                         image = Image.open(uploaded_file)
                         st.image(image, use_column_width=True)
         
+        # 読み取りモード（ページごとの並列読み取りは複数ページのときのみ）
+        ocr_mode_options = ["per_page", "single", "cascade"] if len(uploaded_files) > 1 else ["single", "cascade"]
+        if enable_preprocessing:
+            # レイアウト解析は前処理済みの画像でのみ行う
+            ocr_mode_options.append("regions")
+        ocr_mode = st.radio(
+            "読み取りモード",
+            options=ocr_mode_options,
+            format_func=lambda mode: OCR_MODE_LABELS[mode],
+            horizontal=True
+        )
+        
         # OCR 実行ボタン
-        if st.button("🔍 この文章を読み込む", type="primary"):
-            # 使用制限チェック
-            if not check_usage_limit('ocr'):
-                return
-            
+        if st.button("🔍 この文章を読み込む", type="primary", disabled=bool(st.session_state.get('ocr_job'))):
             with st.spinner(f"{len(uploaded_files)}枚の画像を読み取り中..."):
-                # プランに応じてOCRモデルを選択
-                if st.session_state.user_plan == 'premium':
-                    ocr_model = "gpt-4o"  # Premiumユーザーは高性能モデル
-                else:
-                    ocr_model = "gpt-4o-mini"  # Freeユーザーは標準モデル
+                # プランと直近の応答時間に応じてOCRモデルを選択（遅延中は高速な下位モデルへ）
+                ocr_route = get_model_router().route("ocr", default_ocr_model(st.session_state.user_plan))
+                ocr_model = ocr_route.model
 
-                # 前処理が有効な場合は前処理済み画像を使用
+                # ページごとの内容ハッシュ（キャッシュ・差分読み取りに使用）
                 if enable_preprocessing and processed_images:
-                    latex_result = perform_ocr_with_processed_images(processed_images, uploaded_files, model=ocr_model)
+                    page_digests = [image_digest(img) for img in processed_images]
+                    ocr_settings = make_ocr_cache_key([], ocr_model, PROMPT_VERSION, preprocess_params, None)
                 else:
-                    latex_result = perform_ocr_with_multiple_images(uploaded_files, model=ocr_model)
-                    
-                if latex_result:
-                    st.session_state.latex_code = latex_result
-                    # 使用回数をインクリメント
-                    increment_usage('ocr')
-                    st.success("✅ 読み取り完了!")
+                    page_digests = [bytes_digest(f.getvalue()) for f in uploaded_files]
+                    ocr_settings = make_ocr_cache_key([], ocr_model, PROMPT_VERSION, None, None)
+
+                # 同じ画像・モデル・プロンプトのOCR結果があればディスクキャッシュから返す
+                ocr_cache = get_ocr_cache()
+                cache_key = make_ocr_cache_key(
+                    page_digests, ocr_model, PROMPT_VERSION,
+                    preprocess_params if enable_preprocessing and processed_images else None, ocr_mode
+                )
+                latex_result = ocr_cache.get(cache_key)
+
+                if latex_result is not None:
+                    # キャッシュから返した場合はAPIを呼んでいないので回数に数えない
+                    apply_ocr_result(latex_result, {
+                        "settings": ocr_settings,
+                        "segments": [{"digests": page_digests, "text": latex_result}],
+                    })
+                    st.success("✅ 読み取り完了!（保存済みの結果を使用）")
+                    st.caption(f"OCRキャッシュ ヒット率: {ocr_cache.stats()['hit_rate']:.0%}")
                     
                     # 認識結果を表示（生のTeX + レンダリング済み）
                     st.markdown("### 📄 認識結果")
                     render_latex_content(latex_result)
-                    
                 else:
-                    st.error("❌ 読み取りに失敗しました")
-            
+                    # 前処理が有効な場合は前処理済み画像を使用（読み取りはバックグラウンドで実行）
+                    # 前回と同じ設定で読み取ったページは再利用し、追加・変更されたページだけを読み取る
+                    previous = st.session_state.get('ocr_pages')
+                    segments = previous["segments"] if previous and previous["settings"] == ocr_settings else []
+                    # 使用制限チェック（前回の結果を再利用するページは数えない）
+                    pages_to_process = sum(kind == "page" for kind, _ in plan_incremental_ocr(page_digests, segments))
+                    if not check_usage_limit('ocr', pages_to_process):
+                        return
+                    start_ocr_job(
+                        uploaded_files,
+                        processed_images if enable_preprocessing else None,
+                        model=ocr_model,
+                        mode=ocr_mode,
+                        cache_key=cache_key,
+                        digests=page_digests,
+                        segments=segments,
+                        settings=ocr_settings,
+                        requested_model=ocr_route.requested_model,
+                        # 共有ページキャッシュはモデルを含まない設定で分け、応答したモデルごとに保存する
+                        page_namespace=make_ocr_cache_key([], None, PROMPT_VERSION, preprocess_params, None)
+                    )
+
     else:
         # 画像がアップロードされていない場合のみ表示
         st.info("質問したい部分の画像をアップロードしてください（複数枚可）")
@@ -280,6 +357,17 @@ def show_main_content():
             st.session_state.latex_code = ""
             st.info("TeX手動入力し、質問ができます")
     
+    # 実行中・完了したOCRジョブの表示（読み取り中にアップロードを外しても結果を受け取る）
+    if st.session_state.get('ocr_job'):
+        show_ocr_job()
+    for level, message in st.session_state.pop('ocr_notices', []):
+        getattr(st, level)(message)
+    if st.session_state.get('pending_ocr_result'):
+        show_pending_ocr_result()
+    if st.session_state.pop('show_ocr_result', False) and st.session_state.get('latex_code'):
+        st.markdown("### 📄 認識結果")
+        render_latex_content(st.session_state.latex_code)
+    
     # テスト用クイック入力（画像がない場合のみ表示）
     if not uploaded_files:
         with st.expander("🧪 テスト用の数式で試す"):
@@ -303,16 +391,23 @@ def show_main_content():
     
     if latex_code != st.session_state.get('latex_code', ''):
         st.session_state.latex_code = latex_code
+    # OCR結果・編集内容の検索インデックス（変わっていなければ何もしない）
+    get_reference_index().update(st.session_state.get('latex_code', ''))
     
-    # PDF 生成ボタン
-    if st.button("📄 入力をPDFで確認する", disabled=not latex_code):
-        with st.spinner("📄 PDF生成中..."):
-            pdf_path = generate_pdf(latex_code)
-            if pdf_path:
-                st.session_state.pdf_path = pdf_path
-                st.success("✅ PDF生成完了!")
-            else:
-                st.error("❌ PDF生成失敗")
+    # PDF 生成ボタン（コンパイルはバックグラウンドで実行）
+    if st.button("📄 入力をPDFで確認する", disabled=not latex_code or bool(st.session_state.get('pdf_job'))):
+        try:
+            output_name = f"preview_{get_session_id()}.pdf"
+            st.session_state.pdf_job = get_job_manager().submit(
+                "pdf", _pdf_job, latex_code, output_name,
+                key=fingerprint("pdf", latex_code, output_name)
+            )
+        except JobQueueFull:
+            st.error("現在混み合っています。しばらくしてからもう一度お試しください。")
+    if st.session_state.get('pdf_job'):
+        show_pdf_job()
+    for level, message in st.session_state.pop('pdf_notices', []):
+        getattr(st, level)(message)
     
     # PDF プレビュー表示
     pdf_path = st.session_state.get('pdf_path')
@@ -337,18 +432,19 @@ def show_main_content():
         "gemini-1.5-pro-latest": "🧠 高度な推論に最適"
     }
     
-    # チャットモデル選択（プレミアムユーザーのみ）
-    chat_model = "gemini-1.5-flash-latest"  # 無料プランのデフォルト
-    if st.session_state.user_plan == 'premium':
+    # チャットモデル選択（複数のモデルを選べるのはプレミアムユーザーのみ）
+    plan_chat_models = chat_models(st.session_state.user_plan)
+    chat_model = plan_chat_models[0]
+    if len(plan_chat_models) > 1:
         chat_model = st.selectbox(
             "🤖 チャットモデルを選択",
-            options=list(MODEL_DISPLAY_NAMES.keys()),
+            options=plan_chat_models,
             format_func=lambda model_id: MODEL_DISPLAY_NAMES[model_id],
             help="Premium: 高性能なモデルを選択できます",
             index=0
         )
     else:
-        st.info(f"🔥{MODEL_DISPLAY_NAMES['gemini-1.5-flash-latest']}な推論モデルを使用してチャットします。")
+        st.info(f"🔥{MODEL_DISPLAY_NAMES[chat_model]}な推論モデルを使用してチャットします。")
 
     # チャットメッセージの初期化
     if "chat_messages" not in st.session_state:
@@ -358,9 +454,15 @@ def show_main_content():
     for message in st.session_state.chat_messages:
         with st.chat_message(message["role"]):
             render_latex_content(message["content"])
+            if message.get("note"):
+                st.caption(message["note"])
+            if message.get("context_report"):
+                st.caption(summarize_context_report(message["context_report"]))
+    for notice in st.session_state.pop('chat_notices', []):
+        st.caption(notice)
 
     # ユーザーからの入力を受け取る
-    if prompt := st.chat_input("数式について質問・追加質問してください..."):
+    if prompt := st.chat_input("数式について質問・追加質問してください...", disabled=bool(st.session_state.get('chat_job'))):
         # latex_codeがなければ何もしない
         if not st.session_state.get('latex_code'):
             st.warning("まず、上のセクションで数式を含む画像をアップロードまたはテキストを入力してください。")
@@ -379,26 +481,12 @@ def show_main_content():
             with st.chat_message("assistant"):
                 render_latex_content(limit_msg)
         else:
-            # AIからの応答を生成 & 表示
-            with st.chat_message("assistant"):
-                with st.spinner("🤖 AIが回答を生成中..."):
-                    context = build_chat_context(st.session_state.chat_messages, st.session_state.latex_code)
-                    
-                    # 選択されたモデルに応じて応答を生成
-                    if chat_model.startswith("gemini"):
-                        response = get_gemini_response(context, chat_model)
-                    else:  # gpt-4o-mini
-                        response = get_ai_response_simple(context)
-                
-                    if response:
-                        render_latex_content(response)
-                        # 応答を履歴に追加
-                        st.session_state.chat_messages.append({"role": "assistant", "content": response})
-                        increment_usage('question')
-                    else:
-                        error_msg = "申し訳ありません、エラーが発生しました。"
-                        render_latex_content(error_msg)
-                        st.session_state.chat_messages.append({"role": "assistant", "content": error_msg})
+            # AIからの応答をバックグラウンドで生成（途中経過は下で逐次表示）
+            start_chat_job(st.session_state.chat_messages, st.session_state.latex_code, chat_model)
+
+    # 生成中の応答を表示
+    if st.session_state.get('chat_job'):
+        show_chat_job()
 
     # チャット履歴がある場合の補助ボタン
     if st.session_state.get('chat_messages'):
@@ -408,14 +496,24 @@ def show_main_content():
             st.session_state.chat_messages = []
             st.rerun()
         
-        if st.button("📄 会話をPDFで出力", use_container_width=True):
-            with st.spinner("📄 PDF生成中..."):
-                pdf_path = generate_conversation_pdf(st.session_state.chat_messages, st.session_state.get('latex_code', ''))
-                if pdf_path:
-                    st.session_state.response_pdf_path = pdf_path
-                    st.success("✅ PDF生成完了!")
-                else:
-                    st.error("❌ PDF生成失敗")
+        # 会話PDFの生成もバックグラウンドで実行する
+        if st.button("📄 会話をPDFで出力", use_container_width=True,
+                     disabled=bool(st.session_state.get('conversation_pdf_job'))):
+            chat_history = [
+                {"role": m["role"], "content": m["content"]} for m in st.session_state.chat_messages
+            ]
+            reference = st.session_state.get('latex_code', '')
+            try:
+                st.session_state.conversation_pdf_job = get_job_manager().submit(
+                    "pdf", _conversation_pdf_job, chat_history, reference,
+                    key=fingerprint("conversation_pdf", chat_history, reference)
+                )
+            except JobQueueFull:
+                st.error("現在混み合っています。しばらくしてからもう一度お試しください。")
+        if st.session_state.get('conversation_pdf_job'):
+            show_conversation_pdf_job()
+        for level, message in st.session_state.pop('conversation_pdf_notices', []):
+            getattr(st, level)(message)
         
         if st.session_state.get('response_pdf_path'):
             with open(st.session_state.response_pdf_path, "rb") as pdf_file:
@@ -462,7 +560,7 @@ def show_user_tab():
             
             col1, col2 = st.columns(2)
             with col1:
-                st.metric("OCR実行", f"{ocr_count}回")
+                st.metric("OCR実行", f"{ocr_count}ページ")
             with col2:
                 st.metric("質問回数", f"{question_count}回")
         else:
@@ -473,6 +571,10 @@ def show_user_tab():
         # 料金プラン表示
         st.markdown("---")
         show_pricing_page()
+
+        if user_info.get('email') in ADMIN_EMAILS:
+            st.markdown("---")
+            show_service_stats()
         
         # ログアウトボタン
         st.markdown("---")
@@ -481,44 +583,97 @@ def show_user_tab():
     else:
         st.warning("ログインが必要です")
 
-def preprocess_image(image_file):
+def show_service_stats():
+    """管理者向けに、プロバイダ呼び出しの状態（このプロセス内の集計）を表示"""
+    with st.expander("🛠 サービスの状態"):
+        st.markdown("**サーキットブレーカー・再試行**")
+        st.json(resilience_stats())
+        st.markdown("**送信枠（レート制限）**")
+        st.json(get_rate_limiter().stats())
+        st.markdown("**実行枠（公平スケジューリング・待ち時間のパーセンタイル）**")
+        st.json(get_scheduler().stats())
+        st.markdown("**モデルの格下げ（応答時間の目標）**")
+        st.json(get_model_router().status())
+        st.markdown("**バックグラウンドジョブ（実行中の同じリクエストに統合した件数: coalesced）**")
+        st.json(get_job_manager().stats())
+        st.markdown("**ページ・領域の読み取り（実行中の呼び出しに統合した回数）**")
+        st.json(coalesced_call_stats())
+        st.markdown("**段階的OCR（昇格率・推定短縮時間）**")
+        st.json(cascade_stats())
+        st.markdown("**ヘッジ・切り替え**")
+        st.json(failover_stats())
+        st.markdown("**トークン使用量（キャッシュから読まれた割合）**")
+        st.json(token_usage_stats())
+
+def session_caller():
+    """このセッションの利用者のプラン・IDを、登録するジョブのプロバイダ呼び出しに引き継ぐ（公平スケジューリング用）"""
+    user_info = st.session_state.get('user_info') or {}
+    return caller_context(st.session_state.get('user_plan', 'free'), user_info.get('sub') or get_session_id())
+
+def get_session_id():
+    """セッションごとの識別子を取得（キャッシュのセッション別上限に使用）"""
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+def get_reference_index():
+    """このセッションの参考資料（latex_code）の検索インデックスを取得"""
+    if 'reference_index' not in st.session_state:
+        st.session_state.reference_index = ReferenceIndex()
+    return st.session_state.reference_index
+
+@st.cache_resource
+def get_preprocess_cache():
+    """プロセス全体で共有する前処理キャッシュを取得"""
+    return PreprocessCache()
+
+@st.cache_resource
+def get_ocr_cache():
+    """プロセス全体で共有するOCR結果のディスクキャッシュを取得"""
+    return OCRResultCache()
+
+@st.cache_resource
+def get_shared_page_cache():
+    """プロセス全体で共有する、ユーザー間のページ単位OCRキャッシュを取得"""
+    return SharedPageCache()
+
+@st.cache_resource
+def get_job_manager():
+    """プロセス全体で共有するバックグラウンドジョブの実行プールを取得"""
+    return JobManager()
+
+def preprocess_images_batch(uploaded_files, params=PREPROCESS_PARAMS):
     """
-    教科書画像の前処理：コントラスト強化 + 彩度削除
+    複数画像をまとめて前処理（キャッシュ＋共有プロセスプール）
+    戻り値はアップロード順の (画像, 成功フラグ) のリスト
     """
-    try:
-        # PILからOpenCV形式に変換
-        pil_image = Image.open(image_file)
-        
-        # RGBに変換（必要に応じて）
-        if pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-        
-        # numpy配列に変換
-        image_array = np.array(pil_image)
-        
-        # BGRからRGBに変換（OpenCV用）
-        image_bgr = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
-        
-        # 1. 彩度を削除（グレースケール化）
-        gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
-        
-        # 2. コントラスト強化（グレースケール画像に対してCLAHE適用）
-        clahe = cv2.createCLAHE(clipLimit=1.3, tileGridSize=(8, 8))
-        enhanced_gray = clahe.apply(gray)
-        
-        # 3. グレースケール画像をRGBに戻す（3チャンネル）
-        final_bgr = cv2.cvtColor(enhanced_gray, cv2.COLOR_GRAY2BGR)
-        final_rgb = cv2.cvtColor(final_bgr, cv2.COLOR_BGR2RGB)
-        
-        # PIL Imageに変換
-        processed_image = Image.fromarray(final_rgb)
-        
-        return processed_image, True
-        
-    except Exception as e:
-        st.warning(f"画像前処理でエラーが発生しました: {str(e)}")
-        # エラーの場合は元の画像を返す
-        return Image.open(image_file), False
+    cache = get_preprocess_cache()
+    session_id = get_session_id()
+
+    results = [None] * len(uploaded_files)
+    pending = []  # キャッシュミスした (インデックス, キャッシュキー)
+    for i, uploaded_file in enumerate(uploaded_files):
+        key = make_cache_key(uploaded_file.getvalue(), params)
+        cached_image = cache.get(session_id, key)
+        if cached_image is not None:
+            results[i] = (cached_image, True)
+        else:
+            pending.append((i, key))
+
+    outputs = preprocess_images_parallel(
+        [uploaded_files[i].getvalue() for i, _ in pending], params
+    )
+
+    for (i, key), (processed_image, error) in zip(pending, outputs):
+        if processed_image is not None:
+            cache.put(session_id, key, processed_image)
+            results[i] = (processed_image, True)
+        else:
+            st.warning(f"画像前処理でエラーが発生しました: {error}")
+            # エラーの場合は元の画像を返す
+            results[i] = (Image.open(io.BytesIO(uploaded_files[i].getvalue())), False)
+
+    return results
 
 def render_latex_content(text):
     """LaTeX混在テキストをStreamlitでレンダリング（シンプル版）"""
@@ -538,370 +693,214 @@ def render_latex_content(text):
         st.markdown("**フォールバック表示:**")
         st.text(text)
 
-def perform_ocr_with_processed_images(processed_images, original_files, model="gpt-4o-mini"):
-    """前処理済み画像からGPT Visionを使用して全ての文字・数式を抽出"""
-    try:
-        # 複数画像のbase64エンコード
-        image_contents = []
-        
-        for i, (processed_img, original_file) in enumerate(zip(processed_images, original_files)):
-            # PIL ImageをBytesIOに変換
-            img_buffer = io.BytesIO()
-            processed_img.save(img_buffer, format='PNG')
-            img_buffer.seek(0)
-            
-            # base64エンコード
-            image_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-            
-            image_contents.append({
-                "type": "image_url", 
-                "image_url": {
-                    "url": f"data:image/png;base64,{image_base64}",
-                    "detail": "high"
-                }
-            })
-        
-        # OpenAI クライアントを作成
-        client = openai.OpenAI(
-            api_key=os.environ.get("OPENAI_API_KEY"),
-            default_headers={}  # カスタムヘッダーをクリア
-        )
-        
-        # メッセージ構築（前処理済み画像対応）
-        content = [
-            {
-                "type": "text",
-                "text": f"これら{len(processed_images)}枚の前処理済み画像に含まれる全ての文字・数式を正確に読み取って、正確に書き出してください。数式はLaTeX記法で表現してください。これらの画像は読み取りやすくするために前処理（コントラスト強化、ノイズ除去等）が施されています。複数の画像がある場合は、順番に内容を統合して1つの文書として出力してください。"
-            }
-        ]
-        content.extend(image_contents)
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": """あなたは高精度なOCRシステムです。前処理済みの画像から全ての文字・数式を正確に読み取ってください。
-
-                以下のルールに従ってください：
-                1. 前処理によりコントラストが強化され、文字が鮮明になっています
-                2. 数式は適切なLaTeX記法で表現する（\\frac, \\sum, \\int, \\sqrt など）
-                3. 通常のテキストはそのまま記述する
-                4. レイアウト（段落、改行）を可能な限り保持する
-                5. 数式とテキストを適切に区別する
-                6. インライン数式は $ $ で、ディスプレイ数式は $$ $$ で囲む
-                7. 前処理により文字境界が強調されているので、細かい記号や上付き・下付き文字も正確に読み取る
-
-                出力例：
-                「三角関数の公式
-                $\\sin^2 x + \\cos^2 x = 1$
-                これは三角関数の最も基本的な恒等式である。
-
-                微分の定義
-                $$\\frac{d}{dx} f(x) = \\lim_{h \\to 0} \\frac{f(x+h) - f(x)}{h}$$」"""
-                },
-                {
-                    "role": "user",
-                    "content": content
-                }
-            ],
-            max_tokens=3000  # 複数画像なので上限を増やす
+def record_latency(label, model, first_token_s, total_s):
+    """応答時間（最初のトークンまで・全体）をセッションに記録（直近50件）"""
+    if 'latency_metrics' not in st.session_state:
+        st.session_state.latency_metrics = []
+    st.session_state.latency_metrics.append({
+        "label": label,
+        "model": model,
+        "first_token_s": first_token_s,
+        "total_s": total_s,
+    })
+    del st.session_state.latency_metrics[:-50]
+
+# バックグラウンドジョブの状態を確認する間隔（秒）
+JOB_POLL_INTERVAL = 1.0
+
+OCR_MODE_LABELS = {
+    "per_page": "ページごとに並列で読み取る（高速・長文向き）",
+    "single": "まとめて読み取る",
+    "cascade": "軽量モデルで読み、必要なページだけ高性能モデルで読み直す",
+    "regions": "文章と数式の領域に分けて読み取る（数式の多いページ向き）",
+}
+
+def get_upload_mime_type(uploaded_file):
+    """アップロードファイルのMIMEタイプを判定"""
+    file_type = uploaded_file.type
+    if file_type in ("image/jpeg", "image/png", "image/webp"):
+        return file_type
+    return "image/png"  # デフォルト
+
+def _ocr_job(job, images, model, mode, preprocessed, original_bytes, original_mimes, digests, segments,
+             page_cache, cache_namespace, region_cache):
+    """OCRジョブ本体（ワーカースレッドで実行するため st.* は呼ばない）"""
+    return run_ocr(images, model, mode, preprocessed, original_bytes, original_mimes,
+                   on_chunk=job.append, digests=digests, segments=segments,
+                   page_cache=page_cache, cache_namespace=cache_namespace,
+                   region_cache=region_cache)
+
+def start_ocr_job(uploaded_files, processed_images=None, model="gpt-4o-mini", mode="single", cache_key=None,
+                  digests=None, segments=None, settings=None, requested_model=None, page_namespace=None):
+    """
+    画像から全ての文字・数式を抽出するジョブを登録（OCRエンジン経由、プロバイダはモデル名から自動選択）
+    processed_images があれば前処理済み画像を、なければアップロード画像をそのまま使う
+    mode: "single"（全ページを1リクエスト）/ "per_page"（ページごとに並列）
+          / "cascade"（ページごとに軽量モデル → 品質チェックに落ちたページのみ指定モデル）
+    digests / segments: ページの内容ハッシュと前回の読み取り結果（追加・変更されたページだけを読み取る）
+    requested_model: プランで選ばれたモデル（応答時間の目標を超えたため model に格下げした場合の表示用）
+    page_namespace: 共有ページキャッシュの区分（プロンプト版・前処理設定。モデルは含まない）
+    """
+    # 前処理済み（傾き補正済み）の画像のみ、ユーザー間で共有するページキャッシュを使う
+    page_cache = None
+    if processed_images:
+        args = (processed_images, model, mode, True, None, None)
+        page_cache = get_shared_page_cache()
+    else:
+        # アップロードファイルはスクリプト側で読み出してからワーカーに渡す
+        data_list = [uploaded_file.getvalue() for uploaded_file in uploaded_files]
+        args = (
+            [Image.open(io.BytesIO(data)) for data in data_list], model, mode, False,
+            data_list, [get_upload_mime_type(f) for f in uploaded_files]
         )
-        
-        return response.choices[0].message.content.strip()
-        
-    except Exception as e:
-        error_msg = str(e).encode('utf-8', errors='ignore').decode('utf-8')
-        st.error(f"前処理済み画像 OCR エラー: {error_msg}")
-        st.error(f"エラー詳細: {type(e).__name__}")
-        # デバッグ情報
-        st.write("API キー設定状況:", "設定済み" if os.environ.get("OPENAI_API_KEY") else "未設定")
-        st.write("ファイル数:", len(uploaded_files) if uploaded_files else 0)
-        return None
 
-def perform_ocr_with_gemini_processed_images(processed_images, original_files):
-    """前処理済み画像からGemini 1.5 Flashを使用して全ての文字・数式を抽出"""
     try:
-        # Gemini 1.5 Flash モデルを使用
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        # 前処理済み画像をGemini用に準備
-        gemini_images = []
-        for processed_img in processed_images:
-            # PIL ImageをBytesIOに変換
-            img_buffer = io.BytesIO()
-            processed_img.save(img_buffer, format='PNG')
-            img_buffer.seek(0)
-            
-            # Gemini用の画像オブジェクトを作成
-            gemini_images.append({
-                'mime_type': 'image/png',
-                'data': img_buffer.getvalue()
-            })
-        
-        # プロンプトを作成
-        prompt = f"""これら{len(processed_images)}枚の前処理済み画像に含まれる全ての文字・数式を正確に読み取って、正確に書き出してください。
-
-以下のルールに従ってください：
-1. 前処理によりコントラストが強化され、文字が鮮明になっています
-2. 数式は適切なLaTeX記法で表現する（\\frac, \\sum, \\int, \\sqrt など）
-3. 通常のテキストはそのまま記述する
-4. レイアウト（段落、改行）を可能な限り保持する
-5. 数式とテキストを適切に区別する
-6. インライン数式は $ $ で、ディスプレイ数式は $$ $$ で囲む
-7. 複数の画像がある場合は、順番に内容を統合して1つの文書として出力してください
-
-出力例：
-「三角関数の公式
-$\\sin^2 x + \\cos^2 x = 1$
-これは三角関数の最も基本的な恒等式である。
-
-微分の定義
-$$\\frac{{d}}{{dx}} f(x) = \\lim_{{h \\to 0}} \\frac{{f(x+h) - f(x)}}{{h}}$$」
-"""
-        
-        # リクエストの内容を構築
-        request_parts = [prompt]
-        for img in gemini_images:
-            request_parts.append(img)
-        
-        # Gemini APIを呼び出し
-        response = model.generate_content(request_parts)
-        
-        return response.text.strip()
-        
-    except Exception as e:
-        error_msg = str(e).encode('utf-8', errors='ignore').decode('utf-8')
-        st.error(f"Gemini OCR エラー: {error_msg}")
-        st.error(f"エラー詳細: {type(e).__name__}")
-        return None
-
-def perform_ocr_with_gemini_multiple_images(uploaded_files):
-    """複数の画像からGemini 1.5 Flashを使用して全ての文字・数式を抽出"""
-    try:
-        # Gemini 1.5 Flash モデルを使用
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        # 画像をGemini用に準備
-        gemini_images = []
-        for uploaded_file in uploaded_files:
-            # ファイル形式を判定
-            file_type = uploaded_file.type
-            if file_type == "image/jpeg":
-                mime_type = "image/jpeg"
-            elif file_type == "image/png":
-                mime_type = "image/png"
-            elif file_type == "image/webp":
-                mime_type = "image/webp"
-            else:
-                mime_type = "image/png"  # デフォルト
-            
-            gemini_images.append({
-                'mime_type': mime_type,
-                'data': uploaded_file.getvalue()
-            })
-        
-        # プロンプトを作成
-        prompt = f"""これら{len(uploaded_files)}枚の画像に含まれる全ての文字・数式を正確に読み取って、正確に書き出してください。
-
-以下のルールに従ってください：
-1. 画像の全ての文字を漏れなく抽出する
-2. 数式は適切なLaTeX記法で表現する（\\frac, \\sum, \\int, \\sqrt など）
-3. 通常のテキストはそのまま記述する
-4. レイアウト（段落、改行）を可能な限り保持する
-5. 数式とテキストを適切に区別する
-6. インライン数式は $ $ で、ディスプレイ数式は $$ $$ で囲む
-7. 複数の画像がある場合は、順番に内容を統合して1つの文書として出力してください
-
-出力例：
-「三角関数の公式
-$\\sin^2 x + \\cos^2 x = 1$
-これは三角関数の最も基本的な恒等式である。
-
-微分の定義
-$$\\frac{{d}}{{dx}} f(x) = \\lim_{{h \\to 0}} \\frac{{f(x+h) - f(x)}}{{h}}$$」
-"""
-        
-        # リクエストの内容を構築
-        request_parts = [prompt]
-        for img in gemini_images:
-            request_parts.append(img)
-        
-        # Gemini APIを呼び出し
-        response = model.generate_content(request_parts)
-        
-        return response.text.strip()
-        
-    except Exception as e:
-        error_msg = str(e).encode('utf-8', errors='ignore').decode('utf-8')
-        st.error(f"Gemini OCR エラー: {error_msg}")
-        st.error(f"エラー詳細: {type(e).__name__}")
-        return None
+        # 同じ画像・モデル・プロンプト・前回結果のOCRが実行中なら、そのジョブの結果を共有する
+        with session_caller():
+            job_id = get_job_manager().submit(
+                "ocr", _ocr_job, *args, digests, segments, page_cache, page_namespace, get_ocr_cache(),
+                key=fingerprint("ocr", cache_key or digests, segments)
+            )
+    except JobQueueFull:
+        st.error("現在混み合っています。しばらくしてからもう一度お試しください。")
+        return
+    st.session_state.ocr_job = {
+        "id": job_id,
+        "model": model,
+        "requested_model": requested_model or model,
+        "mode": mode,
+        "pages": len(uploaded_files),
+        "cache_key": cache_key,
+        "settings": settings,
+    }
 
-def perform_ocr_with_multiple_images(uploaded_files, model="gpt-4o-mini"):
-    """複数の画像からGPT Visionを使用して全ての文字・数式を抽出"""
-    try:
-        # 複数画像のbase64エンコード
-        image_contents = []
-        
-        for i, uploaded_file in enumerate(uploaded_files):
-            image_base64 = base64.b64encode(uploaded_file.getvalue()).decode('utf-8')
-            
-            # ファイル形式を判定
-            file_type = uploaded_file.type
-            if file_type == "image/jpeg":
-                mime_type = "image/jpeg"
-            elif file_type == "image/png":
-                mime_type = "image/png"
-            elif file_type == "image/webp":
-                mime_type = "image/webp"
-            else:
-                mime_type = "image/png"  # デフォルト
-            
-            image_contents.append({
-                "type": "image_url", 
-                "image_url": {
-                    "url": f"data:{mime_type};base64,{image_base64}",
-                    "detail": "high"
-                }
-            })
-        
-        # OpenAI クライアントを作成
-        client = openai.OpenAI(
-            api_key=os.environ.get("OPENAI_API_KEY"),
-            default_headers={}  # カスタムヘッダーをクリア
-        )
-        
-        # メッセージ構築（複数画像対応）
-        content = [
-            {
-                "type": "text",
-                "text": f"これら{len(uploaded_files)}枚の前処理済み画像に含まれる全ての文字・数式を正確に読み取って、正確に書き出してください。数式はLaTeX記法で表現してください。これらの画像は読み取りやすくするために前処理（コントラスト強化、ノイズ除去等）が施されています。複数の画像がある場合は、順番に内容を統合して1つの文書として出力してください。"
-            }
-        ]
-        content.extend(image_contents)
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": """あなたは高精度なOCRシステムです。複数の画像に含まれる全ての文字・数式を正確に読み取ってください。
-
-                以下のルールに従ってください：
-                1. 前処理によりコントラストが強化され、文字が鮮明になっています
-                2. 数式は適切なLaTeX記法で表現する（\\frac, \\sum, \\int, \\sqrt など）
-                3. 通常のテキストはそのまま記述する
-                4. レイアウト（段落、改行）を可能な限り保持する
-                5. 数式とテキストを適切に区別する
-                6. インライン数式は $ $ で、ディスプレイ数式は $$ $$ で囲む
-                7. 前処理により文字境界が強調されているので、細かい記号や上付き・下付き文字も正確に読み取る
-
-                出力例：
-                「三角関数の公式
-                $\\sin^2 x + \\cos^2 x = 1$
-                これは三角関数の最も基本的な恒等式である。
-
-                微分の定義
-                $$\\frac{d}{dx} f(x) = \\lim_{h \\to 0} \\frac{f(x+h) - f(x)}{h}$$」"""
-                },
-                {
-                    "role": "user",
-                    "content": content
-                }
-            ],
-            max_tokens=3000  # 複数画像なので上限を増やす
-        )
-        
-        return response.choices[0].message.content.strip()
-        
-    except Exception as e:
-        error_msg = str(e).encode('utf-8', errors='ignore').decode('utf-8')
-        st.error(f"GPT Vision OCR エラー: {error_msg}")
-        st.error(f"エラー詳細: {type(e).__name__}")
-        # デバッグ情報
-        st.write("API キー設定状況:", "設定済み" if os.environ.get("OPENAI_API_KEY") else "未設定")
-        st.write("ファイル数:", len(uploaded_files) if uploaded_files else 0)
-        return None
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_ocr_job():
+    """OCRジョブの進み具合を表示し、完了したら結果を反映して画面全体を再実行"""
+    info = st.session_state.ocr_job
+    job = get_job_manager().get(info["id"])
+    if job is None:
+        # 期限切れ・サーバー再起動
+        del st.session_state.ocr_job
+        st.rerun()
+
+    if not job.finished:
+        st.info(f"⏳ {info['pages']}枚の画像を読み取り中...（{job.elapsed_s:.0f}秒）")
+        queued = get_rate_limiter().queue_length(info["model"])
+        if queued:
+            st.caption(f"混雑のため {info['model']} の送信待ちが {queued}件あります")
+        partial = job.partial_text
+        if partial:
+            st.text(partial)
+        return
 
-def perform_ocr_with_gpt(uploaded_file, model="gpt-4o-mini"):
-    """GPT Vision を使用して画像から全ての文字・数式を抽出"""
-    try:
-        # 画像をbase64エンコード
-        image_base64 = base64.b64encode(uploaded_file.getvalue()).decode('utf-8')
-        
-        # ファイル形式を判定
-        file_type = uploaded_file.type
-        if file_type == "image/jpeg":
-            mime_type = "image/jpeg"
-        elif file_type == "image/png":
-            mime_type = "image/png"
-        elif file_type == "image/webp":
-            mime_type = "image/webp"
+    del st.session_state.ocr_job
+    notices = []
+    if job.status == ERROR:
+        error_msg = str(job.error).encode('utf-8', errors='ignore').decode('utf-8')
+        notices.append(("error", f"OCR エラー: {error_msg}"))
+        notices.append(("error", f"エラー詳細: {type(job.error).__name__}"))
+        notices.append(("error", "❌ 読み取りに失敗しました"))
+    else:
+        result = job.result
+        latex_result = result["text"]
+        processed_pages = result["processed_pages"]
+        if result["reports"]:
+            notices.append(("caption", summarize_reports(result["reports"])))
+        reused_pages = info["pages"] - processed_pages - result["shared_pages"]
+        if reused_pages:
+            notices.append(("caption", f"前回の結果を再利用: {info['pages']}ページ中 {reused_pages}ページ"))
+        if result["shared_pages"]:
+            saved_calls = get_shared_page_cache().stats()["saved_calls"]
+            notices.append(("caption", f"共有キャッシュ: {result['shared_pages']}ページは同じページの読み取り結果を使用（累計 {saved_calls}回の読み取りを省略）"))
+        if "regions" in result:
+            regions = result["regions"]
+            notices.append(("caption", f"レイアウト解析: {regions['regions']}領域（うち数式 {regions['formulas']}）、{regions['ocr_regions']}領域を読み取りました"))
+        if info["mode"] == "cascade" and processed_pages:
+            notices.append(("caption", f"段階的読み取り: {processed_pages}ページ中 {len(result['escalated'])}ページを高性能モデルで読み直しました"))
+        for i, error in sorted(result["errors"].items()):
+            error_msg = str(error).encode('utf-8', errors='ignore').decode('utf-8')
+            notices.append(("warning", f"{i + 1}ページ目の読み取りに失敗しました: {error_msg}"))
+        if result["model"] != info["requested_model"]:
+            notices.append(("caption", f"⚠️ {info['requested_model']} の応答が遅いため {result['model']} で読み取りました"))
+
+        if latex_result:
+            ocr_cache = get_ocr_cache()
+            if info["cache_key"] and is_complete_ocr_result(latex_result):
+                ocr_cache.put(info["cache_key"], latex_result, {"model": info["model"], "pages": info["pages"]})
+            st.session_state.show_ocr_result = apply_ocr_result(
+                latex_result, {"settings": info["settings"], "segments": result["segments"]}
+            )
+            # 使用回数をインクリメント（実際に読み取ったページ数のみ）
+            if processed_pages:
+                increment_usage('ocr', processed_pages)
+            record_latency("ocr", info["model"], job.first_chunk_s, job.elapsed_s)
+            notices.append(("success", "✅ 読み取り完了!"))
+            notices.append(("caption", f"OCRキャッシュ ヒット率: {ocr_cache.stats()['hit_rate']:.0%}"))
         else:
-            mime_type = "image/png"  # デフォルト
-        
-        # OpenAI クライアントを作成
-        client = openai.OpenAI(
-            api_key=os.environ.get("OPENAI_API_KEY"),
-            default_headers={}  # カスタムヘッダーをクリア
-        )
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": """枚の前処理済み画像に含まれる全ての文字・数式を正確に読み取って、正確に書き出してください。数式はLaTeX記法で表現してください。これらの画像は読み取りやすくするために前処理（コントラスト強化、ノイズ除去等）が施されています。
+            notices.append(("error", "❌ 読み取りに失敗しました"))
 
-                以下のルールに従ってください：
-                1. 画像の全ての文字を漏れなく抽出する
-                2. 数式は適切なLaTeX記法で表現する（\\frac, \\sum, \\int, \\sqrt など）
-                3. 通常のテキストはそのまま記述する
-                4. レイアウト（段落、改行）を可能な限り保持する
-                5. 数式とテキストを適切に区別する
-                6. インライン数式は $ $ で、ディスプレイ数式は $$ $$ で囲む
+    st.session_state.ocr_notices = notices
+    st.rerun()
 
-                出力例：
-                「三角関数の公式
+def apply_ocr_result(latex_result, ocr_pages):
+    """
+    読み取り結果をテキスト欄に反映し、ページごとの結果（次回の差分読み取り用）を保存する
+    テキスト欄が前回の読み取り結果から編集されている場合は上書きせず、反映の仕方を利用者に確認する
+    戻り値: テキスト欄に反映したかどうか
+    """
+    previous = st.session_state.get('ocr_pages') or {}
+    current = st.session_state.get('latex_code', '')
+    # 前回の結果にないページ（今回新しく読み取ったページ）だけのテキスト
+    previous_digests = {tuple(segment["digests"]) for segment in previous.get("segments", [])}
+    added_text = OCR_PAGE_SEPARATOR.join(
+        segment["text"] for segment in ocr_pages["segments"]
+        if tuple(segment["digests"]) not in previous_digests
+    )
+    st.session_state.ocr_pages = {**ocr_pages, "text": latex_result}
+
+    if current.strip() and current not in (previous.get("text"), latex_result):
+        st.session_state.pending_ocr_result = {"text": latex_result, "added_text": added_text}
+        return False
+    st.session_state.pop('pending_ocr_result', None)
+    st.session_state.latex_code = latex_result
+    return True
+
+def show_pending_ocr_result():
+    """編集済みのテキスト欄に、新しい読み取り結果をどう反映するか選んでもらう"""
+    pending = st.session_state.pending_ocr_result
+    st.warning("テキスト欄は前回の読み取り後に編集されています。新しい読み取り結果をどう反映しますか？")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        if st.button("読み取り結果で置き換える（編集内容は失われます）", use_container_width=True):
+            st.session_state.latex_code = pending["text"]
+            del st.session_state.pending_ocr_result
+            st.rerun()
+    with col2:
+        if pending["added_text"] and st.button("編集内容の末尾に新しいページを追加", use_container_width=True):
+            edited = st.session_state.latex_code.rstrip()
+            st.session_state.latex_code = edited + OCR_PAGE_SEPARATOR + pending["added_text"]
+            del st.session_state.pending_ocr_result
+            st.rerun()
+    with col3:
+        if st.button("編集内容を残す", use_container_width=True):
+            del st.session_state.pending_ocr_result
+            st.rerun()
+    with st.expander("新しい読み取り結果"):
+        render_latex_content(pending["text"])
 
-                $\\sin^2 x + \\cos^2 x = 1$
+class PDFGenerationError(Exception):
+    """PDF生成の失敗（details はコンパイラの出力など）"""
 
-                これは三角関数の最も基本的な恒等式である。」"""
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "この画像に含まれる全ての文字・数式を正確に読み取って、適切にフォーマットしてください。数式はLaTeX記法で表現してください。"
-                        },
-                        {
-                            "type": "image_url", 
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{image_base64}",
-                                "detail": "high"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=2000
-        )
-        
-        return response.choices[0].message.content.strip()
-        
-    except Exception as e:
-        error_msg = str(e).encode('utf-8', errors='ignore').decode('utf-8')
-        st.error(f"GPT Vision OCR エラー: {error_msg}")
-        st.error(f"エラー詳細: {type(e).__name__}")
-        # デバッグ情報
-        st.write("API キー設定状況:", "設定済み" if os.environ.get("OPENAI_API_KEY") else "未設定")
-        st.write("ファイルタイプ:", uploaded_file.type if hasattr(uploaded_file, 'type') else "不明")
-        return None
+    def __init__(self, message, details=()):
+        super().__init__(message)
+        self.details = list(details)
 
-def generate_pdf(latex_code):
-    """LaTeX コードから PDF を生成"""
+def compile_preview_pdf(latex_code, output_name="preview.pdf"):
+    """
+    LaTeX コードから PDF を生成してパスを返す（失敗時は PDFGenerationError）
+    st.* を呼ばないため、バックグラウンドジョブからも呼び出せる
+    """
     try:
         # エンコーディング安全化（日本語対応）
         safe_latex_code = str(latex_code).encode('utf-8', errors='ignore').decode('utf-8')
@@ -958,10 +957,9 @@ def generate_pdf(latex_code):
                 ], cwd=tmpdir, capture_output=True, text=True, encoding='utf-8', errors='ignore')
                 
                 if result1.returncode != 0:
-                    st.error("uplatex コンパイルエラー:")
-                    st.code(f"stdout: {result1.stdout}")
-                    st.code(f"stderr: {result1.stderr}")
-                    return None
+                    raise PDFGenerationError("uplatex コンパイルエラー:", [
+                        f"stdout: {result1.stdout}", f"stderr: {result1.stderr}"
+                    ])
                 
                 # Step 2: dvipdfmx で .pdf ファイル生成
                 result2 = subprocess.run([
@@ -970,10 +968,9 @@ def generate_pdf(latex_code):
                 ], cwd=tmpdir, capture_output=True, text=True, encoding='utf-8', errors='ignore')
                 
                 if result2.returncode != 0:
-                    st.error("dvipdfmx コンパイルエラー:")
-                    st.code(f"stdout: {result2.stdout}")
-                    st.code(f"stderr: {result2.stderr}")
-                    return None
+                    raise PDFGenerationError("dvipdfmx コンパイルエラー:", [
+                        f"stdout: {result2.stdout}", f"stderr: {result2.stderr}"
+                    ])
                 
                 pdf_path = os.path.join(tmpdir, "document.pdf")
                 
@@ -981,21 +978,48 @@ def generate_pdf(latex_code):
                     # PDF を保存用ディレクトリにコピー
                     output_dir = "outputs"
                     os.makedirs(output_dir, exist_ok=True)
-                    final_pdf_path = os.path.join(output_dir, "preview.pdf")
+                    final_pdf_path = os.path.join(output_dir, output_name)
                     shutil.copy2(pdf_path, final_pdf_path)
                     return final_pdf_path
                 else:
-                    st.error("PDF ファイルが生成されませんでした")
-                    return None
+                    raise PDFGenerationError("PDF ファイルが生成されませんでした")
                     
             except FileNotFoundError as e:
-                st.error(f"LaTeX コンパイラが見つかりません: {str(e)}")
-                st.info("uplatex と dvipdfmx がインストールされているか確認してください")
-                return None
+                raise PDFGenerationError(f"LaTeX コンパイラが見つかりません: {str(e)}", [
+                    "uplatex と dvipdfmx がインストールされているか確認してください"
+                ])
                 
+    except PDFGenerationError:
+        raise
     except Exception as e:
-        st.error(f"PDF 生成エラー: {str(e)}")
-        return None
+        raise PDFGenerationError(f"PDF 生成エラー: {str(e)}")
+
+def _pdf_job(job, latex_code, output_name):
+    """PDF生成ジョブ本体（ワーカースレッドで実行するため st.* は呼ばない）"""
+    return compile_preview_pdf(latex_code, output_name)
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_pdf_job():
+    """PDF生成ジョブの完了を待ち、結果を反映して画面全体を再実行"""
+    job = get_job_manager().get(st.session_state.pdf_job)
+    if job is None:
+        del st.session_state.pdf_job
+        st.rerun()
+
+    if not job.finished:
+        st.info(f"📄 PDF生成中...（{job.elapsed_s:.0f}秒）")
+        return
+
+    del st.session_state.pdf_job
+    if job.status == ERROR:
+        details = getattr(job.error, "details", [])
+        st.session_state.pdf_notices = [("error", str(job.error))] + [("code", d) for d in details]
+        st.session_state.pdf_notices.append(("error", "❌ PDF生成失敗"))
+    else:
+        st.session_state.pdf_path = job.result
+        st.session_state.pdf_notices = [("success", "✅ PDF生成完了!")]
+    st.rerun()
+
 
 def build_conversation_context(chat_history, latex_code, new_question):
     """会話履歴を含むコンテキストを構築"""
@@ -1044,12 +1068,10 @@ def get_ai_response_with_context(conversation_context):
             st.error("OpenAI API キーが設定されていません")
             return None
         
-        client = openai.OpenAI(
-            api_key=api_key,
-            default_headers={}
-        )
+        client = get_openai_client()
         
-        response = client.chat.completions.create(
+        response = call_with_retry(
+            "openai", client.chat.completions.create,
             model="o4-mini",
             messages=[
                 {
@@ -1092,7 +1114,10 @@ LaTeX記法の例：
         return None
 
 def generate_conversation_pdf(chat_history, latex_code=""):
-    """会話履歴をPDFとして出力"""
+    """
+    会話履歴をPDFとして出力してパスを返す（失敗時は PDFGenerationError）
+    st.* を呼ばないため、バックグラウンドジョブからも呼び出せる
+    """
     try:
         def safe_encode(text):
             if isinstance(text, bytes):
@@ -1198,10 +1223,9 @@ def generate_conversation_pdf(chat_history, latex_code=""):
                 ], cwd=tmpdir, capture_output=True, text=True, encoding='utf-8', errors='ignore')
                 
                 if result1.returncode != 0:
-                    st.error("会話PDF uplatex コンパイルエラー:")
-                    st.text(f"stdout: {result1.stdout}")
-                    st.text(f"stderr: {result1.stderr}")
-                    return None
+                    raise PDFGenerationError("会話PDF uplatex コンパイルエラー:", [
+                        f"stdout: {result1.stdout}", f"stderr: {result1.stderr}"
+                    ])
                 
                 # Step 2: dvipdfmx で .pdf ファイル生成
                 result2 = subprocess.run([
@@ -1210,10 +1234,9 @@ def generate_conversation_pdf(chat_history, latex_code=""):
                 ], cwd=tmpdir, capture_output=True, text=True, encoding='utf-8', errors='ignore')
                 
                 if result2.returncode != 0:
-                    st.error("会話PDF dvipdfmx エラー:")
-                    st.text(f"stdout: {result2.stdout}")
-                    st.text(f"stderr: {result2.stderr}")
-                    return None
+                    raise PDFGenerationError("会話PDF dvipdfmx エラー:", [
+                        f"stdout: {result2.stdout}", f"stderr: {result2.stderr}"
+                    ])
                 
                 pdf_path = os.path.join(tmpdir, "conversation.pdf")
                 
@@ -1228,101 +1251,162 @@ def generate_conversation_pdf(chat_history, latex_code=""):
                         f.write(pdf_data)
                     return final_pdf_path
                 else:
-                    st.error("生成されたPDFファイルが見つかりません。")
-                    return None
+                    raise PDFGenerationError("生成されたPDFファイルが見つかりません。")
 
             except FileNotFoundError:
-                st.error("uplatex/dvipdfmxが見つかりません。TeX Liveがインストールされているか確認してください。")
-                return None
-            except Exception as e:
-                st.error(f"PDF生成中に予期せぬエラーが発生しました: {e}")
-                return None
+                raise PDFGenerationError(
+                    "uplatex/dvipdfmxが見つかりません。TeX Liveがインストールされているか確認してください。"
+                )
 
+    except PDFGenerationError:
+        raise
     except Exception as e:
-        st.error(f"PDF生成の準備中にエラー: {e}")
-        return None
+        raise PDFGenerationError(f"PDF生成中に予期せぬエラーが発生しました: {e}")
+
+def _conversation_pdf_job(job, chat_history, latex_code):
+    """会話PDF生成ジョブ本体（ワーカースレッドで実行するため st.* は呼ばない）"""
+    return generate_conversation_pdf(chat_history, latex_code)
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_conversation_pdf_job():
+    """会話PDF生成ジョブの完了を待ち、結果を反映して画面全体を再実行"""
+    job = get_job_manager().get(st.session_state.conversation_pdf_job)
+    if job is None:
+        del st.session_state.conversation_pdf_job
+        st.rerun()
+
+    if not job.finished:
+        st.info(f"📄 PDF生成中...（{job.elapsed_s:.0f}秒）")
+        return
 
-def get_ai_response_simple(context):
-    """シンプルなAI応答取得（GPT-4o-miniなど）"""
-    try:
-        client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": context['system_prompt']},
-                {"role": "user", "content": context['user_input']}
-            ],
-            max_tokens=3000,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        error_msg = str(e).encode('utf-8', errors='ignore').decode('utf-8')
-        st.error(f"GPT 応答エラー: {error_msg}")
-        return None
+    del st.session_state.conversation_pdf_job
+    if job.status == ERROR:
+        details = getattr(job.error, "details", [])
+        st.session_state.conversation_pdf_notices = [("error", str(job.error))] + [("code", d) for d in details]
+        st.session_state.conversation_pdf_notices.append(("error", "❌ PDF生成失敗"))
+    else:
+        st.session_state.response_pdf_path = job.result
+        st.session_state.conversation_pdf_notices = [("success", "✅ PDF生成完了!")]
+    st.rerun()
+
+
+def _chat_job(job, context, model, fallback_context=None):
+    """チャットジョブ本体（ワーカースレッドで実行するため st.* は呼ばない）"""
+    stream = HedgedStream(
+        "chat", model, context.system_prompt, context.question, max_tokens=CHAT_MAX_TOKENS,
+        on_queue=lambda position: job.meta.update(queue_position=position),
+        history=context.history,
+        fallback_request=fallback_context and (
+            fallback_context.system_prompt, fallback_context.question, fallback_context.history
+        ),
+    )
+    for chunk in stream:
+        job.append(chunk)
+    job.meta["model"] = stream.model
+    return job.partial_text.strip()
 
-def get_gemini_response(context, model_name="gemini-1.5-flash-latest"):
-    """Geminiモデルを使用して応答を取得"""
+def release_replaced_context_cache(model, context):
+    """
+    参考資料の編集などで、このセッションが同じモデルで前回使ったコンテキストキャッシュが不要になったら削除する
+    （残すと期限の1時間まで保存料金が掛かる。モデルを変えた場合は使われなくなってから削除される）
+    """
+    previous = st.session_state.get("context_cache_prompt")
+    current = (model, context.system_prompt) if context.report["context_cached"] else None
+    if previous is not None and previous[0] == model and previous != current:
+        release_gemini_cache(*previous)
+    st.session_state.context_cache_prompt = current
+
+def start_chat_job(chat_messages, latex_code, model):
+    """
+    チャットの応答を生成するジョブを登録（応答時間の目標を超えているモデルは高速な下位モデルへ）
+    文脈は応答するモデルのトークン予算に収めてから送る（長い参考資料は質問に関係する部分だけ）
+    ヘッジ・切り替え先のモデルには、そのモデルの予算で作り直した文脈を送る
+    """
+    route = get_model_router().route("chat", model)
+    model = route.model
+    reference_index = get_reference_index()
+    reference_index.update(latex_code)
+    context = build_chat_context(chat_messages, latex_code, model, reference_index=reference_index)
+    fallback_context = None
+    fallback_model = FAILOVER_MODELS.get(model)
+    if fallback_model:
+        fallback_context = build_chat_context(chat_messages, latex_code, fallback_model,
+                                              reference_index=reference_index)
+        if (fallback_context.system_prompt, fallback_context.history, fallback_context.question) == \
+                (context.system_prompt, context.history, context.question):
+            fallback_context = None
+    release_replaced_context_cache(model, context)
     try:
-        # モデル設定
-        if model_name == "gemini-1.5-flash-latest":
-            # 無料プランは思考モード（中）を使用
-            if st.session_state.user_plan == 'free':
-                model = genai.GenerativeModel(
-                    'gemini-1.5-flash-latest',
-                    generation_config={
-                    }
-                )
-            else:
-                model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        elif model_name == "gemini-1.5-pro-latest":
-            model = genai.GenerativeModel('gemini-1.5-pro-latest')
-        else:
-            model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        # システムプロンプト
-        system_prompt = """あなたは科学の専門家です。会話履歴を踏まえて、一貫性のある回答をしてください。
+        # 同じ文脈・モデルの応答が生成中なら、そのジョブの結果を共有する
+        with session_caller():
+            job_id = get_job_manager().submit(
+                "chat", _chat_job, context, model, fallback_context,
+                key=fingerprint("chat", model, context.system_prompt, context.history, context.question)
+            )
+    except JobQueueFull:
+        error_msg = "現在混み合っています。しばらくしてからもう一度お試しください。"
+        st.session_state.chat_messages.append({"role": "assistant", "content": error_msg})
+        with st.chat_message("assistant"):
+            render_latex_content(error_msg)
+        return
+    st.session_state.chat_job = {
+        "id": job_id,
+        "model": model,
+        "requested_model": route.requested_model,
+        "context_report": context.report,
+    }
 
-回答する際の重要なルール：
-1. 会話履歴を考慮して、前の質問との関連性を意識する
-2. 「先ほど」「前回」などの表現がある場合は、履歴を参照する
-3. 数式は必ず正確なLaTeX記法で表現する
-4. インライン数式は $...$ で囲む
-5. ディスプレイ数式は $$...$$ で囲む
-6. 追加質問の場合は、前の回答を踏まえて補足説明する
-7. 一貫した説明を心がけ、矛盾のない回答をする
-8. 回答は簡潔にまとめ、3-4段落以内に収める
-9. ユーザーの入力に誤字脱字がある場合は、適切に解釈し、回答を行う9. ユーザーの入力に誤字脱字がある場合は、適切に解釈し、回答を行う
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_chat_job():
+    """生成中の応答を逐次表示し、完了したら履歴に追加して画面全体を再実行"""
+    info = st.session_state.chat_job
+    job = get_job_manager().get(info["id"])
+    if job is None:
+        del st.session_state.chat_job
+        st.rerun()
+
+    if not job.finished:
+        with st.chat_message("assistant"):
+            partial = job.partial_text
+            position = job.meta.get("queue_position", 0)
+            if partial:
+                st.markdown(partial, unsafe_allow_html=True)
+            elif position:
+                st.caption(f"⏳ 混雑のため順番待ち中（{position}番目）")
+            else:
+                st.caption("⏳ 回答を生成中...")
+        return
 
-LaTeX記法の例：
-- 分数: \\frac{分子}{分母}
-- 上付き: x^{2}、下付き: x_{1}
-- 平方根: \\sqrt{x}
-- 積分: \\int_{下限}^{上限} f(x) dx
-- 総和: \\sum_{i=1}^{n} a_i"""
-        
-        # プロンプトを構築
-        prompt = f"{system_prompt}\n\n{context}"
-        
-        # Gemini APIを呼び出し
-        response = model.generate_content(prompt)
-        
-        return response.text.strip()
-        
-    except Exception as e:
-        error_msg = str(e).encode('utf-8', errors='ignore').decode('utf-8')
-        st.error(f"Gemini API エラー: {error_msg}")
-        return None
+    del st.session_state.chat_job
+    message = {"role": "assistant"}
+    if job.status == ERROR or not job.result:
+        if job.error is not None:
+            error_msg = str(job.error).encode('utf-8', errors='ignore').decode('utf-8')
+            st.session_state.chat_notices = [f"応答エラー: {error_msg}"]
+        response = "申し訳ありません、エラーが発生しました。"
+    else:
+        response = job.result
+        # 応答の使用回数をインクリメント
+        increment_usage('question')
+        record_latency("chat", info["model"], job.first_chunk_s, job.elapsed_s)
+        # 格下げ・切り替えで別のモデルが応答した場合は、その旨を回答に付けて残す
+        answered_model = job.meta.get("model", info["model"])
+        if answered_model != info["requested_model"]:
+            message["note"] = f"⚠️ {info['requested_model']} の応答が遅いため {answered_model} で応答しました"
+        message["context_report"] = info["context_report"]
+    # 応答を履歴に追加
+    message["content"] = response
+    st.session_state.chat_messages.append(message)
+    st.rerun()
 
 def get_ai_response(latex_code, question):
     """GPT-4o mini に質問して回答を取得"""
     try:
-        # OpenAI クライアントを作成
-        client = openai.OpenAI(
-            api_key=os.environ.get("OPENAI_API_KEY"),
-            default_headers={}  # カスタムヘッダーをクリア
-        )
+        # 共有のOpenAI クライアントを取得
+        client = get_openai_client()
         
-        response = client.chat.completions.create(
+        response = call_with_retry(
+            "openai", client.chat.completions.create,
             model="o4-mini",
             messages=[
                 {
@@ -1433,28 +1517,6 @@ def generate_response_pdf_safe(question, answer, latex_code=""):
         st.error(f"PDF生成エラー: {str(e)}")
         return None
 
-def build_chat_context(chat_messages, latex_code):
-    """チャット用のコンテキストを構築"""
-    context = f"参考資料:\n{latex_code}\n\n"
-    
-    if len(chat_messages) > 1:
-        context += "これまでの会話履歴:\n"
-        # 最新のメッセージを除いた最近の会話を取得
-        recent_messages = chat_messages[-6:]  # 最大6メッセージ（3組）
-        
-        for i in range(0, len(recent_messages) - 1, 2):
-            if i + 1 < len(recent_messages):
-                user_msg = recent_messages[i]["content"]
-                ai_msg = recent_messages[i + 1]["content"]
-                context += f"質問{i//2+1}: {user_msg}\n回答{i//2+1}: {ai_msg}\n\n"
-    
-    # 最新の質問を追加
-    if chat_messages:
-        latest_question = chat_messages[-1]["content"]
-        context += f"新しい質問: {latest_question}"
-    
-    return context
-
 def generate_response_pdf(question, answer, latex_code=""):
     """質問と回答をPDFとして出力"""
     try:
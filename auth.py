@@ -273,7 +273,7 @@ def show_usage_limits():
         question_count = st.session_state.get('question_usage_count', 0)
         
         st.markdown("### 📊 使用状況")
-        st.write(f"OCR実行: {ocr_count}回")
+        st.write(f"OCR実行: {ocr_count}ページ")
         st.write(f"質問回数: {question_count}回")
         
         # プレミアムアップグレードボタン
@@ -287,8 +287,8 @@ def show_upgrade_modal():
     """アップグレードモーダル表示"""
     st.info("Premium機能：\n- 無制限OCR\n- 無制限質問\n- 高精度モデル利用")
     
-def check_usage_limit(action_type):
-    """使用制限チェック"""
+def check_usage_limit(action_type, amount=1):
+    """使用制限チェック（OCRは今回読み取るページ数を amount に指定）"""
     plan = st.session_state.user_plan
     
     if plan == 'premium':
@@ -309,11 +309,17 @@ def check_usage_limit(action_type):
     if current_count >= limit:
         st.error(f"{action_type.upper()}の使用回数上限に達しました。Premiumにアップグレードしてください。")
         return False
+    if current_count + amount > limit:
+        st.error(
+            f"{action_type.upper()}の残りは{limit - current_count}ページです（今回は{amount}ページ）。"
+            "ページを減らすか、Premiumにアップグレードしてください。"
+        )
+        return False
     
     return True
 
-def increment_usage(action_type):
-    """使用回数をインクリメントし、ファイルに保存"""
+def increment_usage(action_type, amount=1):
+    """使用回数をインクリメントし、ファイルに保存（OCRは読み取ったページ数を amount に指定）"""
     user_id = st.session_state.user_info.get('sub')
     if not user_id:
         return
@@ -331,7 +337,7 @@ def increment_usage(action_type):
         if count_key:
             # セッションのカウントを更新
             current_count = st.session_state.get(count_key, 0)
-            st.session_state[count_key] = current_count + 1
+            st.session_state[count_key] = current_count + amount
             
             # ユーザーデータをロードして更新し、保存
             user_data = load_user_data(user_id)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+旧RGB経由の前処理と、グレースケール1チャンネルの前処理の時間・メモリ・PNGサイズ比較
+
+ピークメモリは変種ごとに新しいプロセスで、前処理の実行中に現在のRSS（/proc/self/statm）を
+短い間隔で読み取って計測する（ru_maxrss はインポート時の最大値を含んだまま減らないため使わない）。
+/proc のない環境では tracemalloc（numpy の確保分のみ）で代用する
+
+使い方:
+    python benchmarks/bench_grayscale_pipeline.py --megapixels 12
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_pages import make_page_jpeg  # noqa: E402
+from image_processing import PREPROCESS_PARAMS, preprocess_image_data  # noqa: E402
+
+def legacy_preprocess(data, clip_limit=1.3, tile_grid_size=(8, 8), auto_crop=False):
+    """変更前の前処理（PIL RGB → BGR → GRAY → CLAHE → BGR → RGB → PIL、切り抜きなし）"""
+    pil_image = Image.open(io.BytesIO(data))
+    if pil_image.mode != 'RGB':
+        pil_image = pil_image.convert('RGB')
+    image_array = np.array(pil_image)
+    image_bgr = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+    gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
+    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tuple(tile_grid_size))
+    enhanced_gray = clahe.apply(gray)
+    final_bgr = cv2.cvtColor(enhanced_gray, cv2.COLOR_GRAY2BGR)
+    final_rgb = cv2.cvtColor(final_bgr, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(final_rgb)
+
+VARIANTS = {
+    "legacy_rgb": legacy_preprocess,
+    "grayscale": preprocess_image_data,
+}
+
+STATM_PATH = "/proc/self/statm"
+RSS_SAMPLE_INTERVAL_S = 0.001
+
+def _current_rss_mb():
+    """現在のRSS（MB）"""
+    with open(STATM_PATH) as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+class PeakMemory:
+    """with の間のピークメモリ増分（MB）を計測する"""
+
+    def __init__(self):
+        self.use_rss = os.path.exists(STATM_PATH)
+        self.method = "rss" if self.use_rss else "tracemalloc"
+        self.peak_delta_mb = 0.0
+        self._stop = threading.Event()
+
+    def _sample(self, baseline):
+        peak = baseline
+        while not self._stop.is_set():
+            peak = max(peak, _current_rss_mb())
+            time.sleep(RSS_SAMPLE_INTERVAL_S)
+        self.peak_delta_mb = max(peak, _current_rss_mb()) - baseline
+
+    def __enter__(self):
+        if self.use_rss:
+            self._thread = threading.Thread(target=self._sample, args=(_current_rss_mb(),), daemon=True)
+            self._thread.start()
+        else:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.use_rss:
+            self._stop.set()
+            self._thread.join()
+        else:
+            self.peak_delta_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+        return False
+
+def _run_variant(name, data, repeat, queue):
+    func = VARIANTS[name]
+    # 初回の呼び出しで確保される OpenCV 内部のバッファなどを計測から外す
+    func(data, **PREPROCESS_PARAMS)
+
+    timings = []
+    peak_delta = 0.0
+    for _ in range(repeat):
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            image = func(data, **PREPROCESS_PARAMS)
+            timings.append(time.perf_counter() - start)
+        peak_delta = max(peak_delta, memory.peak_delta_mb)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    queue.put({
+        "variant": name,
+        "seconds": min(timings),
+        "peak_memory_delta_mb": peak_delta,
+        "memory_method": memory.method,
+        "png_bytes": len(buffer.getvalue()),
+        "mode": image.mode,
+    })
+
+def measure(name, data, repeat):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_variant, args=(name, data, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--megapixels", type=float, default=12.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = make_page_jpeg(args.megapixels, seed=0)
+    results = [measure(name, data, args.repeat) for name in VARIANTS]
+
+    print(f"megapixels={args.megapixels} jpeg_bytes={len(data)}")
+    for r in results:
+        print(
+            f"{r['variant']:<11}: {r['seconds'] * 1000:8.1f}ms  "
+            f"peak {r['memory_method']} +{r['peak_memory_delta_mb']:7.1f}MB  "
+            f"PNG {r['png_bytes'] / 1024:8.0f}KB  mode={r['mode']}"
+        )
+
+    legacy, gray = results
+    print(f"time ratio : {legacy['seconds'] / gray['seconds']:.2f}x")
+    if gray['peak_memory_delta_mb'] > 0:
+        print(f"memory ratio: {legacy['peak_memory_delta_mb'] / gray['peak_memory_delta_mb']:.2f}x")
+    print(f"PNG ratio  : {legacy['png_bytes'] / gray['png_bytes']:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+前処理の逐次実行とプロセスプール並列実行のスループット比較
+
+使い方:
+    python benchmarks/bench_parallel_preprocess.py --pages 8 --megapixels 12
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_pages import make_page_jpeg  # noqa: E402
+from image_processing import (  # noqa: E402
+    PREPROCESS_PARAMS, _preprocess_worker, get_preprocess_pool, preprocess_images_parallel
+)
+
+def run_serial(pages):
+    return [_preprocess_worker(data, PREPROCESS_PARAMS) for data in pages]
+
+def run_parallel(pages):
+    return preprocess_images_parallel(pages, PREPROCESS_PARAMS)
+
+def measure(func, pages, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = func(pages)
+        timings.append(time.perf_counter() - start)
+        if any(image is None for image, _ in results):
+            raise RuntimeError("前処理に失敗したページがあります")
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=8)
+    parser.add_argument("--megapixels", type=float, default=12.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = [make_page_jpeg(args.megapixels, seed) for seed in range(args.pages)]
+
+    # プロセス起動コストは初回のみなので計測から除外する
+    get_preprocess_pool().submit(int, 0).result()
+
+    serial = measure(run_serial, pages, args.repeat)
+    parallel = measure(run_parallel, pages, args.repeat)
+
+    print(f"pages={args.pages} megapixels={args.megapixels}")
+    print(f"serial   : {serial:.3f}s ({args.pages / serial:.2f} pages/s)")
+    print(f"parallel : {parallel:.3f}s ({args.pages / parallel:.2f} pages/s)")
+    print(f"speedup  : {serial / parallel:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+前処理のステージ別マイクロベンチマーク
+
+擬似教科書ページ（1MP〜48MP）に対して、デコード・色変換・切り抜き・CLAHE・エンコード・base64 の
+各ステージの時間とピークメモリ（tracemalloc）を計測し、JSONに書き出す。
+--compare で以前のJSONと比較し、ステージごとの速度比を表示する。
+
+使い方:
+    python benchmarks/preprocess_suite.py
+    python benchmarks/preprocess_suite.py --megapixels 1 12 --compare benchmarks/results/preprocess_abc1234.json
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from synthetic_pages import make_page_jpeg  # noqa: E402
+from image_encoder import encode_image  # noqa: E402
+from image_processing import PREPROCESS_PARAMS, crop_and_deskew, preprocess_image_data  # noqa: E402
+
+DEFAULT_MEGAPIXELS = [1, 4, 12, 24, 48]
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def measure_stage(func, repeat):
+    """ステージを repeat 回実行し、時間（ms）とピークメモリ（KB）を計測"""
+    timings = []
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return result, {
+        "ms_min": min(timings),
+        "ms_median": statistics.median(timings),
+        "peak_kb": peak / 1024,
+    }
+
+def run_resolution(megapixels, seed, repeat):
+    data = make_page_jpeg(megapixels, seed)
+    params = PREPROCESS_PARAMS
+    stages = {}
+
+    # 旧来のカラーデコード + 色変換
+    color, stages["decode_color"] = measure_stage(
+        lambda: cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR), repeat)
+    _, stages["color_conversion"] = measure_stage(
+        lambda: cv2.cvtColor(color, cv2.COLOR_BGR2GRAY), repeat)
+
+    # 現在のグレースケール直接デコード
+    gray, stages["decode_gray"] = measure_stage(
+        lambda: cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE), repeat)
+
+    (_, crop_report), stages["crop_deskew"] = measure_stage(lambda: crop_and_deskew(gray), repeat)
+
+    clahe = cv2.createCLAHE(clipLimit=params["clip_limit"], tileGridSize=tuple(params["tile_grid_size"]))
+    enhanced, stages["clahe"] = measure_stage(lambda: clahe.apply(gray), repeat)
+
+    encoded, stages["encode"] = measure_stage(lambda: encode_image(Image.fromarray(enhanced)), repeat)
+    _, stages["base64"] = measure_stage(lambda: base64.b64encode(encoded["data"]), repeat)
+
+    _, stages["end_to_end"] = measure_stage(lambda: preprocess_image_data(data, **params), repeat)
+
+    return {
+        "megapixels": megapixels,
+        "size": [int(gray.shape[1]), int(gray.shape[0])],
+        "jpeg_bytes": len(data),
+        "encoded_format": encoded["format"],
+        "encoded_bytes": encoded["bytes"],
+        "crop_ratio": crop_report["crop_ratio"],
+        "stages": stages,
+    }
+
+def compare(current, baseline):
+    """以前の結果とステージごとの ms_min の比を表示（1.0より大きいと遅くなっている）"""
+    previous = {r["megapixels"]: r for r in baseline["results"]}
+    print(f"\ncompare with {baseline['meta']['commit']} (ratio = current / baseline)")
+    for result in current["results"]:
+        old = previous.get(result["megapixels"])
+        if old is None:
+            continue
+        ratios = []
+        for stage, values in result["stages"].items():
+            if stage in old["stages"] and old["stages"][stage]["ms_min"] > 0:
+                ratios.append(f"{stage}={values['ms_min'] / old['stages'][stage]['ms_min']:.2f}")
+        print(f"  {result['megapixels']:>4}MP: " + " ".join(ratios))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megapixels", type=float, nargs="+", default=DEFAULT_MEGAPIXELS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は results/preprocess_<commit>.json）")
+    parser.add_argument("--compare", help="比較対象の結果JSON")
+    args = parser.parse_args()
+
+    commit = _git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "results": [],
+    }
+
+    for megapixels in args.megapixels:
+        result = run_resolution(megapixels, args.seed, args.repeat)
+        report["results"].append(result)
+        summary = " ".join(f"{name}={values['ms_min']:.1f}ms" for name, values in result["stages"].items())
+        print(f"{megapixels:>4}MP: {summary}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"preprocess_{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"saved: {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマーク用の擬似教科書ページ生成（オフライン・シード固定で再現可能）
+
+本文テキスト・数式（分数線・添字つき）を描画し、照明ムラ・ノイズ・透視変換を加えて
+スマートフォンで撮影したページに近い画像を作る
+"""
+import cv2
+import numpy as np
+
+PROSE_LINES = [
+    "The derivative of f at x is defined as the limit below.",
+    "Let a, b and c be real coefficients with a != 0.",
+    "Integrating both sides over [a, b] gives the result.",
+    "Hence the series converges for every |x| < 1.",
+]
+FORMULA_LINES = [
+    ("x = -b +- sqrt(b^2 - 4ac)", "2a"),
+    ("f(x+h) - f(x)", "h"),
+    ("sum a_n x^n", "n!"),
+    ("d^2 y", "dx^2"),
+]
+
+def _draw_fraction(page, x, y, numerator, denominator, scale, thickness):
+    """分数（分子・分数線・分母）を描画し、使った高さを返す"""
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    (num_w, num_h), _ = cv2.getTextSize(numerator, font, scale, thickness)
+    (den_w, den_h), _ = cv2.getTextSize(denominator, font, scale, thickness)
+    bar_w = max(num_w, den_w)
+    cv2.putText(page, numerator, (x + (bar_w - num_w) // 2, y), font, scale, 20, thickness, cv2.LINE_AA)
+    bar_y = y + num_h // 2 + thickness * 2
+    cv2.line(page, (x, bar_y), (x + bar_w, bar_y), 20, thickness, cv2.LINE_AA)
+    cv2.putText(page, denominator, (x + (bar_w - den_w) // 2, bar_y + den_h + thickness * 3),
+                font, scale, 20, thickness, cv2.LINE_AA)
+    # 添字（小さい文字）
+    cv2.putText(page, "n=1", (x + bar_w + thickness * 4, bar_y + den_h), font, scale * 0.55, 20,
+                max(1, thickness // 2), cv2.LINE_AA)
+    return num_h + den_h + thickness * 8
+
+def render_page(megapixels, seed=0):
+    """撮影前のきれいなページ（グレースケール）を生成"""
+    rng = np.random.default_rng(seed)
+    width = int((megapixels * 1_000_000 * 3 / 4) ** 0.5)
+    height = int(width * 4 / 3)
+    page = np.full((height, width), 245, dtype=np.uint8)
+
+    margin = width // 12
+    line_height = max(height // 45, 14)
+    scale = line_height / 32
+    thickness = max(1, int(round(scale * 2)))
+
+    y = margin + line_height
+    while y < height - margin - line_height * 3:
+        if rng.random() < 0.3:
+            numerator, denominator = FORMULA_LINES[rng.integers(len(FORMULA_LINES))]
+            y += _draw_fraction(page, margin * 2, y, numerator, denominator, scale, thickness) + line_height
+        else:
+            text = PROSE_LINES[rng.integers(len(PROSE_LINES))]
+            cv2.putText(page, text, (margin, y), cv2.FONT_HERSHEY_SIMPLEX, scale, 30, thickness, cv2.LINE_AA)
+            y += line_height
+    return page
+
+def photograph(page, seed=0):
+    """照明ムラ・ノイズ・透視変換・机の背景を加えてカラー写真風にする"""
+    rng = np.random.default_rng(seed + 1)
+    height, width = page.shape
+
+    # 照明ムラ（左上から右下への明るさの勾配）
+    gradient = np.linspace(0.8, 1.05, width, dtype=np.float32)[None, :] * \
+        np.linspace(0.9, 1.0, height, dtype=np.float32)[:, None]
+    lit = np.clip(page.astype(np.float32) * gradient + rng.normal(0, 6, page.shape), 0, 255).astype(np.uint8)
+
+    # 透視変換（四隅をランダムにずらし、外側は机の色で埋める）
+    jitter = min(width, height) * 0.06
+    src = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    dst = src + rng.uniform(-jitter, jitter, size=src.shape).astype(np.float32)
+    matrix = cv2.getPerspectiveTransform(src, dst)
+    warped = cv2.warpPerspective(lit, matrix, (width, height), borderValue=90)
+
+    # 紙の黄ばみを少し乗せてカラー化
+    color = cv2.merge([
+        (warped * 0.92).astype(np.uint8),
+        (warped * 0.97).astype(np.uint8),
+        warped,
+    ])
+    return color
+
+def make_page_jpeg(megapixels, seed=0, quality=90):
+    """撮影風の擬似ページをJPEGバイト列で生成"""
+    color = photograph(render_page(megapixels, seed), seed)
+    ok, encoded = cv2.imencode(".jpg", color, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("JPEGエンコードに失敗しました")
+    return encoded.tobytes()
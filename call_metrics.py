@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""プロバイダ呼び出し時間の記録と集計（プロセス全体、Streamlitに依存しない）"""
+import math
+import threading
+import time
+from collections import defaultdict, deque
+
+# 直近のプロバイダ呼び出し時間（プロセス全体）
+_call_timings = deque(maxlen=200)
+_call_timings_lock = threading.Lock()
+
+# 最初の断片を待っている間のタイムアウトとみなす例外
+_TIMEOUT_ERRORS = ("APITimeoutError", "ReadTimeout", "ConnectTimeout", "TimeoutException", "DeadlineExceeded")
+
+def record_call_timing(kind, provider, model, first_token_s, total_s, ok, censored=None):
+    """
+    プロバイダ呼び出し1回分の時間を記録
+    censored: 最初の断片が届く前に打ち切られた理由（"hedged_away" / "timed_out"）。
+        最初の断片までの時間は少なくとも total_s だったことになる
+    """
+    with _call_timings_lock:
+        _call_timings.append({
+            "kind": kind,
+            "provider": provider,
+            "model": model,
+            "first_token_s": first_token_s,
+            "total_s": total_s,
+            "ok": ok,
+            "censored": censored,
+            "at": time.time(),
+        })
+
+def recent_call_timings():
+    """直近のプロバイダ呼び出し時間の一覧"""
+    with _call_timings_lock:
+        return list(_call_timings)
+
+def timed_stream(kind, provider, model, chunks, hedged_away=None):
+    """
+    テキスト断片をそのまま流しつつ、最初の断片までの時間と全体の時間を記録
+    最初の断片の前にタイムアウトした、または hedged_away（threading.Event）が立って打ち切られた場合は、
+    打ち切りまでの時間を打ち切られた記録として残す（遅い呼び出しが集計から漏れないように）
+    """
+    start = time.perf_counter()
+    first_token_s = None
+    ok = False
+    censored = None
+    try:
+        for chunk in chunks:
+            if first_token_s is None:
+                first_token_s = time.perf_counter() - start
+            yield chunk
+        ok = True
+    except Exception as e:
+        if first_token_s is None and (isinstance(e, TimeoutError) or type(e).__name__ in _TIMEOUT_ERRORS):
+            censored = "timed_out"
+        raise
+    finally:
+        if first_token_s is None and not ok and hedged_away is not None and hedged_away.is_set():
+            censored = "hedged_away"
+        record_call_timing(kind, provider.name, model, first_token_s, time.perf_counter() - start, ok, censored)
+
+# プロバイダ・モデルごとのトークン使用量の累計（入力のうちキャッシュから読まれた分を含む）
+_token_usage = defaultdict(lambda: {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0})
+_token_usage_lock = threading.Lock()
+
+def record_token_usage(provider, model, prompt_tokens, cached_tokens, output_tokens):
+    """応答の使用量（usage）を記録"""
+    with _token_usage_lock:
+        usage = _token_usage[f"{provider}:{model}"]
+        usage["requests"] += 1
+        usage["prompt_tokens"] += prompt_tokens or 0
+        usage["cached_tokens"] += cached_tokens or 0
+        usage["output_tokens"] += output_tokens or 0
+
+def token_usage_stats():
+    """プロバイダ・モデルごとのトークン使用量と、入力のうちキャッシュから読まれた割合"""
+    with _token_usage_lock:
+        stats = {key: dict(usage) for key, usage in _token_usage.items()}
+    for usage in stats.values():
+        usage["cached_ratio"] = usage["cached_tokens"] / usage["prompt_tokens"] if usage["prompt_tokens"] else 0.0
+    return stats
+
+def percentile(values, q):
+    """値の q パーセンタイル（最近傍順位法、空なら None）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def call_latencies(kind, model, field="total_s", since=None, censored_as=None):
+    """
+    指定の種類・モデルで成功した直近の呼び出し時間の一覧（since: この時刻以降の記録のみ）
+    censored_as: 打ち切られた記録（ヘッジで採用されなかった・タイムアウト）の扱い
+        None: 含めない / "elapsed": 打ち切りまでの時間（下限）として含める / 数値: その値として含める
+    """
+    kinds = (kind,) if isinstance(kind, str) else tuple(kind)
+    samples = []
+    for t in recent_call_timings():
+        if t["kind"] not in kinds or t["model"] != model or (since is not None and t["at"] < since):
+            continue
+        if t["ok"] and t[field] is not None:
+            samples.append(t[field])
+        elif t.get("censored") and censored_as is not None:
+            samples.append(t["total_s"] if censored_as == "elapsed" else censored_as)
+    return samples
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+チャットの文脈（システムプロンプト・参考資料・会話履歴・新しい質問）をモデルごとのトークン予算に収める
+
+優先順位の高い順に予算を割り当てる：
+1. システムプロンプトと新しい質問（必ず送る。質問が長すぎる場合のみ切り詰める）
+2. 参考資料（OCR結果）
+   - 短い資料：全文をシステムプロンプトに付ける。量は予算だけで決まり、会話の長さによって変えない
+   - 長い資料（RETRIEVAL_MIN_TOKENS 超）：検索インデックスで質問に関係する部分だけを選び、質問と一緒に送る
+   - ただしコンテキストキャッシュを使える Gemini のモデルで、キャッシュできる長さ（GEMINI_CACHE_MIN_TOKENS 以上）の
+     資料は、大きい予算（CACHED_CONTEXT_BUDGETS）でシステムプロンプトに付ける（サーバー側に保存され、毎回処理し直さない）
+3. 会話履歴（新しい往復から順に、往復単位で）
+
+システムプロンプト（＋短い参考資料）と会話履歴は毎回バイト単位で同じ先頭部分になるようにし、
+プロバイダ側のプロンプトキャッシュ（OpenAIの自動キャッシュ・Geminiのコンテキストキャッシュ）を効かせる。
+質問ごとに変わる抜粋は最後の質問に入れるため、先頭部分を崩さない。
+会話履歴は1つの文字列にまとめず、プロバイダのネイティブな複数ターンのメッセージとして送る
+"""
+from collections import namedtuple
+
+from prompts import get_prompt
+from providers import GEMINI_CACHE_MIN_TOKENS
+from token_counter import count_tokens, truncate_to_tokens
+
+# モデルごとの入力トークンの予算（コンテキスト長ではなく、1回の質問で送る量の上限）
+CONTEXT_BUDGETS = {
+    "gpt-4o": 16_000,
+    "gpt-4o-mini": 16_000,
+    "gemini-1.5-pro-latest": 32_000,
+    "gemini-1.5-flash-latest": 32_000,
+}
+# コンテキストキャッシュに置ける長い参考資料の予算（キャッシュ分は割安で、毎回処理し直さない）
+CACHED_CONTEXT_BUDGETS = {
+    "gemini-1.5-pro-latest": 128_000,
+    "gemini-1.5-flash-latest": 128_000,
+}
+DEFAULT_CONTEXT_BUDGET = 8_000
+CHAT_MAX_TOKENS = 3000              # 出力の上限
+CONVERSATION_RESERVE_TOKENS = 4_000 # 参考資料に使わず、会話履歴と質問に残す量
+RETRIEVAL_MIN_TOKENS = 4_000        # これより長い参考資料は全文を送らず、関係する部分だけを送る
+RETRIEVAL_BUDGET_TOKENS = 3_000     # 抜粋の量（資料が長くなっても一定）
+MESSAGE_OVERHEAD_TOKENS = 4         # メッセージ1件ごとの役割・区切りの分
+TRUNCATED_MARKER = "\n（以下省略）"
+
+ChatContext = namedtuple("ChatContext", ["system_prompt", "history", "question", "report"])
+
+def _turns(messages):
+    """履歴を往復（質問と、それに続く回答）単位に分ける（質問のない回答・回答のない質問は捨てる）"""
+    turns = []
+    for message in messages:
+        if message["role"] == "user":
+            if turns and turns[-1][-1]["role"] == "user":
+                turns.pop()
+            turns.append([message])
+        elif turns:
+            turns[-1].append(message)
+    if turns and turns[-1][-1]["role"] == "user":
+        turns.pop()
+    return turns
+
+def _merge_roles(messages):
+    """同じ役割が続くメッセージを1件にまとめる（Geminiは役割が交互である必要がある）"""
+    merged = []
+    for message in messages:
+        if merged and merged[-1]["role"] == message["role"]:
+            merged[-1] = {"role": message["role"], "content": merged[-1]["content"] + "\n\n" + message["content"]}
+        else:
+            merged.append({"role": message["role"], "content": message["content"]})
+    return merged
+
+def _message_tokens(message):
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+def _system_prompt(reference):
+    # 会話によって変わる内容（日時・回数など）を含めないこと（先頭部分が変わるとキャッシュされない）
+    return get_prompt("chat_system") + (f"\n\n参考資料:\n{reference}" if reference else "")
+
+def _uses_context_cache(model, reference_tokens):
+    return model in CACHED_CONTEXT_BUDGETS and reference_tokens >= GEMINI_CACHE_MIN_TOKENS
+
+def build_chat_context(chat_messages, latex_code, model, max_tokens=CHAT_MAX_TOKENS, reference_index=None):
+    """
+    chat_messages（最後が新しい質問）と参考資料を、モデルの予算に収まる文脈にする
+    reference_index（latex_code で update 済みの ReferenceIndex）があれば、長い資料は関係する部分だけを送る
+    （コンテキストキャッシュに置ける場合を除く）
+    戻り値の report は送るトークン数の内訳と、省略した内容
+    """
+    messages = [m for m in chat_messages if m.get("content") and m["role"] in ("user", "assistant")]
+    question = messages[-1]["content"] if messages and messages[-1]["role"] == "user" else ""
+    history = messages[:-1] if question else messages
+    reference = latex_code or ""
+    reference_tokens = count_tokens(reference)
+    cached = _uses_context_cache(model, reference_tokens)
+    budget = CACHED_CONTEXT_BUDGETS[model] if cached else CONTEXT_BUDGETS.get(model, DEFAULT_CONTEXT_BUDGET)
+    retrieved_chunks = None
+
+    # 1. システムプロンプトと新しい質問
+    base_tokens = count_tokens(_system_prompt("")) + MESSAGE_OVERHEAD_TOKENS * 2
+    question_tokens = count_tokens(question)
+    if base_tokens + question_tokens > budget:
+        question = truncate_to_tokens(question, budget - base_tokens, TRUNCATED_MARKER)
+        question_tokens = count_tokens(question)
+    remaining = budget - base_tokens - question_tokens
+
+    # 2. 参考資料
+    reference_budget = max(0, budget - base_tokens - CONVERSATION_RESERVE_TOKENS)
+    if reference_index is not None and reference_tokens > RETRIEVAL_MIN_TOKENS and not cached:
+        # 長い資料：質問に関係する部分だけを、質問と一緒に送る（資料が長くなっても量は一定）
+        excerpt_budget = max(0, min(RETRIEVAL_BUDGET_TOKENS, reference_budget, remaining))
+        reference, retrieved_chunks = reference_index.retrieve(question, excerpt_budget)
+        if not reference:
+            # 質問と共通する語がない場合は資料の冒頭を送る
+            reference = truncate_to_tokens(latex_code, excerpt_budget, TRUNCATED_MARKER)
+        reference_truncated = True
+        system_prompt = _system_prompt("")
+        question = get_prompt("chat_reference_excerpt", excerpt=reference, question=question)
+        question_tokens = count_tokens(question)
+    else:
+        # 短い資料：全文（量は予算だけで決まるため、同じ資料なら毎回同じ先頭部分になる）
+        if reference_budget > remaining:
+            # 質問が会話用の枠より長い場合のみ、この回だけ短くする
+            reference_budget = max(remaining, 0)
+        reference_truncated = reference_tokens > reference_budget
+        if reference_truncated:
+            reference = truncate_to_tokens(reference, reference_budget, TRUNCATED_MARKER)
+        system_prompt = _system_prompt(reference)
+    system_tokens = count_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    remaining = budget - system_tokens - question_tokens - MESSAGE_OVERHEAD_TOKENS
+
+    # 3. 会話履歴（新しい往復から）
+    kept_turns = []
+    turns = _turns(history)
+    for turn in reversed(turns):
+        tokens = sum(_message_tokens(m) for m in turn)
+        if tokens > remaining:
+            break
+        kept_turns.insert(0, turn)
+        remaining -= tokens
+    history_messages = _merge_roles([m for turn in kept_turns for m in turn])
+    history_tokens = sum(_message_tokens(m) for m in history_messages)
+
+    reference_sent = count_tokens(reference)
+    report = {
+        "budget": budget,
+        "system": system_tokens - (0 if retrieved_chunks is not None else reference_sent),
+        "reference": reference_sent,
+        "reference_total": reference_tokens,
+        "retrieved_chunks": None if retrieved_chunks is None else len(retrieved_chunks),
+        "history": history_tokens,
+        "question": question_tokens + MESSAGE_OVERHEAD_TOKENS - (reference_sent if retrieved_chunks is not None else 0),
+        "total": system_tokens + history_tokens + question_tokens + MESSAGE_OVERHEAD_TOKENS,
+        "prefix": system_tokens,        # 毎回同じ先頭部分（キャッシュの対象）
+        "max_output": max_tokens,
+        "turns_sent": len(kept_turns),
+        "turns_dropped": len(turns) - len(kept_turns),
+        "reference_truncated": reference_truncated,
+        "context_cached": cached,       # 参考資料を Gemini のコンテキストキャッシュに置く
+    }
+    return ChatContext(system_prompt, history_messages, question, report)
+
+def summarize_context_report(report):
+    """送ったトークン数の表示用の要約"""
+    text = (
+        f"送信 {report['total']:,} / {report['budget']:,} トークン"
+        f"（参考資料 {report['reference']:,}・履歴 {report['history']:,}・質問 {report['question']:,}）"
+    )
+    omitted = []
+    if report["turns_dropped"]:
+        omitted.append(f"古い会話 {report['turns_dropped']}往復")
+    if report["retrieved_chunks"] is not None:
+        omitted.append(f"参考資料のうち質問に関係しない部分（{report['retrieved_chunks']}箇所を送信）")
+    elif report["reference_truncated"]:
+        omitted.append("参考資料の後半")
+    if omitted:
+        text += f" 省略: {'、'.join(omitted)}"
+    return text
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+プロバイダ間のヘッジ・フェイルオーバー（OpenAI ⇔ Gemini）
+
+- 主モデルが期限（直近の最初の断片までの時間のパーセンタイル）までに応答しなければ、
+  もう一方のプロバイダにも同じリクエストを送り、先に最初の断片を返した方を採用する
+- 主モデルが 429 / 5xx / 接続エラーで失敗した場合は期限を待たずに切り替える
+- 採用されなかった側は、最初の断片を待っている間でも応答を閉じて打ち切る
+
+プロバイダは provider_for（モデル名 → Provider）で差し替えられるため、ローカルの偽プロバイダで試験できる
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from call_metrics import call_latencies, percentile, timed_stream
+from providers import get_provider
+from rate_limiter import RateLimitTimeout, estimate_request_tokens, get_rate_limiter, retry_after_seconds
+from resilience import error_status_code, get_breaker, is_retryable, retry_stream
+from scheduler import current_caller, get_scheduler
+
+# 主モデル → 切り替え先のモデル（別プロバイダの同程度の性能のモデル）
+FAILOVER_MODELS = {
+    "gpt-4o": "gemini-1.5-pro-latest",
+    "gpt-4o-mini": "gemini-1.5-flash-latest",
+    "gemini-1.5-pro-latest": "gpt-4o",
+    "gemini-1.5-flash-latest": "gpt-4o-mini",
+}
+
+# ヘッジの期限：直近の「最初の断片までの時間」の何パーセンタイルを待つか
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 10      # これより記録が少ない間は既定の期限を使う
+HEDGE_MIN_DELAY_S = 1.0
+HEDGE_DEFAULT_DELAYS = {    # 秒
+    "chat": 8.0,
+    "ocr_page": 20.0,
+    "ocr_region": 10.0,     # 切り出した1領域（出力は OCR_REGION_MAX_TOKENS まで）
+    "ocr_document": 40.0,
+}
+PROVIDER_RETRY_ATTEMPTS = 2  # 切り替え先があるため、同じプロバイダへの再試行は少なくする
+
+logger = logging.getLogger(__name__)
+
+_CHUNK, _DONE, _ERROR = "chunk", "done", "error"
+
+def _is_provider_retryable(error):
+    # 429 は同じプロバイダへ再試行せず、送信を止めて別プロバイダへ切り替える
+    return is_retryable(error) and error_status_code(error) != 429
+
+def is_failover_error(error):
+    """別プロバイダへ即座に切り替えるべきエラーか（429・5xx・接続断・タイムアウト）"""
+    status = error_status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return (
+        isinstance(error, (TimeoutError, ConnectionError))
+        or type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+    )
+
+def hedge_delay(kind, model):
+    """ヘッジを送るまでの待ち時間（秒）"""
+    # ヘッジで打ち切られた・タイムアウトした呼び出しも、打ち切りまでの時間（下限）として含める
+    samples = call_latencies(kind, model, field="first_token_s", censored_as="elapsed")
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAYS.get(kind, HEDGE_DEFAULT_DELAYS["chat"])
+    return max(HEDGE_MIN_DELAY_S, percentile(samples, HEDGE_PERCENTILE))
+
+# ヘッジ・フェイルオーバーの集計（プロセス全体）
+_stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "failovers": 0}
+_first_token_samples = deque(maxlen=200)
+_stats_lock = threading.Lock()
+
+def _record(first_token_s, hedged, hedge_won, failed_over):
+    with _stats_lock:
+        _stats["calls"] += 1
+        _stats["hedged"] += hedged
+        _stats["hedge_wins"] += hedge_won
+        _stats["failovers"] += failed_over
+        if first_token_s is not None:
+            _first_token_samples.append(first_token_s)
+
+def failover_stats():
+    """ヘッジ回数・切り替え回数と、利用者から見た最初の断片までの時間のパーセンタイル"""
+    with _stats_lock:
+        stats = dict(_stats)
+        samples = list(_first_token_samples)
+    for q in (50, 95, 99):
+        stats[f"first_token_p{q}_s"] = percentile(samples, q)
+    return stats
+
+class _Attempt:
+    def __init__(self, model, provider):
+        self.model = model
+        self.provider = provider
+        self.cancelled = threading.Event()
+        self.hedged_away = threading.Event()   # 最初の断片の前にヘッジ先に負けた
+        self.finished = False
+        self._closers = []
+        self._lock = threading.Lock()
+
+    def on_open(self, close):
+        """プロバイダが応答を開いたら呼ぶ（打ち切り済みならすぐ閉じる）"""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._closers.append(close)
+                return
+        close()
+
+    def cancel(self):
+        """
+        試行を打ち切る。最初の断片を待っている間も応答を閉じ、
+        読み取り中のスレッドを止めて接続と実行枠をすぐ返す
+        """
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            closers, self._closers = self._closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception as e:
+                logger.debug("closing cancelled %s stream failed: %s", self.model, e)
+
+class HedgedStream:
+    """
+    ヘッジ・フェイルオーバー付きのテキスト断片ストリーム
+    反復し始めてから最初の断片が届いた時点で応答するモデルが確定し、model 属性に入る
+    fallback_request は切り替え先のモデルに送る (system_prompt, user_text, history)
+    （主モデルの予算で作った文脈が、切り替え先のトークン予算・コンテキスト長に収まらない場合に使う）
+    """
+
+    def __init__(self, kind, model, system_prompt, user_text, images=(), max_tokens=3000,
+                 fallback_model=None, provider_for=get_provider, delay=None, limiter=None, on_queue=None,
+                 scheduler=None, history=(), fallback_request=None):
+        self.kind = kind
+        self.requested_model = model
+        self.model = model
+        self.fallback_model = FAILOVER_MODELS.get(model) if fallback_model is None else fallback_model
+        self.provider_for = provider_for
+        self.request = (system_prompt, user_text, images, max_tokens, history)
+        self.fallback_request = self.request
+        if fallback_request is not None:
+            fallback_prompt, fallback_text, fallback_history = fallback_request
+            self.fallback_request = (fallback_prompt, fallback_text, images, max_tokens, fallback_history)
+        self.delay = hedge_delay(kind, model) if delay is None else delay
+        self.limiter = limiter or get_rate_limiter()
+        self.on_queue = on_queue
+        self.scheduler = scheduler or get_scheduler()
+        # 試行は別スレッドで動くため、呼び出し元（プラン・利用者）をここで取り出しておく
+        self.caller = current_caller()
+        self.hedged = False
+        self.failed_over = False
+        self._events = queue.Queue()
+
+    @property
+    def degraded(self):
+        """指定と別のモデルが応答したか"""
+        return self.model != self.requested_model
+
+    def __iter__(self):
+        return self._run()
+
+    def _start(self, model, request):
+        attempt = _Attempt(model, self.provider_for(model))
+        threading.Thread(target=self._pump, args=(attempt, request), daemon=True).start()
+        return attempt
+
+    def _pump(self, attempt, request):
+        """別スレッドで実行枠・送信枠を確保してからストリームを読み、断片・完了・例外をキューへ送る"""
+        provider = attempt.provider
+        tokens = estimate_request_tokens(*request)
+        chunks = timed_stream(self.kind, provider, attempt.model, retry_stream(
+            provider.name, lambda: provider.stream(attempt.model, *request, on_open=attempt.on_open),
+            attempts=PROVIDER_RETRY_ATTEMPTS,
+            # 打ち切りで閉じた応答のエラーは再試行しない
+            retryable=lambda e: not attempt.cancelled.is_set() and _is_provider_retryable(e),
+        ), hedged_away=attempt.hedged_away)
+        try:
+            # 遮断中のプロバイダは順番を待たずに失敗させ、すぐ切り替える
+            get_breaker(provider.name).check()
+            with self.scheduler.slot(attempt.model, *self.caller, cancelled=attempt.cancelled) as ticket:
+                if ticket is None:
+                    return
+                # 打ち切られた試行は送信枠（RPM・TPM）を取らずに順番を譲る
+                if not self.limiter.acquire(attempt.provider.name, attempt.model, tokens, self.on_queue,
+                                            cancelled=attempt.cancelled):
+                    return
+                if attempt.cancelled.is_set():
+                    return
+                for chunk in chunks:
+                    if attempt.cancelled.is_set():
+                        return
+                    self._events.put((attempt, _CHUNK, chunk))
+                self._events.put((attempt, _DONE, None))
+        except Exception as e:
+            if attempt.cancelled.is_set():
+                # 打ち切りで応答を閉じたことによるエラー
+                return
+            # 送信前に諦めた場合（RateLimitTimeout）はプロバイダから 429 を受けていないので止めない
+            if error_status_code(e) == 429 and not isinstance(e, RateLimitTimeout):
+                self.limiter.penalize(attempt.provider.name, attempt.model, retry_after_seconds(e))
+            self._events.put((attempt, _ERROR, e))
+        finally:
+            # 打ち切られた側もここで接続を閉じる
+            chunks.close()
+
+    def _run(self):
+        start = time.perf_counter()
+        primary = self._start(self.model, self.request)
+        attempts = [primary]
+        errors = []
+        deadline = start + self.delay if self.fallback_model else None
+
+        try:
+            # 最初の断片（または空の完了）を返した試行を採用する
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+                try:
+                    attempt, event, payload = self._events.get(timeout=timeout)
+                except queue.Empty:
+                    deadline = None
+                    self.hedged = True
+                    attempts.append(self._start(self.fallback_model, self.fallback_request))
+                    logger.info("%s: no response from %s after %.1fs, hedging to %s",
+                                self.kind, self.model, self.delay, self.fallback_model)
+                    continue
+
+                if event != _ERROR:
+                    break
+
+                attempt.finished = True
+                errors.append(payload)
+                if len(attempts) == 1 and self.fallback_model and is_failover_error(payload):
+                    deadline = None
+                    self.failed_over = True
+                    attempts.append(self._start(self.fallback_model, self.fallback_request))
+                    logger.warning("%s: %s failed (%s), failing over to %s",
+                                   self.kind, self.model, type(payload).__name__, self.fallback_model)
+                    continue
+                if all(a.finished for a in attempts):
+                    raise errors[0]
+
+            winner = attempt
+            self.model = winner.model
+            first_token_s = time.perf_counter() - start
+            if self.hedged and winner is not primary:
+                # 期限までに応答しなかった主モデルは、遅い呼び出しとして記録させる
+                primary.hedged_away.set()
+            for other in attempts:
+                if other is not winner:
+                    other.cancel()
+
+            hedge_won = self.hedged and winner is not primary
+            if hedge_won:
+                logger.info("%s: hedge to %s won, first token at %.1fs (%s silent for at least %.1fs)",
+                            self.kind, winner.model, first_token_s, primary.model, first_token_s)
+            _record(first_token_s if event == _CHUNK else None, self.hedged, hedge_won, self.failed_over)
+
+            # 採用した試行の残りを流す
+            while event != _DONE:
+                if event == _ERROR:
+                    raise payload
+                yield payload
+                attempt, event, payload = self._events.get()
+                while attempt is not winner:
+                    attempt, event, payload = self._events.get()
+        finally:
+            # 途中で読むのをやめた場合も含め、全ての試行を打ち切る
+            for attempt in attempts:
+                attempt.cancel()
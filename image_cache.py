@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import threading
+import zlib
+from collections import OrderedDict
+
+from PIL import Image
+
+# キャッシュ容量（圧縮後のバイト数で管理）
+SESSION_BYTE_BUDGET = 64 * 1024 * 1024    # 1セッションあたり 64MB
+GLOBAL_BYTE_BUDGET = 512 * 1024 * 1024    # プロセス全体で 512MB
+# 前処理結果はグレースケール中心で圧縮が効くため、速度重視のレベルで十分
+COMPRESSION_LEVEL = 1
+
+def make_cache_key(data, params):
+    """アップロード画像のバイト列ハッシュと前処理パラメータからキャッシュキーを生成"""
+    digest = hashlib.sha256(data).hexdigest()
+    params_repr = json.dumps(params, sort_keys=True, default=str)
+    return f"{digest}:{params_repr}"
+
+class PreprocessCache:
+    """前処理済み画像のLRUキャッシュ（セッション別・全体のバイト上限付き）"""
+
+    def __init__(self, session_budget=SESSION_BYTE_BUDGET, global_budget=GLOBAL_BYTE_BUDGET):
+        self.session_budget = session_budget
+        self.global_budget = global_budget
+        self._lock = threading.Lock()
+        # (session_id, key) -> (mode, size, 圧縮済みピクセル列, info)。末尾ほど最近使用
+        self._entries = OrderedDict()
+        self._session_bytes = {}
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, session_id, key):
+        """キャッシュから前処理済み画像を取得（なければ None）"""
+        entry_key = (session_id, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(entry_key)
+            self._hits += 1
+
+        # 展開はロック外で行う
+        mode, size, payload, info = entry
+        image = Image.frombytes(mode, size, zlib.decompress(payload))
+        # 切り抜き・傾き補正の結果（crop_report）などのメタデータも戻す
+        image.info.update(info)
+        return image
+
+    def put(self, session_id, key, image):
+        """前処理済み画像を圧縮して保存し、上限を超えた分をLRUで追い出す"""
+        payload = zlib.compress(image.tobytes(), COMPRESSION_LEVEL)
+        entry_size = len(payload)
+
+        # 単体でセッション上限を超える画像は保存しない
+        if entry_size > self.session_budget or entry_size > self.global_budget:
+            return
+
+        entry_key = (session_id, key)
+        with self._lock:
+            if entry_key in self._entries:
+                self._remove(entry_key)
+
+            self._entries[entry_key] = (image.mode, image.size, payload, dict(image.info))
+            self._session_bytes[session_id] = self._session_bytes.get(session_id, 0) + entry_size
+            self._total_bytes += entry_size
+
+            # 1. セッション上限：同一セッション内の古いものから追い出す
+            while self._session_bytes.get(session_id, 0) > self.session_budget:
+                oldest = next(k for k in self._entries if k[0] == session_id)
+                self._remove(oldest)
+                self._evictions += 1
+
+            # 2. 全体上限：全セッション横断で古いものから追い出す
+            while self._total_bytes > self.global_budget:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def _remove(self, entry_key):
+        """エントリを削除してバイト数を更新（ロック取得済みで呼ぶこと）"""
+        _, _, payload, _ = self._entries.pop(entry_key)
+        session_id = entry_key[0]
+        remaining = self._session_bytes.get(session_id, 0) - len(payload)
+        if remaining > 0:
+            self._session_bytes[session_id] = remaining
+        else:
+            self._session_bytes.pop(session_id, None)
+        self._total_bytes -= len(payload)
+
+    def stats(self, session_id=None):
+        """ヒット・ミス数と使用バイト数を返す"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            result = {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "entries": len(self._entries),
+                "total_bytes": self._total_bytes,
+            }
+            if session_id is not None:
+                result["session_bytes"] = self._session_bytes.get(session_id, 0)
+            return result
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import io
+
+import cv2
+import numpy as np
+from PIL import Image, features
+
+# 非可逆形式の品質下限（これ未満には下げない）
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+WEBP_METHOD = 2             # 4 以上はサイズがほぼ同じで、エンコードが倍近く遅い
+PNG_COMPRESS_LEVEL = 6      # 9 にしてもほとんど小さくならず、時間だけ掛かる
+# 二値化済みとみなす条件（ほぼ白かほぼ黒の画素の割合）
+BILEVEL_PIXEL_RATIO = 0.97
+# OCR忠実度ガード：二値化したインク領域の不一致率の上限
+MAX_INK_MISMATCH = 0.03
+# 1画素あたりのビット数がこれ以下の候補が見つかれば、残りの（重い）候補は試さない
+TARGET_BITS_PER_PIXEL = 1.5
+# 1枚あたりに試す候補の数（登録順に、適用条件を満たすもののみ。どれも使えなければ通常のPNG）
+MAX_CANDIDATES = 2
+
+# 登録済みエンコーダ: (名前, 関数, 非可逆かどうか, 適用条件)
+# 登録順に試すため、エンコードが軽いものから登録する
+ENCODERS = []
+
+def register_encoder(name, lossy=False, applies=None):
+    """エンコーダを登録するデコレータ（関数は PIL Image → (バイト列, MIMEタイプ)）"""
+    def decorator(func):
+        ENCODERS.append((name, func, lossy, applies or (lambda image, info: True)))
+        return func
+    return decorator
+
+def _is_grayscale(image):
+    return image.mode in ('L', '1')
+
+def _is_bilevel(image, info):
+    if not _is_grayscale(image):
+        return False
+    return info["extreme_ratio"] >= BILEVEL_PIXEL_RATIO
+
+@register_encoder("png_bilevel", lossy=True, applies=_is_bilevel)
+def encode_png_bilevel(image):
+    """二値化済みページ用の1bit PNG"""
+    bilevel = image.convert('L').point(lambda v: 255 if v >= 128 else 0).convert('1', dither=Image.Dither.NONE)
+    buffer = io.BytesIO()
+    bilevel.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue(), "image/png"
+
+@register_encoder("jpeg", lossy=True)
+def encode_jpeg(image):
+    """JPEG（品質下限つき）"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), "image/jpeg"
+
+@register_encoder("webp", lossy=True, applies=lambda image, info: features.check('webp'))
+def encode_webp(image):
+    """WebP（品質下限つき）"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='WEBP', quality=WEBP_QUALITY, method=WEBP_METHOD)
+    return buffer.getvalue(), "image/webp"
+
+@register_encoder("png")
+def encode_png(image):
+    """PNG（グレースケールは1チャンネルのまま）"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue(), "image/png"
+
+@register_encoder("png_palette", lossy=True, applies=lambda image, info: _is_grayscale(image))
+def encode_png_palette(image):
+    """16階調パレットPNG（4bit）"""
+    palette_image = image.convert('L').quantize(colors=16, dither=Image.Dither.NONE)
+    buffer = io.BytesIO()
+    palette_image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL, bits=4)
+    return buffer.getvalue(), "image/png"
+
+def _ink_mask(gray):
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return mask > 0
+
+def _passes_fidelity_guard(reference_mask, data):
+    """エンコード結果を復号し、二値化したインク領域が元画像とほぼ一致するか確認"""
+    decoded = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if decoded is None or decoded.shape != reference_mask.shape:
+        return False
+    ink_pixels = max(int(np.count_nonzero(reference_mask)), 1)
+    mismatch = np.count_nonzero(reference_mask ^ _ink_mask(decoded)) / ink_pixels
+    return mismatch <= MAX_INK_MISMATCH
+
+def encode_image(image):
+    """
+    画像ごとに登録済みエンコーダを軽いものから試し、忠実度ガードを満たす中で最小のものを選ぶ
+    TARGET_BITS_PER_PIXEL 以下の候補が見つかればそこで打ち切り、候補は MAX_CANDIDATES 個まで試す
+    戻り値: {"data", "mime_type", "format", "bytes", "raw_bytes", "candidates"}
+    """
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+
+    gray = np.asarray(image.convert('L'))
+    info = {"extreme_ratio": float(np.count_nonzero((gray <= 32) | (gray >= 223))) / gray.size}
+    reference_mask = _ink_mask(gray)
+    target_bytes = gray.size * TARGET_BITS_PER_PIXEL / 8
+
+    best = None
+    candidates = {}
+    for name, func, lossy, applies in ENCODERS:
+        if best is not None and best["bytes"] <= target_bytes:
+            break
+        if len(candidates) >= MAX_CANDIDATES:
+            break
+        if not applies(image, info):
+            continue
+        try:
+            data, mime_type = func(image)
+        except (OSError, ValueError):
+            # このビルドのPillowで未対応の形式などは候補から外す
+            continue
+        candidates[name] = len(data)
+        if best is not None and len(data) >= best["bytes"]:
+            continue
+        if lossy and not _passes_fidelity_guard(reference_mask, data):
+            continue
+        best = {"data": data, "mime_type": mime_type, "format": name, "bytes": len(data)}
+
+    if best is None:
+        # どの候補も使えなかった場合は通常のPNG
+        data, mime_type = encode_png(image)
+        best = {"data": data, "mime_type": mime_type, "format": "png", "bytes": len(data)}
+    best["raw_bytes"] = gray.size * len(image.getbands())
+    best["candidates"] = candidates
+    return best
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# 前処理用プロセスプールの上限（環境変数で調整可能）
+MAX_PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", min(4, os.cpu_count() or 1)))
+
+# 画像前処理パラメータ（キャッシュキーにも含める）
+PREPROCESS_PARAMS = {
+    "clip_limit": 1.3,
+    "tile_grid_size": (8, 8),
+    "auto_crop": False,
+}
+
+# 本文領域検出・傾き補正の設定
+CROP_ANALYSIS_SIDE = 1024   # 解析用の縮小サイズ
+CROP_MARGIN_RATIO = 0.02    # 検出した本文領域の周囲に残す余白
+MAX_SKEW_DEGREES = 15.0     # これより大きい傾きは誤検出とみなして補正しない
+MIN_SKEW_DEGREES = 0.3      # これ未満の傾きは補正しない
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def detect_text_region(gray):
+    """
+    本文領域の矩形（元画像の座標）と傾き（度）を推定
+    縮小したインクマスクを行単位の塊にまとめ、行らしい塊だけを使うことで手や背景を除外する
+    """
+    height, width = gray.shape
+    factor = min(1.0, CROP_ANALYSIS_SIDE / max(height, width))
+    small = gray
+    if factor < 1.0:
+        small = cv2.resize(gray, (int(width * factor), int(height * factor)), interpolation=cv2.INTER_AREA)
+    small_h, small_w = small.shape
+
+    # 文字を白とするマスク → 横長のカーネルで文字を行の塊にまとめる
+    mask = cv2.adaptiveThreshold(small, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+    lines = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 3)))
+
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(lines, connectivity=8)
+    comp_w = stats[1:, cv2.CC_STAT_WIDTH]
+    comp_h = stats[1:, cv2.CC_STAT_HEIGHT]
+    comp_area = stats[1:, cv2.CC_STAT_AREA]
+    # 行らしい塊：横長で、高さがページの一部、ある程度の面積がある
+    is_line = (comp_w >= comp_h * 2) & (comp_h <= small_h * 0.15) & (comp_area >= 30)
+    line_ids = np.flatnonzero(is_line) + 1
+    if line_ids.size == 0:
+        return None, 0.0
+
+    text_mask = np.isin(labels, line_ids)
+
+    # 射影プロファイルで本文領域の上下左右を求める
+    rows = np.flatnonzero(text_mask.any(axis=1))
+    cols = np.flatnonzero(text_mask.any(axis=0))
+    margin_y = int(small_h * CROP_MARGIN_RATIO)
+    margin_x = int(small_w * CROP_MARGIN_RATIO)
+    top = max(rows[0] - margin_y, 0)
+    bottom = min(rows[-1] + margin_y + 1, small_h)
+    left = max(cols[0] - margin_x, 0)
+    right = min(cols[-1] + margin_x + 1, small_w)
+    box = (int(left / factor), int(top / factor), int(right / factor), int(bottom / factor))
+
+    # 行ごとの minAreaRect の角度の中央値を傾きとする
+    angles = []
+    for line_id in line_ids:
+        x, y, w, h = stats[line_id, :4]
+        points = cv2.findNonZero((labels[y:y + h, x:x + w] == line_id).astype(np.uint8))
+        (_, _), (rect_w, rect_h), angle = cv2.minAreaRect(points)
+        if rect_w < rect_h:
+            angle -= 90
+        # [-45, 45) の範囲に正規化（OpenCV の版によって角度の範囲が異なるため、剰余で折り返す）
+        angle = (angle + 45) % 90 - 45
+        angles.append(angle)
+    skew = float(np.median(angles))
+    if abs(skew) > MAX_SKEW_DEGREES:
+        skew = 0.0
+
+    return box, skew
+
+def crop_and_deskew(gray):
+    """本文領域に切り抜き、傾きを補正する（戻り値: 画像, レポート）"""
+    start = time.perf_counter()
+    original_pixels = gray.size
+
+    box, skew = detect_text_region(gray)
+    if box is not None:
+        left, top, right, bottom = box
+        gray = gray[top:bottom, left:right]
+
+    if abs(skew) >= MIN_SKEW_DEGREES:
+        height, width = gray.shape
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), skew, 1.0)
+        # 回転で角が切れないようにキャンバスを広げる
+        cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+        new_w = int(height * sin + width * cos)
+        new_h = int(height * cos + width * sin)
+        matrix[0, 2] += new_w / 2 - width / 2
+        matrix[1, 2] += new_h / 2 - height / 2
+        gray = cv2.warpAffine(gray, matrix, (new_w, new_h), flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_REPLICATE)
+    else:
+        skew = 0.0
+
+    report = {
+        "crop_ratio": gray.size / original_pixels,
+        "skew_degrees": skew,
+        "elapsed_ms": (time.perf_counter() - start) * 1000,
+    }
+    return np.ascontiguousarray(gray), report
+
+def preprocess_image_data(data, clip_limit=1.3, tile_grid_size=(8, 8), auto_crop=False):
+    """
+    教科書画像の前処理：（本文領域の切り抜き・傾き補正）+ コントラスト強化 + 彩度削除
+    デコード時点で1チャンネルにし、CLAHEもその場で適用するため、8bitの画像1枚分しか確保しない
+    Streamlitに依存しないため、ワーカープロセスからも呼び出せる（エラーは例外として送出）
+    """
+    # 1. 彩度を削除（グレースケールで直接デコード、EXIFの回転情報も反映される）
+    gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("画像をデコードできませんでした")
+
+    # 2. 本文領域への切り抜きと傾き補正（CLAHEの対象画素も減る）
+    crop_report = None
+    if auto_crop:
+        gray, crop_report = crop_and_deskew(gray)
+
+    # 3. コントラスト強化（CLAHEをその場で適用）
+    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tuple(tile_grid_size))
+    clahe.apply(gray, dst=gray)
+
+    # 4. 1チャンネル（Lモード）のままPIL Imageに変換（配列のコピーなし）
+    processed_image = Image.fromarray(gray)
+    if crop_report is not None:
+        processed_image.info["crop_report"] = crop_report
+    return processed_image
+
+def _preprocess_worker(data, params):
+    """ワーカープロセス側の処理（例外は文字列にして返す）"""
+    try:
+        return preprocess_image_data(data, **params), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def get_preprocess_pool():
+    """プロセス全体で共有する前処理用プロセスプールを取得"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Streamlitサーバーはマルチスレッドのため、forkではなくspawnで起動する
+            _pool = ProcessPoolExecutor(
+                max_workers=MAX_PREPROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+def _reset_preprocess_pool():
+    """壊れたプロセスプールを破棄（次回呼び出し時に再生成）"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def preprocess_images_parallel(data_list, params):
+    """
+    複数画像をプロセスプールで並列に前処理
+    戻り値はアップロード順の (画像 or None, エラーメッセージ or None) のリスト
+    """
+    if not data_list:
+        return []
+
+    # 1枚だけならプロセス間通信のコストの方が大きいので直接処理する
+    if len(data_list) == 1 or MAX_PREPROCESS_WORKERS <= 1:
+        return [_preprocess_worker(data, params) for data in data_list]
+
+    try:
+        pool = get_preprocess_pool()
+        return list(pool.map(_preprocess_worker, data_list, [params] * len(data_list)))
+    except BrokenProcessPool:
+        # ワーカーが異常終了した場合はプールを作り直し、今回は逐次処理で続行
+        _reset_preprocess_pool()
+        return [_preprocess_worker(data, params) for data in data_list]
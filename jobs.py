@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+バックグラウンドジョブ（OCR・チャット・PDF生成）
+
+Streamlitのスクリプト実行スレッドでプロバイダを呼ぶと画面全体が止まり、
+再実行で呼び出しが途中で打ち切られるため、共有のワーカープールで実行する。
+ジョブIDをセッションに保存し、状態と途中結果をポーリングで取得する。
+ジョブ関数はワーカースレッドで動くため st.* を呼ばないこと（途中結果は job.append で渡す）
+登録した時点の contextvars（呼び出し元のプラン・利用者など）はジョブ関数へ引き継がれる
+"""
+import contextvars
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "16"))
+JOB_MAX_PENDING = 64                 # 実行待ち＋実行中の上限
+JOB_TTL_SECONDS = 30 * 60            # 完了後に保持する時間
+
+QUEUED, RUNNING, DONE, ERROR = "queued", "running", "done", "error"
+
+class JobQueueFull(Exception):
+    """実行待ちのジョブが多すぎる"""
+
+class Job:
+    """ジョブ1件の状態・途中結果・結果"""
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.first_chunk_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.meta = {}
+        self._chunks = []
+        self._lock = threading.Lock()
+
+    def append(self, chunk):
+        """途中結果（テキスト断片）を追加"""
+        with self._lock:
+            if self.first_chunk_at is None:
+                self.first_chunk_at = time.time()
+            self._chunks.append(chunk)
+
+    @property
+    def partial_text(self):
+        with self._lock:
+            return "".join(self._chunks)
+
+    @property
+    def finished(self):
+        return self.status in (DONE, ERROR)
+
+    @property
+    def first_chunk_s(self):
+        """実行開始から最初の途中結果までの秒数"""
+        if self.started_at is None or self.first_chunk_at is None:
+            return None
+        return self.first_chunk_at - self.started_at
+
+    @property
+    def elapsed_s(self):
+        """実行開始から完了（実行中は現在）までの秒数"""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+class JobManager:
+    """上限付きのワーカープールでジョブを実行し、完了後は TTL まで保持する"""
+
+    def __init__(self, max_workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, ttl=JOB_TTL_SECONDS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._jobs = {}
+        self._in_flight = {}    # リクエストの指紋 → 実行中のジョブID
+        self._coalesced = 0
+        self._lock = threading.Lock()
+
+    def submit(self, kind, func, *args, key=None, **kwargs):
+        """
+        ジョブを登録してIDを返す
+        func(job, *args, **kwargs) の戻り値が結果になる
+        key（リクエストの指紋）が同じジョブが実行中なら、新たに登録せずそのジョブのIDを返す
+        """
+        self.expire()
+        with self._lock:
+            if key is not None and key in self._in_flight:
+                self._coalesced += 1
+                return self._in_flight[key]
+            pending = sum(1 for j in self._jobs.values() if not j.finished)
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"実行待ちのジョブが上限（{self.max_pending}件）に達しています")
+            job = Job(kind)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._in_flight[key] = job.id
+        self._executor.submit(contextvars.copy_context().run, self._run, job, func, args, kwargs, key)
+        return job.id
+
+    def _run(self, job, func, args, kwargs, key):
+        job.started_at = time.time()
+        job.status = RUNNING
+        try:
+            job.result = func(job, *args, **kwargs)
+            status = DONE
+        except Exception as e:
+            job.error = e
+            status = ERROR
+        # 完了時刻を先に設定する（完了状態のジョブは必ず finished_at を持つ）
+        job.finished_at = time.time()
+        job.status = status
+        if key is not None:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def get(self, job_id):
+        """ジョブを取得（存在しない・期限切れなら None）"""
+        self.expire()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def expire(self):
+        """完了から TTL を過ぎたジョブを削除"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def stats(self):
+        """状態ごとのジョブ数と、実行中のジョブに統合したリクエスト数"""
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, ERROR: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            counts["coalesced"] = self._coalesced
+        return counts
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+ページのレイアウト解析：行単位の帯に分け、文章ブロックとディスプレイ数式に分類する
+
+前処理後（グレースケール・必要なら傾き補正済み）の画像を前提とし、1段組の読み順（上から下）で返す
+"""
+import cv2
+import numpy as np
+
+LINE_MIN_INK_RATIO = 0.002     # 行とみなす横一列のインク画素の割合
+LINE_MIN_HEIGHT = 3            # これより低い帯はノイズとして捨てる
+LINE_MERGE_GAP_RATIO = 0.1     # 行の高さに対してこれ未満の隙間は同じ行（添字・アクセントなど）
+LINE_THIN_RATIO = 0.4          # 行の高さに対してこれより低い帯（分数の横線など）は上下の行とつなげる
+BLOCK_GAP_RATIO = 1.5          # 同じ種類の行をまとめる隙間の上限
+DISPLAY_HEIGHT_RATIO = 1.8     # 行の高さの中央値に対してこれ以上高い行は数式とみなす
+CENTER_INDENT_RATIO = 0.1      # 左右の余白がどちらも本文幅のこの割合以上なら中央寄せ
+CENTER_BALANCE_RATIO = 0.1     # 左右の余白の差の許容量（本文幅に対する割合）
+REGION_PADDING_RATIO = 0.3     # 領域の周囲に残す余白（行の高さに対する割合）
+LAYOUT_MAX_REGIONS = 24        # これより多く分かれる場合は分割しない
+
+def _ink_mask(gray):
+    block = max(15, (min(gray.shape) // 40) | 1)
+    mask = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, block, 15)
+    return cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+
+def _line_bands(mask):
+    """横方向の射影プロファイルから行の帯 [上端, 下端) を求める"""
+    height, width = mask.shape
+    has_ink = np.count_nonzero(mask, axis=1) > max(2, width * LINE_MIN_INK_RATIO)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], has_ink.astype(np.int8), [0]))))
+    bands = [(int(top), int(bottom)) for top, bottom in zip(edges[::2], edges[1::2])
+             if bottom - top >= LINE_MIN_HEIGHT]
+    if not bands:
+        return [], 0
+
+    # 分数の分子・横線・分母や添字などで分かれた帯を1行にまとめる
+    heights = [bottom - top for top, bottom in bands]
+    line_height = float(np.median(heights))
+    thin = [height < line_height * LINE_THIN_RATIO for height in heights]
+    merged = [list(bands[0])]
+    for k in range(1, len(bands)):
+        top, bottom = bands[k]
+        gap = top - merged[-1][1]
+        touches_thin = thin[k] or thin[k - 1]
+        if gap < line_height * LINE_MERGE_GAP_RATIO or (touches_thin and gap < line_height):
+            merged[-1][1] = bottom
+        else:
+            merged.append([top, bottom])
+    return [tuple(band) for band in merged], line_height
+
+def _classify_lines(mask, bands, line_height):
+    """各行を "prose" / "formula" に分類（左右の範囲つき）"""
+    extents = []
+    for top, bottom in bands:
+        cols = np.flatnonzero(mask[top:bottom].any(axis=0))
+        extents.append((int(cols[0]), int(cols[-1]) + 1))
+    text_left = min(left for left, _ in extents)
+    text_right = max(right for _, right in extents)
+    text_width = max(text_right - text_left, 1)
+
+    lines = []
+    for (top, bottom), (left, right) in zip(bands, extents):
+        left_margin = left - text_left
+        right_margin = text_right - right
+        centered = (
+            left_margin >= text_width * CENTER_INDENT_RATIO
+            and right_margin >= text_width * CENTER_INDENT_RATIO
+            and abs(left_margin - right_margin) <= text_width * CENTER_BALANCE_RATIO
+        )
+        tall = bottom - top >= line_height * DISPLAY_HEIGHT_RATIO
+        kind = "formula" if centered or tall else "prose"
+        lines.append({"kind": kind, "top": top, "bottom": bottom, "left": left, "right": right})
+    return lines, text_left, text_right
+
+def segment_layout(image):
+    """
+    ページを読み順の領域に分ける
+    戻り値: [{"kind": "prose" | "formula" | "page", "box": (左, 上, 右, 下), "image": 切り出した画像}]
+    分割できない・分けすぎる場合はページ全体を1つの "page" 領域として返す
+    """
+    gray = np.asarray(image.convert("L"))
+    height, width = gray.shape
+    whole_page = [{"kind": "page", "box": (0, 0, width, height), "image": image}]
+
+    mask = _ink_mask(gray)
+    bands, line_height = _line_bands(mask)
+    if len(bands) < 2:
+        return whole_page
+    lines, text_left, text_right = _classify_lines(mask, bands, line_height)
+
+    # 同じ種類で隙間の小さい行をブロックにまとめる
+    blocks = [dict(lines[0])]
+    for line in lines[1:]:
+        block = blocks[-1]
+        if line["kind"] == block["kind"] and line["top"] - block["bottom"] < line_height * BLOCK_GAP_RATIO:
+            block["bottom"] = line["bottom"]
+            block["left"] = min(block["left"], line["left"])
+            block["right"] = max(block["right"], line["right"])
+        else:
+            blocks.append(dict(line))
+
+    if len(blocks) < 2 or len(blocks) > LAYOUT_MAX_REGIONS:
+        return whole_page
+
+    pad = int(line_height * REGION_PADDING_RATIO)
+    regions = []
+    for block in blocks:
+        if block["kind"] == "prose":
+            # 文章は行頭・行末がそろうよう本文の全幅で切り出す
+            left, right = text_left, text_right
+        else:
+            left, right = block["left"], block["right"]
+        box = (
+            max(left - pad, 0),
+            max(block["top"] - pad, 0),
+            min(right + pad, width),
+            min(block["bottom"] + pad, height),
+        )
+        regions.append({"kind": block["kind"], "box": box, "image": image.crop(box)})
+    return regions
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+プランに応じたモデル選択と、応答時間の目標（SLO）に基づく自動的な格下げ
+
+- プランごとに使うモデル（OCR）・選べるモデル（チャット）を決める
+- 直近の「最初の断片までの時間」の p50 / p95 をモデルごとに集計し（ヘッジで打ち切られた・タイムアウトした
+  呼び出しは目標を超えたものとして数える）、目標を超えたモデルへの
+  リクエストは一時的に高速な下位モデルへ回す（OCR: gpt-4o → gpt-4o-mini、チャット: Pro → Flash など）
+- 格下げ中も一部のリクエストは元のモデルへ送って回復を確かめ、目標を十分下回ったら元に戻す
+"""
+import functools
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+
+from call_metrics import call_latencies, percentile
+
+# プランごとのOCRモデル
+PLAN_OCR_MODELS = {"premium": "gpt-4o", "free": "gpt-4o-mini"}
+
+# プランごとに選べるチャットモデル（先頭が既定）
+PLAN_CHAT_MODELS = {
+    "premium": ["gemini-1.5-flash-latest", "gpt-4o-mini", "gemini-1.5-pro-latest"],
+    "free": ["gemini-1.5-flash-latest"],
+}
+
+# 用途ごとの集計対象の呼び出しの種類（call_metrics の kind）
+TASK_KINDS = {
+    "ocr": ("ocr_page", "ocr_region", "ocr_document"),
+    "chat": ("chat",),
+}
+
+# 用途ごとの格下げ先（遅いモデル → 高速な下位モデル）
+DEGRADE_MODELS = {
+    "ocr": {"gpt-4o": "gpt-4o-mini"},
+    "chat": {"gemini-1.5-pro-latest": "gemini-1.5-flash-latest", "gpt-4o": "gpt-4o-mini"},
+}
+
+# 最初の断片までの時間の目標（秒）。MODEL_SLOS（JSON）で上書きできる
+DEFAULT_SLOS = {
+    "ocr": {"p50": 8.0, "p95": 20.0},
+    "chat": {"p50": 3.0, "p95": 8.0},
+}
+
+ROUTER_WINDOW_S = 300.0        # この時間内の記録で判定する
+ROUTER_MIN_SAMPLES = 5         # これより記録が少なければ判定しない
+ROUTER_HOLD_S = 120.0          # 格下げしてから少なくともこの時間は戻さない
+ROUTER_RECOVERY_RATIO = 0.8    # 目標のこの割合を下回ったら元に戻す
+ROUTER_PROBE_RATIO = 0.1       # 格下げ中に元のモデルへ送る割合（回復の確認用）
+
+Route = namedtuple("Route", ["model", "requested_model", "degraded"])
+
+def default_ocr_model(plan):
+    """プランに応じたOCRモデル"""
+    return PLAN_OCR_MODELS.get(plan, PLAN_OCR_MODELS["free"])
+
+def chat_models(plan):
+    """プランで選べるチャットモデル（先頭が既定）"""
+    return PLAN_CHAT_MODELS.get(plan, PLAN_CHAT_MODELS["free"])
+
+class ModelRouter:
+    """用途・モデルごとに応答時間を監視し、目標を超えている間は下位モデルへ回す"""
+
+    def __init__(self, slos=None):
+        self.slos = slos or DEFAULT_SLOS
+        self._degraded_since = {}     # (用途, モデル) → 格下げした時刻
+        self._stats = {"routed": 0, "degraded": 0, "probes": 0, "degradations": 0, "recoveries": 0}
+        self._lock = threading.Lock()
+
+    def latency(self, task, model, censored_as="elapsed"):
+        """
+        直近の最初の断片までの時間 (p50, p95, 記録数)
+        censored_as: 打ち切られた呼び出しの扱い（既定は打ち切りまでの時間、call_latencies 参照）
+        """
+        samples = call_latencies(TASK_KINDS[task], model, field="first_token_s",
+                                 since=time.time() - ROUTER_WINDOW_S, censored_as=censored_as)
+        return percentile(samples, 50), percentile(samples, 95), len(samples)
+
+    def _breached(self, task, model, ratio=1.0):
+        """目標（× ratio）を超えているか（記録が少なければ None）"""
+        # ヘッジ先に負けた・タイムアウトした呼び出しは、目標を超えたものとして数える
+        p50, p95, count = self.latency(task, model, censored_as=math.inf)
+        if count < ROUTER_MIN_SAMPLES:
+            return None
+        slo = self.slos[task]
+        return p50 > slo["p50"] * ratio or p95 > slo["p95"] * ratio
+
+    def _update(self, task, model):
+        key = (task, model)
+        now = time.monotonic()
+        since = self._degraded_since.get(key)
+        if since is None:
+            if self._breached(task, model):
+                self._degraded_since[key] = now
+                self._stats["degradations"] += 1
+        elif now - since >= ROUTER_HOLD_S and not self._breached(task, model, ROUTER_RECOVERY_RATIO):
+            # 目標を十分下回った（記録がなくなった場合も、古い記録で止め続けないよう戻して確かめる）
+            del self._degraded_since[key]
+            self._stats["recoveries"] += 1
+        return key in self._degraded_since
+
+    def route(self, task, model):
+        """実際に使うモデルを決める"""
+        fallback = DEGRADE_MODELS.get(task, {}).get(model)
+        with self._lock:
+            self._stats["routed"] += 1
+            if fallback is None or not self._update(task, model):
+                return Route(model, model, False)
+            if random.random() < ROUTER_PROBE_RATIO:
+                self._stats["probes"] += 1
+                return Route(model, model, False)
+            self._stats["degraded"] += 1
+            return Route(fallback, model, True)
+
+    def status(self):
+        """格下げ中のモデル・集計と、用途・モデルごとの直近の p50 / p95"""
+        with self._lock:
+            stats = dict(self._stats)
+            degraded = sorted(self._degraded_since)
+        stats["degraded_models"] = [f"{task}:{model}" for task, model in degraded]
+        stats["latency"] = {
+            f"{task}:{model}": dict(zip(("p50_s", "p95_s", "samples"), self.latency(task, model)))
+            for task, models in DEGRADE_MODELS.items() for model in models
+        }
+        return stats
+
+def _load_slos():
+    slos = {task: dict(slo) for task, slo in DEFAULT_SLOS.items()}
+    override = os.getenv("MODEL_SLOS")
+    if override:
+        for task, slo in json.loads(override).items():
+            slos.setdefault(task, {}).update(slo)
+    return slos
+
+@functools.lru_cache(maxsize=None)
+def get_model_router():
+    """プロセス全体で共有するモデルルーター"""
+    return ModelRouter(_load_slos())
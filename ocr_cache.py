@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# OCR結果キャッシュの保存先と上限（利用者の画像の読み取り結果を作業ツリーに書かないよう、既定はユーザーのキャッシュディレクトリ）
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR") or os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "rigakugpt", "ocr_cache"
+)
+OCR_CACHE_MAX_BYTES = 200 * 1024 * 1024       # 200MB
+OCR_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60     # 30日
+# 上限チェック（ディレクトリ走査）は書き込み何回ごとに行うか
+EVICTION_CHECK_INTERVAL = 20
+
+def bytes_digest(data):
+    """バイト列のハッシュ"""
+    return hashlib.sha256(data).hexdigest()
+
+def image_digest(image):
+    """PIL画像の画素内容のハッシュ（モード・サイズを含む）"""
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode('utf-8'))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+def make_ocr_cache_key(image_digests, model, prompt_version, preprocess_params, ocr_mode="single"):
+    """画像ハッシュ・モデル名・プロンプト版・前処理パラメータ・読み取りモードからキーを生成"""
+    h = hashlib.sha256()
+    for digest in image_digests:
+        h.update(digest.encode('utf-8'))
+    h.update(json.dumps({
+        "model": model,
+        "prompt_version": prompt_version,
+        "preprocess": preprocess_params,
+        "ocr_mode": ocr_mode,
+    }, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+class OCRResultCache:
+    """
+    ディスク上のOCR結果キャッシュ
+    - 書き込みは一時ファイル + os.replace によるアトミックな置き換え（複数プロセスから安全）
+    - 参照時に更新日時を更新し、容量超過時は更新日時の古い順に削除（LRU）
+    - 作成から TTL を過ぎたエントリは参照時に削除
+    """
+
+    def __init__(self, directory=OCR_CACHE_DIR, max_bytes=OCR_CACHE_MAX_BYTES, ttl=OCR_CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def get(self, key):
+        """キャッシュされたOCR結果のテキストを返す（なければ None）"""
+        entry = self.get_entry(key)
+        return None if entry is None else entry["text"]
+
+    def get_entry(self, key):
+        """キャッシュされたエントリ（"text" と保存時の "metadata"）を返す（なければ None）"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            # 存在しない・他プロセスが削除中・壊れたファイルはミス扱い
+            self._count(hit=False)
+            return None
+
+        if time.time() - entry.get("created_at", 0) > self.ttl:
+            self._remove(path)
+            self._count(hit=False)
+            return None
+
+        try:
+            # LRU のため最終参照時刻を更新
+            os.utime(path)
+        except OSError:
+            pass
+        self._count(hit=True)
+        return entry
+
+    def contains(self, key):
+        """エントリのファイルが残っているか（期限切れの判定はしない）"""
+        return os.path.exists(self._path(key))
+
+    def put(self, key, text, metadata=None):
+        """OCR結果をアトミックに保存"""
+        path = self._path(key)
+        entry = {"text": text, "created_at": time.time(), "metadata": metadata or {}}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except BaseException:
+                self._remove(tmp_path)
+                raise
+        except OSError:
+            # キャッシュの書き込み失敗はOCR自体の失敗にはしない
+            return
+
+        with self._lock:
+            self._writes += 1
+            check_eviction = self._writes % EVICTION_CHECK_INTERVAL == 1
+        if check_eviction:
+            self.evict()
+
+    def evict(self):
+        """容量上限を超えていれば、最終参照の古いエントリから削除"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        # 上限の9割まで減らして、削除の頻発を防ぐ
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            if self._remove(path):
+                total -= size
+                with self._lock:
+                    self._evictions += 1
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        """ヒット率などの統計（このプロセス内の集計）"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "writes": self._writes,
+                "evictions": self._evictions,
+            }
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+OCRエンジン：画像の最適化・プロンプト選択・プロバイダ呼び出し（ヘッジ付き）・ページ並列化
+
+Streamlitに依存しないため、ワーカースレッドからも呼び出せる（エラーは例外として送出）
+"""
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from call_metrics import call_latencies
+from failover import HedgedStream
+from layout import segment_layout
+from ocr_cache import bytes_digest, image_digest, make_ocr_cache_key
+from ocr_quality import score_ocr_result
+from prompts import PROMPT_VERSION, get_prompt
+from singleflight import SingleFlight, fingerprint
+from vision_budget import optimize_image_for_vision
+
+OCR_MAX_TOKENS = 3000
+
+# ページごとの並列OCR（fan-out）の設定
+OCR_FANOUT_WORKERS = 8
+OCR_PAGE_RETRIES = 1
+OCR_PAGE_SEPARATOR = "\n\n---\n\n"
+OCR_FAILED_PAGE_TEMPLATE = "（{page}ページ目の読み取りに失敗しました）"
+
+# 領域ごとのOCR（レイアウト解析）の設定
+OCR_REGION_MAX_TOKENS = 1500
+REGION_PROMPTS = {
+    "prose": ("ocr_region_prose_system", "ocr_region_prose_user"),
+    "formula": ("ocr_region_formula_system", "ocr_region_formula_user"),
+    "page": ("ocr_page_system", "ocr_page_user"),
+}
+
+# 段階的OCR：指定モデル → 先に試す安価なモデル
+CASCADE_CHEAP_MODELS = {
+    "gpt-4o": "gpt-4o-mini",
+    "gpt-4o-mini": "gemini-1.5-flash-latest",
+}
+
+logger = logging.getLogger(__name__)
+
+def prepare_ocr_images(images, original_bytes=None, original_mimes=None):
+    """
+    送信用に画像を最適化（解像度・detail・形式）
+    戻り値: ([{"data", "mime_type", "detail", "tokens"}], [最適化レポート])
+    """
+    ocr_images = []
+    reports = []
+    for i, image in enumerate(images):
+        data, mime_type, detail, report = optimize_image_for_vision(
+            image,
+            original_bytes[i] if original_bytes else None,
+            original_mimes[i] if original_mimes else None,
+        )
+        ocr_images.append({"data": data, "mime_type": mime_type, "detail": detail, "tokens": report["tokens_after"]})
+        reports.append(report)
+    return ocr_images, reports
+
+def _preprocess_note(preprocessed):
+    return get_prompt("ocr_preprocess_note") if preprocessed else ""
+
+def stream_ocr_document(ocr_images, model, preprocessed=True):
+    """全ページを1リクエストで読み取り、テキスト断片を順に返す（応答したモデルは戻り値の model 属性）"""
+    return HedgedStream(
+        "ocr_document",
+        model,
+        get_prompt("ocr_document_system"),
+        get_prompt("ocr_document_user", count=len(ocr_images), preprocess_note=_preprocess_note(preprocessed)),
+        ocr_images,
+        OCR_MAX_TOKENS,
+    )
+
+# 同じ画像・モデル・プロンプトで実行中のページ・領域の読み取りを1回の呼び出しにまとめる
+_page_flight = SingleFlight()
+
+def _request_key(kind, ocr_image, model, preprocessed):
+    return fingerprint(
+        kind, bytes_digest(ocr_image["data"]), ocr_image.get("detail"), ocr_image.get("region_kind"),
+        model, preprocessed, PROMPT_VERSION
+    )
+
+def coalesced_call_stats():
+    """ページ・領域の読み取りのうち、実行中の呼び出しに統合した回数"""
+    return _page_flight.stats()
+
+def ocr_page(ocr_image, model, preprocessed=True):
+    """
+    1ページ分を読み取る（同じ内容の読み取りが実行中なら、その結果を共有する）
+    戻り値: (テキスト, 実際に応答したモデル)
+    """
+    return _page_flight.do(_request_key("ocr_page", ocr_image, model, preprocessed),
+                           _ocr_page, ocr_image, model, preprocessed)
+
+def _ocr_page(ocr_image, model, preprocessed):
+    stream = HedgedStream(
+        "ocr_page",
+        model,
+        get_prompt("ocr_page_system"),
+        get_prompt("ocr_page_user", preprocess_note=_preprocess_note(preprocessed)),
+        [ocr_image],
+        OCR_MAX_TOKENS,
+    )
+    return "".join(stream).strip(), stream.model
+
+def ocr_pages(ocr_images, model, preprocessed=True, page_func=None):
+    """
+    ページごとに別リクエストで並列に読み取る（失敗したページのみ再試行）
+    戻り値: (アップロード順のテキスト（失敗ページは None）, {ページ番号: 例外}, ページごとに応答したモデル)
+    """
+    page_func = page_func or ocr_page
+    results = [None] * len(ocr_images)
+    models = [None] * len(ocr_images)
+    errors = {}
+    pending = list(range(len(ocr_images)))
+
+    for _ in range(OCR_PAGE_RETRIES + 1):
+        with ThreadPoolExecutor(max_workers=min(OCR_FANOUT_WORKERS, len(pending))) as executor:
+            # 呼び出し元（プラン・利用者）をワーカースレッドへ引き継ぐ
+            futures = {
+                executor.submit(contextvars.copy_context().run, page_func, ocr_images[i], model, preprocessed): i
+                for i in pending
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i], models[i] = future.result()
+                    errors.pop(i, None)
+                except Exception as e:
+                    errors[i] = e
+        pending = [i for i in pending if results[i] is None]
+        if not pending:
+            break
+
+    return results, errors, models
+
+def ocr_region(ocr_image, model, preprocessed=True):
+    """
+    レイアウト解析で切り出した1領域を、領域の種類（ocr_image["region_kind"]）に合ったプロンプトで読み取る
+    戻り値: (テキスト, 実際に応答したモデル)
+    """
+    return _page_flight.do(_request_key("ocr_region", ocr_image, model, preprocessed),
+                           _ocr_region, ocr_image, model, preprocessed)
+
+def _ocr_region(ocr_image, model, preprocessed):
+    system_name, user_name = REGION_PROMPTS[ocr_image["region_kind"]]
+    stream = HedgedStream(
+        "ocr_region",
+        model,
+        get_prompt(system_name),
+        get_prompt(user_name, preprocess_note=_preprocess_note(preprocessed)),
+        [ocr_image],
+        OCR_REGION_MAX_TOKENS if ocr_image["region_kind"] != "page" else OCR_MAX_TOKENS,
+    )
+    return "".join(stream).strip(), stream.model
+
+def _region_cache_key(region, model):
+    return make_ocr_cache_key(
+        [image_digest(region["image"])], model, PROMPT_VERSION, {"region": region["kind"]}, "region"
+    )
+
+def ocr_regions(images, model, preprocessed=True, region_cache=None):
+    """
+    各ページを文章ブロック・ディスプレイ数式の領域に分け、全ページの領域をまとめて並列に読み取り、読み順に組み立てる
+    region_cache（OCRResultCache）があれば領域ごとに結果を保存し、切り抜き直しても変わらない領域は再利用する
+    戻り値: (ページごとのテキスト（失敗ページは None）, {ページ番号: 例外}, [最適化レポート], 統計,
+             ページごとに応答したモデル（領域ごとに異なる場合は None）)
+    """
+    regions = [(page, region) for page, image in enumerate(images) for region in segment_layout(image)]
+    region_texts = [None] * len(regions)
+    region_models = [model] * len(regions)
+    keys = [None] * len(regions)
+    pending = []
+    for j, (_, region) in enumerate(regions):
+        if region_cache is not None:
+            keys[j] = _region_cache_key(region, model)
+            region_texts[j] = region_cache.get(keys[j])
+        if region_texts[j] is None:
+            pending.append(j)
+
+    ocr_images, reports = prepare_ocr_images([regions[j][1]["image"] for j in pending])
+    for j, ocr_image in zip(pending, ocr_images):
+        ocr_image["region_kind"] = regions[j][1]["kind"]
+    texts, region_errors, models = (
+        ocr_pages(ocr_images, model, preprocessed, page_func=ocr_region) if pending else ([], {}, [])
+    )
+    for j, text, answered_model in zip(pending, texts, models):
+        region_texts[j] = text
+        region_models[j] = answered_model
+        if text is not None and region_cache is not None:
+            # 切り替え先のモデルが読んだ結果は、そのモデルの結果として保存する
+            region_cache.put(_region_cache_key(regions[j][1], answered_model), text,
+                             {"model": answered_model, "region": regions[j][1]["kind"]})
+
+    # 読み順に組み立てる（1領域でも失敗したページは失敗扱い）
+    page_parts = [[] for _ in images]
+    page_models = [set() for _ in images]
+    errors = {}
+    for j, (page, _) in enumerate(regions):
+        page_parts[page].append(region_texts[j])
+        page_models[page].add(region_models[j])
+    for k, error in region_errors.items():
+        errors.setdefault(regions[pending[k]][0], error)
+    page_texts = [
+        None if page in errors else "\n\n".join(text for text in parts if text)
+        for page, parts in enumerate(page_parts)
+    ]
+    stats = {
+        "regions": len(regions),
+        "formulas": sum(1 for _, region in regions if region["kind"] == "formula"),
+        "ocr_regions": len(pending),
+    }
+    page_models = [next(iter(models)) if len(models) == 1 else None for models in page_models]
+    return page_texts, errors, reports, stats, page_models
+
+_cascade_stats = {"runs": 0, "pages": 0, "escalated": 0, "saved_call_s": 0.0}
+_cascade_stats_lock = threading.Lock()
+
+def _average_page_latency(model):
+    """直近のページ単位OCRの平均所要時間（記録がなければ None）"""
+    samples = call_latencies("ocr_page", model)
+    return sum(samples) / len(samples) if samples else None
+
+def ocr_pages_cascade(ocr_images, reports, model, preprocessed=True):
+    """
+    段階的OCR：まず安価なモデルで全ページを読み、品質チェックに落ちたページだけ指定モデルで読み直す
+    戻り値: (テキスト, {ページ番号: 例外}, 上位モデルで読み直したページ番号のリスト, ページごとに応答したモデル)
+    """
+    cheap_model = CASCADE_CHEAP_MODELS.get(model)
+    if cheap_model is None:
+        texts, errors, models = ocr_pages(ocr_images, model, preprocessed)
+        return texts, errors, [], models
+
+    texts, errors, models = ocr_pages(ocr_images, cheap_model, preprocessed)
+    escalated = [
+        i for i, text in enumerate(texts)
+        if text is None or not score_ocr_result(text, reports[i])["ok"]
+    ]
+
+    if escalated:
+        strong_texts, strong_errors, strong_models = ocr_pages([ocr_images[i] for i in escalated], model, preprocessed)
+        for j, i in enumerate(escalated):
+            if strong_texts[j] is not None:
+                texts[i] = strong_texts[j]
+                models[i] = strong_models[j]
+                errors.pop(i, None)
+            elif texts[i] is None:
+                errors[i] = strong_errors[j]
+            # 上位モデルが失敗し安価なモデルの結果がある場合はそれを残す
+
+    # 全ページを上位モデルで読んだ場合と比べた、呼び出し時間の推定短縮量
+    # （読み直したページは安価なモデルの分が余計に掛かっているため差し引く。負になることもある）
+    strong_latency = _average_page_latency(model)
+    cheap_latency = _average_page_latency(cheap_model)
+    kept = len(ocr_images) - len(escalated)
+    saved = 0.0
+    if strong_latency and cheap_latency:
+        saved = (strong_latency - cheap_latency) * kept - cheap_latency * len(escalated)
+
+    with _cascade_stats_lock:
+        _cascade_stats["runs"] += 1
+        _cascade_stats["pages"] += len(ocr_images)
+        _cascade_stats["escalated"] += len(escalated)
+        _cascade_stats["saved_call_s"] += saved
+        total_rate = _cascade_stats["escalated"] / _cascade_stats["pages"]
+
+    logger.info(
+        "OCR cascade %s->%s: escalated %d/%d pages (overall rate %.0f%%), estimated call time saved %.1fs",
+        cheap_model, model, len(escalated), len(ocr_images), total_rate * 100, saved
+    )
+    return texts, errors, escalated, models
+
+def cascade_stats():
+    """段階的OCRの累計（昇格率・推定短縮時間）"""
+    with _cascade_stats_lock:
+        stats = dict(_cascade_stats)
+    stats["escalation_rate"] = stats["escalated"] / stats["pages"] if stats["pages"] else 0.0
+    return stats
+
+def plan_incremental_ocr(digests, segments):
+    """
+    前回の読み取り結果のうち、今回のアップロードでそのまま使える部分を探す
+    segments: [{"digests": [ページのハッシュ], "text": str}]（1ページ、またはまとめて読んだ連続ページ）
+    戻り値: アップロード順の [("reuse", segment) | ("page", ページ番号)]
+    """
+    by_first_page = {}
+    for segment in segments:
+        by_first_page.setdefault(segment["digests"][0], []).append(segment)
+
+    plan = []
+    i = 0
+    while i < len(digests):
+        candidates = [
+            segment for segment in by_first_page.get(digests[i], [])
+            if list(digests[i:i + len(segment["digests"])]) == list(segment["digests"])
+        ]
+        if candidates:
+            segment = max(candidates, key=lambda seg: len(seg["digests"]))
+            plan.append(("reuse", segment))
+            i += len(segment["digests"])
+        else:
+            plan.append(("page", i))
+            i += 1
+    return plan
+
+def run_ocr(images, model, mode="single", preprocessed=True, original_bytes=None, original_mimes=None,
+            on_chunk=None, digests=None, segments=None, page_cache=None, cache_namespace=None,
+            region_cache=None):
+    """
+    画像の最適化からOCRまでを一括で実行（バックグラウンドジョブから呼ぶ）
+    mode: "single"（全ページを1リクエスト）/ "per_page"（ページごとに並列）
+          / "cascade"（ページごとに軽量モデル → 品質チェックに落ちたページのみ指定モデル）
+          / "regions"（レイアウト解析した領域ごとに並列、前処理済みの画像のみ。それ以外は "per_page"）
+    on_chunk: "single" の場合に途中結果の断片を受け取る関数
+    digests / segments: ページのハッシュと前回の結果（plan_incremental_ocr 参照）。
+        指定すると新しいページ・変更されたページだけを読み取り、前回の結果とアップロード順に繋ぐ
+        （一部のページだけを読む場合は "single" でもページごとに読む）
+    page_cache / cache_namespace: ユーザー間で共有するページ単位のキャッシュ（phash_cache.SharedPageCache）と、
+        モデルを含まない設定（プロンプト版・前処理設定）。結果はページごとに実際に応答したモデルの分として保存する
+    region_cache: "regions" の場合に領域ごとの結果を保存するキャッシュ（OCRResultCache）
+    戻り値: {"text", "segments", "reports", "errors": {ページ番号: 例外}, "escalated": [ページ番号],
+             "model", "processed_pages", "shared_pages"}
+    """
+    if digests is None:
+        plan = [("page", i) for i in range(len(images))]
+    else:
+        plan = plan_incremental_ocr(digests, segments or [])
+    pending = [item for kind, item in plan if kind == "page"]
+
+    # 他のユーザーが読み取った似たページの結果を使う
+    page_texts = {}
+    page_models = {}
+    if page_cache is not None:
+        for i in pending:
+            text = page_cache.lookup(images[i], cache_namespace, model)
+            if text is not None:
+                page_texts[i] = text
+        pending = [i for i in pending if i not in page_texts]
+
+    result = {
+        "reports": [], "errors": {}, "escalated": [], "model": model,
+        "processed_pages": len(pending), "shared_pages": len(page_texts),
+    }
+
+    if pending and mode == "regions" and preprocessed:
+        texts, errors, reports, region_stats, models = ocr_regions(
+            [images[i] for i in pending], model, preprocessed, region_cache
+        )
+        result["reports"] = reports
+        result["regions"] = region_stats
+        if all(text is None for text in texts):
+            raise next(iter(errors.values()))
+        result["errors"] = {pending[j]: error for j, error in errors.items()}
+        page_texts.update(zip(pending, texts))
+        page_models.update(zip(pending, models))
+    elif pending:
+        ocr_images, reports = prepare_ocr_images(
+            [images[i] for i in pending],
+            [original_bytes[i] for i in pending] if original_bytes else None,
+            [original_mimes[i] for i in pending] if original_mimes else None,
+        )
+        result["reports"] = reports
+
+        if mode == "single" and len(pending) == len(images):
+            stream = stream_ocr_document(ocr_images, model, preprocessed)
+            parts = []
+            for chunk in stream:
+                parts.append(chunk)
+                if on_chunk:
+                    on_chunk(chunk)
+            result["text"] = "".join(parts).strip()
+            result["model"] = stream.model
+            result["segments"] = [{"digests": list(digests), "text": result["text"]}] if digests else []
+            return result
+
+        if mode == "cascade":
+            texts, errors, escalated, models = ocr_pages_cascade(ocr_images, reports, model, preprocessed)
+            result["escalated"] = [pending[j] for j in escalated]
+        else:
+            texts, errors, models = ocr_pages(ocr_images, model, preprocessed)
+        if all(text is None for text in texts):
+            raise errors[0]
+        result["errors"] = {pending[j]: error for j, error in errors.items()}
+        page_texts.update(zip(pending, texts))
+        page_models.update(zip(pending, models))
+
+    if pending and page_cache is not None:
+        for i in pending:
+            # 領域ごとに別のモデルが応答したページは共有しない
+            if page_texts[i] and page_models.get(i):
+                page_cache.store(images[i], cache_namespace, page_models[i], page_texts[i])
+
+    # 前回の結果と今回読み取ったページをアップロード順に繋ぐ（失敗ページは次回また読み取る）
+    parts = []
+    new_segments = []
+    for kind, item in plan:
+        if kind == "reuse":
+            parts.append(item["text"])
+            new_segments.append(item)
+        elif page_texts[item] is None:
+            parts.append(OCR_FAILED_PAGE_TEMPLATE.format(page=item + 1))
+        else:
+            parts.append(page_texts[item])
+            if digests:
+                new_segments.append({"digests": [digests[item]], "text": page_texts[item]})
+    result["text"] = OCR_PAGE_SEPARATOR.join(parts)
+    result["segments"] = new_segments
+    return result
+
+def is_complete_ocr_result(text):
+    """全ページの読み取りに成功した結果かどうか（失敗ページを含む結果はキャッシュしない）"""
+    return OCR_FAILED_PAGE_TEMPLATE.split("{page}")[1] not in text
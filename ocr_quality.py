@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""OCR結果の簡易品質チェック（APIを呼ばずにローカルで判定）"""
+import re
+
+# 上位モデルへ切り替える閾値
+MAX_UNKNOWN_COMMAND_RATE = 0.2
+MIN_LENGTH_RATIO = 0.25   # 推定文字数に対する出力文字数の下限
+MAX_LENGTH_RATIO = 4.0    # 同上限（幻覚・繰り返しの検出）
+GLYPH_INK_FILL = 0.2      # 文字の外接矩形に占めるインクの割合の目安
+
+# よく使われるLaTeXコマンド（これ以外は「未知のコマンド」として数える）
+KNOWN_COMMANDS = {
+    # 構造・書式
+    "begin", "end", "text", "textbf", "textit", "mathrm", "mathbf", "mathit", "mathcal", "mathbb",
+    "mathsf", "mathtt", "operatorname", "left", "right", "big", "Big", "bigg", "Bigg", "quad", "qquad",
+    "label", "tag", "displaystyle", "limits", "nolimits", "overline", "underline", "overbrace",
+    "underbrace", "hat", "bar", "vec", "dot", "ddot", "tilde", "widehat", "widetilde", "boldsymbol",
+    "stackrel", "overset", "underset", "substack", "phantom", "hline", "cline", "newline", "item",
+    # 分数・根号・演算
+    "frac", "dfrac", "tfrac", "sqrt", "sum", "prod", "int", "iint", "iiint", "oint", "lim", "limsup",
+    "liminf", "sup", "inf", "max", "min", "arg", "det", "dim", "ker", "deg", "gcd", "Pr", "exp", "log",
+    "ln", "lg", "sin", "cos", "tan", "cot", "sec", "csc", "arcsin", "arccos", "arctan", "sinh", "cosh",
+    "tanh", "coth", "binom", "pmod", "bmod", "mod", "partial", "nabla", "infty", "cdot", "cdots",
+    "ldots", "dots", "vdots", "ddots", "times", "div", "pm", "mp", "circ", "bullet", "star", "ast",
+    "oplus", "otimes", "cup", "cap", "bigcup", "bigcap", "setminus", "wedge", "vee", "neg", "lnot",
+    # 関係
+    "le", "leq", "ge", "geq", "ne", "neq", "approx", "sim", "simeq", "cong", "equiv", "propto",
+    "ll", "gg", "in", "notin", "ni", "subset", "subseteq", "supset", "supseteq", "mid", "parallel",
+    "perp", "to", "gets", "mapsto", "rightarrow", "leftarrow", "Rightarrow", "Leftarrow",
+    "leftrightarrow", "Leftrightarrow", "iff", "implies", "longrightarrow", "Longrightarrow",
+    "forall", "exists", "nexists", "emptyset", "varnothing", "angle", "triangle", "degree",
+    # 括弧
+    "langle", "rangle", "lfloor", "rfloor", "lceil", "rceil", "lvert", "rvert", "vert", "Vert",
+    "lbrace", "rbrace",
+    # ギリシャ文字
+    "alpha", "beta", "gamma", "delta", "epsilon", "varepsilon", "zeta", "eta", "theta", "vartheta",
+    "iota", "kappa", "lambda", "mu", "nu", "xi", "pi", "varpi", "rho", "varrho", "sigma", "varsigma",
+    "tau", "upsilon", "phi", "varphi", "chi", "psi", "omega", "Gamma", "Delta", "Theta", "Lambda",
+    "Xi", "Pi", "Sigma", "Upsilon", "Phi", "Psi", "Omega", "hbar", "ell", "Re", "Im", "aleph",
+}
+
+_COMMAND_RE = re.compile(r"\\([A-Za-z]+)")
+_ESCAPED_RE = re.compile(r"\\[{}$]")
+
+def check_brace_balance(text):
+    """エスケープされていない { } の対応が取れているか"""
+    depth = 0
+    for char in _ESCAPED_RE.sub("", text):
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+def check_dollar_balance(text):
+    """エスケープされていない $ / $$ が閉じているか"""
+    stripped = _ESCAPED_RE.sub("", text)
+    display = stripped.count("$$")
+    inline = stripped.replace("$$", "").count("$")
+    return display % 2 == 0 and inline % 2 == 0
+
+def unknown_command_rate(text):
+    """LaTeXコマンドのうち、既知の一覧にないものの割合"""
+    commands = _COMMAND_RE.findall(text)
+    if not commands:
+        return 0.0
+    unknown = sum(1 for command in commands if command not in KNOWN_COMMANDS)
+    return unknown / len(commands)
+
+def expected_glyph_count(report):
+    """画像のインク量と文字の高さから、ページ内のおおよその文字数を推定"""
+    glyph_px = report.get("glyph_px")
+    if not glyph_px:
+        return None
+    width, height = report["size_before"]
+    ink_pixels = report["ink_ratio"] * width * height
+    return ink_pixels / (glyph_px * glyph_px * GLYPH_INK_FILL)
+
+def score_ocr_result(text, report=None):
+    """
+    OCR結果を採点し、上位モデルで読み直すべきかを判定
+    戻り値: {"ok": bool, "reasons": [...], 各指標}
+    """
+    reasons = []
+    if not text or not text.strip():
+        return {"ok": False, "reasons": ["empty"]}
+
+    if not check_brace_balance(text):
+        reasons.append("brace_unbalanced")
+    if not check_dollar_balance(text):
+        reasons.append("dollar_unbalanced")
+
+    unknown_rate = unknown_command_rate(text)
+    if unknown_rate > MAX_UNKNOWN_COMMAND_RATE:
+        reasons.append("unknown_commands")
+
+    length_ratio = None
+    expected = expected_glyph_count(report) if report else None
+    if expected:
+        # コマンド名・空白を除いたおおよその文字数で比較
+        visible = len(re.sub(r"\s+", "", _COMMAND_RE.sub("", text)))
+        length_ratio = visible / expected
+        if length_ratio < MIN_LENGTH_RATIO:
+            reasons.append("too_short")
+        elif length_ratio > MAX_LENGTH_RATIO:
+            reasons.append("too_long")
+
+    return {
+        "ok": not reasons,
+        "reasons": reasons,
+        "unknown_command_rate": unknown_rate,
+        "length_ratio": length_ratio,
+    }
@@ -4,7 +4,9 @@ import stripe
 import os
 from dotenv import load_dotenv
 import json
+import uuid
 from data_manager import save_user_data, load_user_data
+from resilience import call_with_retry
 from utils import get_redirect_uri
 
 # 環境変数読み込み
@@ -14,6 +16,11 @@ load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+STRIPE_TIMEOUT_S = 20  # 1回の呼び出しのタイムアウト
+
+# 再試行は resilience で行う（SDK内の再試行と重ねない）
+stripe.max_network_retries = 0
+stripe.default_http_client = stripe.new_default_http_client(timeout=STRIPE_TIMEOUT_S)
 
 class StripePayment:
     def __init__(self):
@@ -24,7 +31,10 @@ class StripePayment:
     def create_checkout_session(self, user_email, success_url, cancel_url):
         """Stripe Checkoutセッションを作成"""
         try:
-            session = stripe.checkout.Session.create(
+            # 再試行で二重にセッションを作らないよう、全ての試行で同じ冪等キーを使う
+            session = call_with_retry(
+                "stripe", stripe.checkout.Session.create,
+                idempotency_key=uuid.uuid4().hex,
                 payment_method_types=['card'],
                 line_items=[{
                     'price_data': {
@@ -59,7 +69,8 @@ class StripePayment:
     def create_portal_session(self, customer_id, return_url):
         """Stripe Customer Portalセッションを作成"""
         try:
-            session = stripe.billing_portal.Session.create(
+            session = call_with_retry(
+                "stripe", stripe.billing_portal.Session.create,
                 customer=customer_id,
                 return_url=return_url,
             )
@@ -73,7 +84,7 @@ class StripePayment:
     def get_customer_by_email(self, email):
         """メールアドレスから顧客情報を取得"""
         try:
-            customers = stripe.Customer.list(email=email, limit=1)
+            customers = call_with_retry("stripe", stripe.Customer.list, email=email, limit=1)
             
             if customers.data:
                 return customers.data[0]
@@ -86,7 +97,8 @@ class StripePayment:
     def check_subscription_status(self, customer_id):
         """サブスクリプション状況を確認"""
         try:
-            subscriptions = stripe.Subscription.list(
+            subscriptions = call_with_retry(
+                "stripe", stripe.Subscription.list,
                 customer=customer_id,
                 status='active',
                 limit=1
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+ユーザー間で共有するページ単位のOCRキャッシュ（知覚ハッシュによる近似一致）
+
+同じ教科書のページでも撮影角度・照明が違えばバイト列は一致しないため、
+前処理済み（傾き補正済み）グレースケール画像の知覚ハッシュ（DCTハッシュ）で検索する。
+- ハミング距離による近傍検索は BK-tree で行う
+- 候補は別のハッシュ（差分ハッシュ）と縦横比で絞り込み、さらに保存した縮小画像とタイルごとの
+  差で内容を照合してから再利用する（64ビットのハッシュだけでは、同じ割り付けで文字だけ違う
+  ページを見分けられない）
+- 索引は追記専用のファイルに保存し、他プロセスの追記も参照時に読み込む
+- テキスト本体は OCRResultCache（容量上限・TTL付き）に保存する。起動時と、本体が追い出されたときに
+  索引を作り直し、本体のなくなったエントリを除く
+- 結果は実際に応答したモデル（ヘッジ・切り替え後のモデル）ごとに分けて保存する
+"""
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+from ocr_cache import OCR_CACHE_DIR, OCRResultCache
+
+SHARED_CACHE_DIR = os.path.join(OCR_CACHE_DIR, "shared")
+
+# 一致とみなす距離（64ビット中）
+PHASH_MAX_DISTANCE = 6       # 検索（DCTハッシュ）
+DHASH_MAX_DISTANCE = 10      # 照合（差分ハッシュ）
+ASPECT_TOLERANCE = 0.05      # 照合（縦横比の相対差）
+
+# 内容の照合：明るさ・コントラストを揃えた縮小画像を VERIFY_GRID x VERIFY_GRID のタイルに分け、
+# 全てのタイルの二乗誤差の平均（標準化した画素値で）がこれ以下なら一致
+THUMBNAIL_SIZE = (256, 340)      # 幅, 高さ（本文の1行が数画素になる解像度）
+THUMBNAIL_BLUR_SIGMA = 1.0       # 画素未満の位置ずれで差が大きくならないようにぼかす
+THUMBNAIL_JPEG_QUALITY = 75      # 保存時（1ページ十数KB）
+VERIFY_GRID = 8
+VERIFY_SEARCH_PX = 2             # タイルごとに上下左右この画素数まで位置ずれを探す
+MAX_TILE_DIFFERENCE = 0.1        # 同じページの再圧縮・縮小で 0.05 未満、1行だけ違うページで 0.15 以上
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+def _gray_array(image):
+    return np.asarray(image.convert("L"), dtype=np.float32)
+
+def perceptual_hash(image):
+    """DCTハッシュ（64ビット）：32x32 に縮小した画像の低周波成分が中央値より大きいか"""
+    small = cv2.resize(_gray_array(image), (32, 32), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small)[:8, :8]
+    median = np.median(low.flatten()[1:])  # 直流成分は明るさに左右されるため除く
+    return _bits_to_int(low > median)
+
+def difference_hash(image):
+    """差分ハッシュ（64ビット）：9x8 に縮小した画像で隣り合う画素の大小"""
+    small = cv2.resize(_gray_array(image), (9, 8), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+def content_thumbnail(image):
+    """内容照合用の縮小画像（ぼかしたグレースケール、float32）"""
+    small = cv2.resize(_gray_array(image), THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.GaussianBlur(small, (0, 0), THUMBNAIL_BLUR_SIGMA)
+
+def encode_thumbnail(thumbnail):
+    ok, data = cv2.imencode(".jpg", np.clip(thumbnail, 0, 255).astype(np.uint8),
+                            [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_JPEG_QUALITY])
+    return base64.b64encode(data.tobytes()).decode('ascii') if ok else None
+
+def decode_thumbnail(text):
+    try:
+        data = np.frombuffer(base64.b64decode(text), dtype=np.uint8)
+    except (TypeError, ValueError):
+        return None
+    thumbnail = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+    if thumbnail is None or thumbnail.shape != THUMBNAIL_SIZE[::-1]:
+        return None
+    return thumbnail.astype(np.float32)
+
+def _standardize(thumbnail):
+    return (thumbnail - thumbnail.mean()) / max(float(thumbnail.std()), 1e-6)
+
+def content_difference(stored, thumbnail):
+    """
+    2つの縮小画像のタイルごとの差（小さな位置ずれは探索する）の最大値
+    1行だけ文字が違うページでも、その行を含むタイルの差が大きくなるため一致しない
+    """
+    stored, thumbnail = _standardize(stored), _standardize(thumbnail)
+    height, width = stored.shape
+    m = VERIFY_SEARCH_PX
+    worst = 0.0
+    for row in range(VERIFY_GRID):
+        for col in range(VERIFY_GRID):
+            top, bottom = row * height // VERIFY_GRID, (row + 1) * height // VERIFY_GRID
+            left, right = col * width // VERIFY_GRID, (col + 1) * width // VERIFY_GRID
+            template = stored[top + m:bottom - m, left + m:right - m]
+            search = thumbnail[max(top - m, 0):bottom + m, max(left - m, 0):right + m]
+            difference = float(cv2.matchTemplate(search, template, cv2.TM_SQDIFF).min()) / template.size
+            worst = max(worst, difference)
+    return worst
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    """ハミング距離で近傍検索する BK-tree（ノードは [キー, 値, {距離: 子ノード}]）"""
+
+    def __init__(self, distance=hamming_distance):
+        self._distance = distance
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, value):
+        node = [key, value, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            d = self._distance(key, current[0])
+            child = current[2].get(d)
+            if child is None:
+                current[2][d] = node
+                return
+            current = child
+
+    def search(self, key, max_distance):
+        """距離 max_distance 以内の (距離, 値) を近い順に返す"""
+        if self._root is None:
+            return []
+        results = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = self._distance(key, node[0])
+            if d <= max_distance:
+                results.append((d, node[1]))
+            # 三角不等式により、距離 d±max_distance の子だけをたどればよい
+            for child_distance, child in node[2].items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda item: item[0])
+        return results
+
+class SharedPageCache:
+    """
+    ユーザー間で共有するページ単位のOCR結果
+    namespace（プロンプト版・前処理設定）と応答したモデルの組ごとに別の BK-tree で管理する
+    """
+
+    def __init__(self, directory=SHARED_CACHE_DIR):
+        self.texts = OCRResultCache(directory)
+        self._index_path = os.path.join(directory, "index.jsonl")
+        self._lock = threading.Lock()
+        self._reset()
+        self._lookups = 0
+        self._hits = 0
+        self._rejected = 0
+        self._stores = 0
+        self._compactions = 0
+        with self._lock:
+            self._compact()
+
+    def _reset(self):
+        self._offset = 0
+        self._inode = None
+        self._trees = {}
+        self._keys = set()
+        self._evictions_seen = self.texts.stats()["evictions"]
+
+    def _compact(self):
+        """本体の残っているエントリだけで索引ファイルを書き直し、読み込み直す（ロック内で呼ぶ）"""
+        try:
+            with open(self._index_path, 'rb') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            lines = []
+        kept = []
+        seen = set()
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["key"] in seen or not self.texts.contains(entry["key"]):
+                continue
+            seen.add(entry["key"])
+            kept.append(line + b"\n")
+        if len(kept) < len(lines):
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._index_path), suffix=".tmp")
+                with os.fdopen(fd, 'wb') as f:
+                    f.writelines(kept)
+                os.replace(tmp_path, self._index_path)
+                self._compactions += 1
+            except OSError:
+                pass
+        self._reset()
+        self._refresh()
+
+    def _refresh(self):
+        """索引ファイルに追記された分（他プロセス・他ユーザーの分を含む）を読み込む（ロック内で呼ぶ）"""
+        try:
+            with open(self._index_path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if self._inode is not None and inode != self._inode:
+                    # 他プロセスが索引を書き直した場合は最初から読み直す
+                    self._reset()
+                self._inode = inode
+                f.seek(self._offset)
+                data = f.read()
+        except OSError:
+            return
+        # 書き込み途中の最終行は次回に読む
+        complete = data[:data.rfind(b"\n") + 1]
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["key"] in self._keys:
+                continue
+            self._keys.add(entry["key"])
+            self._trees.setdefault((entry["namespace"], entry.get("model")), BKTree()).add(entry["phash"], entry)
+
+    def lookup(self, image, namespace, model):
+        """model が読み取った似たページのOCR結果があれば返す（照合に通らなければ None）"""
+        phash = perceptual_hash(image)
+        dhash = difference_hash(image)
+        aspect = image.size[0] / image.size[1]
+        with self._lock:
+            self._refresh()
+            tree = self._trees.get((namespace, model))
+            candidates = tree.search(phash, PHASH_MAX_DISTANCE) if tree else []
+            self._lookups += 1
+
+        thumbnail = None
+        for _, entry in candidates:
+            if (hamming_distance(dhash, entry["dhash"]) > DHASH_MAX_DISTANCE
+                    or abs(aspect - entry["aspect"]) > entry["aspect"] * ASPECT_TOLERANCE):
+                with self._lock:
+                    self._rejected += 1
+                continue
+            cached = self.texts.get_entry(entry["key"])
+            if cached is None:
+                continue
+            # 縮小画像のない（照合できない）エントリは使わない
+            stored = decode_thumbnail(cached["metadata"].get("thumbnail") or "")
+            if thumbnail is None:
+                thumbnail = content_thumbnail(image)
+            if stored is None or content_difference(stored, thumbnail) > MAX_TILE_DIFFERENCE:
+                with self._lock:
+                    self._rejected += 1
+                continue
+            with self._lock:
+                self._hits += 1
+            return cached["text"]
+        return None
+
+    def store(self, image, namespace, model, text):
+        """ページのOCR結果を、実際に応答したモデル model の結果として登録"""
+        phash = perceptual_hash(image)
+        dhash = difference_hash(image)
+        key = hashlib.sha256(f"{namespace}:{model}:{phash:016x}:{dhash:016x}".encode('utf-8')).hexdigest()
+        thumbnail = encode_thumbnail(content_thumbnail(image))
+        if thumbnail is None:
+            return
+        self.texts.put(key, text, {"namespace": namespace, "model": model, "thumbnail": thumbnail})
+        entry = {
+            "key": key,
+            "namespace": namespace,
+            "model": model,
+            "phash": phash,
+            "dhash": dhash,
+            "aspect": image.size[0] / image.size[1],
+        }
+        with self._lock:
+            if self.texts.stats()["evictions"] > self._evictions_seen:
+                # 本体が追い出されたら、索引からも除く
+                self._compact()
+            if key in self._keys:
+                return
+            try:
+                with open(self._index_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry) + "\n")
+            except OSError:
+                # キャッシュの書き込み失敗はOCR自体の失敗にはしない
+                return
+            self._stores += 1
+
+    def stats(self):
+        """検索回数・ヒット数（＝省略できたOCR呼び出し数）など（このプロセス内の集計）"""
+        with self._lock:
+            return {
+                "lookups": self._lookups,
+                "hits": self._hits,
+                "saved_calls": self._hits,
+                "rejected": self._rejected,
+                "stores": self._stores,
+                "compactions": self._compactions,
+                "hit_rate": self._hits / self._lookups if self._lookups else 0.0,
+                "entries": sum(len(tree) for tree in self._trees.values()),
+            }
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+import base64
+import datetime
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+import httpx
+import openai
+from dotenv import load_dotenv
+
+from call_metrics import record_token_usage
+from rate_limiter import get_rate_limiter
+from singleflight import SingleFlight
+from token_counter import count_tokens
+
+# 環境変数読み込み
+load_dotenv()
+
+# Gemini API設定
+genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+# 接続プールの設定（プロセス内で使い回し、リクエストごとのTCP/TLS接続を避ける）
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE = 32
+HTTP_KEEPALIVE_EXPIRY = 120  # 秒
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+# 1回の呼び出しのタイムアウト（OpenAIの read は断片の間隔、Gemini はストリーム全体の期限）
+OPENAI_CALL_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+GEMINI_CALL_TIMEOUT_S = 180.0
+
+# Gemini のコンテキストキャッシュ（長いシステムプロンプト＝参考資料をサーバー側に保存して再利用する）
+GEMINI_CACHE_MIN_TOKENS = 32_768         # これより短いプロンプトはキャッシュできない
+GEMINI_CACHE_TTL_S = 60 * 60
+GEMINI_CACHE_RENEW_MARGIN_S = 60         # 期限までこれより短ければ作り直す
+GEMINI_CACHE_IDLE_S = 10 * 60            # これ以上使われていないキャッシュは期限前に削除する
+GEMINI_CACHE_MODELS = {                  # キャッシュには版を固定したモデル名が必要
+    "gemini-1.5-flash-latest": "models/gemini-1.5-flash-002",
+    "gemini-1.5-pro-latest": "models/gemini-1.5-pro-002",
+}
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client(api_key=None):
+    """プロセス全体で共有するOpenAIクライアント（keep-alive接続プール付き）"""
+    http_client = openai.DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=HTTP_TIMEOUT,
+    )
+    return openai.OpenAI(
+        api_key=api_key or os.environ.get("OPENAI_API_KEY"),
+        default_headers={},  # カスタムヘッダーをクリア
+        http_client=http_client,
+        max_retries=0,  # 再試行は resilience で行う（SDK内の再試行と重ねない）
+    )
+
+@functools.lru_cache(maxsize=64)
+def get_gemini_model(model_name, system_instruction=None):
+    """モデル名・システムプロンプトごとに共有するGeminiモデル（gRPC接続はライブラリ側で共有）"""
+    return genai.GenerativeModel(model_name, system_instruction=system_instruction)
+
+# (モデル名, システムプロンプトのハッシュ) → (キャッシュを参照するモデル, 期限, CachedContent)
+_gemini_caches = {}
+_gemini_cache_used = {}                # キー → 最後に使った時刻
+_gemini_cache_failures = {}            # キー → 作成に失敗した時刻（しばらく作り直さない）
+_gemini_cache_lock = threading.Lock()
+_gemini_cache_flight = SingleFlight()
+
+def _gemini_cache_key(model_name, system_instruction):
+    return (model_name, hashlib.sha256(system_instruction.encode('utf-8')).hexdigest())
+
+def _delete_gemini_caches(entries):
+    """サーバー側のキャッシュを削除（保存料金が期限まで掛からないようにする）"""
+    for _, _, cached_content in entries:
+        try:
+            cached_content.delete()
+        except Exception as e:
+            logger.debug("deleting gemini context cache %s failed: %s", cached_content.name, e)
+
+def _prune_gemini_caches():
+    """期限切れのキャッシュを表から外し、しばらく使われていないキャッシュはサーバーからも削除する"""
+    now = time.time()
+    idle = []
+    with _gemini_cache_lock:
+        for key, entry in list(_gemini_caches.items()):
+            if entry[1] <= now:
+                # サーバー側では期限で消えている
+                del _gemini_caches[key]
+            elif now - _gemini_cache_used.get(key, now) > GEMINI_CACHE_IDLE_S:
+                idle.append(_gemini_caches.pop(key))
+            else:
+                continue
+            _gemini_cache_used.pop(key, None)
+        for key, failed_at in list(_gemini_cache_failures.items()):
+            if now - failed_at >= GEMINI_CACHE_TTL_S:
+                del _gemini_cache_failures[key]
+    _delete_gemini_caches(idle)
+
+def _create_gemini_cache(key, model_name, system_instruction):
+    _prune_gemini_caches()
+    cached_content = genai.caching.CachedContent.create(
+        model=GEMINI_CACHE_MODELS[model_name],
+        system_instruction=system_instruction,
+        ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL_S),
+    )
+    entry = (genai.GenerativeModel.from_cached_content(cached_content=cached_content),
+             time.time() + GEMINI_CACHE_TTL_S, cached_content)
+    with _gemini_cache_lock:
+        replaced = _gemini_caches.get(key)
+        _gemini_caches[key] = entry
+        _gemini_cache_used[key] = time.time()
+    if replaced is not None:
+        # 期限が近づいて作り直した古いキャッシュ
+        _delete_gemini_caches([replaced])
+    return entry
+
+def get_gemini_cached_model(model_name, system_instruction):
+    """
+    長いシステムプロンプトをコンテキストキャッシュに置いたGeminiモデル（同じプロンプトなら使い回す）
+    キャッシュできない場合（短い・対応していないモデル・作成に失敗）は None
+    """
+    if model_name not in GEMINI_CACHE_MODELS or count_tokens(system_instruction) < GEMINI_CACHE_MIN_TOKENS:
+        return None
+    key = _gemini_cache_key(model_name, system_instruction)
+    with _gemini_cache_lock:
+        if time.time() - _gemini_cache_failures.get(key, float("-inf")) < GEMINI_CACHE_TTL_S:
+            return None
+        entry = _gemini_caches.get(key)
+        if entry is not None:
+            _gemini_cache_used[key] = time.time()
+    if entry is None or entry[1] - time.time() < GEMINI_CACHE_RENEW_MARGIN_S:
+        try:
+            # 同じプロンプトのキャッシュを同時に複数作らない
+            entry = _gemini_cache_flight.do(key, _create_gemini_cache, key, model_name, system_instruction)
+        except Exception as e:
+            logger.warning("gemini context cache for %s unavailable: %s", model_name, e)
+            with _gemini_cache_lock:
+                _gemini_cache_failures[key] = time.time()
+            return None
+    return entry[0]
+
+def release_gemini_cache(model_name, system_instruction):
+    """参考資料が編集されて使わなくなったシステムプロンプトのキャッシュを、期限を待たずに削除する"""
+    key = _gemini_cache_key(model_name, system_instruction)
+    with _gemini_cache_lock:
+        entry = _gemini_caches.pop(key, None)
+        _gemini_cache_used.pop(key, None)
+    if entry is not None:
+        _delete_gemini_caches([entry])
+
+class Provider:
+    """LLMプロバイダの共通インターフェース"""
+
+    name = ""
+
+    def stream(self, model, system_prompt, user_text, images=(), max_tokens=3000, history=(), on_open=None):
+        """
+        テキスト断片を順に返すイテレータ
+        images は {"data": bytes, "mime_type": str, "detail": str} のリスト
+        history は user_text より前の会話 [{"role": "user" | "assistant", "content": str}]
+        on_open(close) は応答を開いた時点で、別スレッドから応答を閉じる関数を渡して呼ばれる
+        （最初の断片を待っている間でも打ち切れるようにするため）
+        """
+        raise NotImplementedError
+
+    def complete(self, model, system_prompt, user_text, images=(), max_tokens=3000, history=()):
+        """全文を一度に取得"""
+        return "".join(self.stream(model, system_prompt, user_text, images, max_tokens, history))
+
+class OpenAIProvider(Provider):
+    name = "openai"
+
+    def stream(self, model, system_prompt, user_text, images=(), max_tokens=3000, history=(), on_open=None):
+        if images:
+            content = [{"type": "text", "text": user_text}]
+            for image in images:
+                image_base64 = base64.b64encode(image["data"]).decode('utf-8')
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{image['mime_type']};base64,{image_base64}",
+                        "detail": image.get("detail", "high")
+                    }
+                })
+        else:
+            content = user_text
+
+        raw_response = get_openai_client().chat.completions.with_raw_response.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                *({"role": m["role"], "content": m["content"]} for m in history),
+                {"role": "user", "content": content}
+            ],
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=OPENAI_CALL_TIMEOUT,
+        )
+        # レート制限の残量・解除時刻をヘッダーから取り込む
+        get_rate_limiter().observe_headers(self.name, model, raw_response.headers)
+        stream = raw_response.parse()
+        if on_open:
+            on_open(stream.close)
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if chunk.usage:
+                # 最後の断片に使用量が付く（1024トークン以上の共通の先頭部分は自動でキャッシュされる）
+                details = chunk.usage.prompt_tokens_details
+                record_token_usage(self.name, model, chunk.usage.prompt_tokens,
+                                   (details.cached_tokens or 0) if details else 0, chunk.usage.completion_tokens)
+
+def _gemini_chunk_text(chunk):
+    """
+    Gemini の断片のテキスト（chunk.text はテキストのない断片で ValueError になるため、parts から読む）
+    安全性フィルタで止められた断片・使用量だけの最後の断片は空文字
+    """
+    if not chunk.candidates:
+        return ""
+    content = chunk.candidates[0].content
+    return "".join(getattr(part, "text", "") or "" for part in (content.parts if content else ()))
+
+def _open_gemini_stream(gemini_model, contents, generation_config, timeout):
+    """
+    generate_content(stream=True) と同じ手順でストリームを開き、応答の断片（proto）のイテレータを返す
+    generate_content は最初の断片が届くまで戻らないため、その前に cancel() できる呼び出しを直接受け取る
+    （SDK の内部を使うため、requirements.txt で google-generativeai の版を固定している）
+    """
+    request = gemini_model._prepare_request(
+        contents=contents, generation_config=generation_config, tools=None, tool_config=None
+    )
+    if gemini_model._client is None:
+        gemini_model._client = genai_client.get_default_generative_client()
+    return gemini_model._client.stream_generate_content(request, timeout=timeout)
+
+class GeminiProvider(Provider):
+    name = "gemini"
+
+    def stream(self, model, system_prompt, user_text, images=(), max_tokens=3000, history=(), on_open=None):
+        parts = [user_text]
+        for image in images:
+            parts.append({'mime_type': image["mime_type"], 'data': image["data"]})
+        # Gemini の役割名は user / model
+        contents = [
+            {"role": "model" if m["role"] == "assistant" else "user", "parts": [m["content"]]}
+            for m in history
+        ]
+        contents.append({"role": "user", "parts": parts})
+
+        gemini_model = get_gemini_cached_model(model, system_prompt) or get_gemini_model(model, system_prompt)
+        response = _open_gemini_stream(
+            gemini_model, contents, {"max_output_tokens": max_tokens}, GEMINI_CALL_TIMEOUT_S
+        )
+        if on_open:
+            on_open(response.cancel)
+        usage = None
+        for chunk in response:
+            if chunk.usage_metadata:
+                usage = chunk.usage_metadata
+            text = _gemini_chunk_text(chunk)
+            if text:
+                yield text
+        if usage is not None:
+            record_token_usage(self.name, model, usage.prompt_token_count,
+                               usage.cached_content_token_count, usage.candidates_token_count)
+
+_PROVIDERS = {
+    "openai": OpenAIProvider(),
+    "gemini": GeminiProvider(),
+}
+
+def get_provider(model):
+    """モデル名から担当するプロバイダを取得"""
+    return _PROVIDERS["gemini" if model.startswith("gemini") else "openai"]
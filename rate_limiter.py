@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+プロバイダ・モデルごとのレート制限（トークンバケット）
+
+- リクエスト数（RPM）とトークン数（TPM）の2つのバケットから、送信前に見積もった量を取り出す
+- 足りなければ先着順に待たせ（待ち時間の上限つき）、429 を起こさずに上限付近の流量を保つ
+- 応答ヘッダー（x-ratelimit-*・retry-after）から残量・上限・解除時刻を取り込み、見積もりのずれを補正する
+- バケットはプロセス内（既定）か、RATE_LIMIT_DB を指定した場合は SQLite で複数プロセス間で共有する
+"""
+import collections
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# モデルごとの上限（1分あたり）。RATE_LIMITS（JSON）で上書きできる
+DEFAULT_RATE_LIMITS = {
+    "gpt-4o": {"rpm": 500, "tpm": 30_000},
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200_000},
+    "gemini-1.5-pro-latest": {"rpm": 1000, "tpm": 4_000_000},
+    "gemini-1.5-flash-latest": {"rpm": 2000, "tpm": 4_000_000},
+}
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB")
+RATE_LIMIT_MAX_WAIT_S = 60.0          # これ以上待つ見込みなら諦める
+RATE_LIMIT_DEFAULT_PENALTY_S = 10.0   # 429 に retry-after がない場合に止める時間
+
+# 送信前のトークン数の見積もり
+BYTES_PER_TOKEN = 3                   # UTF-8で日本語1文字（3バイト）≒ 1トークン、英語は約4文字で1トークン
+DEFAULT_IMAGE_TOKENS = 765            # 画像のトークン数が分からない場合（detail=high の 512px タイル2枚分相当）
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+class RateLimitTimeout(Exception):
+    """待ち時間の上限までに送信できない（429 と同様に別プロバイダへの切り替え対象）"""
+    status_code = 429
+
+def estimate_request_tokens(system_prompt, user_text, images=(), max_tokens=0, history=()):
+    """リクエストのトークン数を送信前に見積もる（出力の上限も上限計算に含まれるため加える）"""
+    text_bytes = sum(len(text.encode('utf-8')) for text in (system_prompt, user_text, *(m["content"] for m in history)))
+    image_tokens = 0
+    for image in images:
+        if "tokens" in image:
+            image_tokens += image["tokens"]
+        elif image.get("detail") == "low":
+            image_tokens += LOW_DETAIL_IMAGE_TOKENS
+        else:
+            image_tokens += DEFAULT_IMAGE_TOKENS
+    return text_bytes // BYTES_PER_TOKEN + image_tokens + max_tokens
+
+def parse_reset_duration(value):
+    """"1s" / "6m0s" / "20ms" 形式の解除までの時間を秒に変換"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def _refill(state, capacity, rate, now):
+    level, updated, blocked_until = state
+    return min(capacity, level + (now - updated) * rate), now, blocked_until
+
+def _try_take(states, specs, now):
+    """
+    全てのバケットから同時に取り出せるか判定（取り出せなければどのバケットも減らさない）
+    specs: [(名前, 容量, 1秒あたりの補充量, 取り出す量)]
+    戻り値: (更新後の状態, 待つべき秒数（0なら取り出し済み）)
+    """
+    new_states = {}
+    wait = 0.0
+    for name, capacity, rate, amount in specs:
+        level, updated, blocked_until = _refill(states.get(name, (capacity, now, 0.0)), capacity, rate, now)
+        amount = min(amount, capacity)  # 容量を超える要求は満タンになれば通す
+        if blocked_until > now:
+            wait = max(wait, blocked_until - now)
+        if level < amount:
+            wait = max(wait, (amount - level) / rate)
+        new_states[name] = (level - amount, updated, blocked_until)
+    return new_states, wait
+
+class MemoryBucketStore:
+    """プロセス内のバケット"""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def take(self, specs, now):
+        with self._lock:
+            new_states, wait = _try_take(self._states, specs, now)
+            if wait == 0:
+                self._states.update(new_states)
+            return wait
+
+    def update(self, name, capacity, rate, now, level=None, blocked_until=None):
+        with self._lock:
+            state = _refill(self._states.get(name, (capacity, now, 0.0)), capacity, rate, now)
+            self._states[name] = (
+                state[0] if level is None else level,
+                now,
+                state[2] if blocked_until is None else max(state[2], blocked_until),
+            )
+
+class SQLiteBucketStore:
+    """SQLiteファイルに保存するバケット（同じマシンの複数プロセスで共有）"""
+
+    def __init__(self, path):
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "name TEXT PRIMARY KEY, level REAL, updated REAL, blocked_until REAL)"
+            )
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def _transaction(self, names, func):
+        conn = self._connect()
+        try:
+            # 読み取りから書き込みまでを他プロセスと排他にする
+            conn.execute("BEGIN IMMEDIATE")
+            placeholders = ",".join("?" * len(names))
+            rows = conn.execute(
+                f"SELECT name, level, updated, blocked_until FROM buckets WHERE name IN ({placeholders})", names
+            ).fetchall()
+            states = {row[0]: tuple(row[1:]) for row in rows}
+            new_states, result = func(states)
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (name, level, updated, blocked_until) VALUES (?, ?, ?, ?)",
+                [(name, *state) for name, state in new_states.items()]
+            )
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def take(self, specs, now):
+        def take_all(states):
+            new_states, wait = _try_take(states, specs, now)
+            return (new_states if wait == 0 else {}), wait
+        return self._transaction([spec[0] for spec in specs], take_all)
+
+    def update(self, name, capacity, rate, now, level=None, blocked_until=None):
+        def update_one(states):
+            state = _refill(states.get(name, (capacity, now, 0.0)), capacity, rate, now)
+            return {name: (
+                state[0] if level is None else level,
+                now,
+                state[2] if blocked_until is None else max(state[2], blocked_until),
+            )}, None
+        self._transaction([name], update_one)
+
+class RateLimiter:
+    """プロバイダ・モデルごとに RPM・TPM のバケットを持ち、先着順に送信を許可する"""
+
+    def __init__(self, limits=None, store=None, max_wait=RATE_LIMIT_MAX_WAIT_S):
+        self.limits = {model: dict(limit) for model, limit in (limits or DEFAULT_RATE_LIMITS).items()}
+        self.store = store or MemoryBucketStore()
+        self.max_wait = max_wait
+        self._queues = collections.defaultdict(collections.deque)
+        self._cond = threading.Condition()
+        self._stats = {"acquired": 0, "waited": 0, "wait_s": 0.0, "timeouts": 0, "cancelled": 0, "penalties": 0}
+
+    def _specs(self, provider, model, tokens):
+        limit = self.limits[model]
+        return [
+            (f"{provider}:{model}:requests", limit["rpm"], limit["rpm"] / 60, 1),
+            (f"{provider}:{model}:tokens", limit["tpm"], limit["tpm"] / 60, tokens),
+        ]
+
+    def queue_length(self, model):
+        """モデルの送信待ちの数（このプロセス内）"""
+        with self._cond:
+            return sum(len(queue) for (_, queued_model), queue in self._queues.items() if queued_model == model)
+
+    def acquire(self, provider, model, tokens, on_queue=None, cancelled=None):
+        """
+        送信枠を確保するまで待つ（先着順）。確保できたら True
+        on_queue(順番) で待ち順を通知し、確保できたら on_queue(0) を呼ぶ
+        cancelled（threading.Event）が立ったら枠を取らずに待つのをやめて False を返す
+        待ち時間の上限を超える見込みなら RateLimitTimeout
+        """
+        if model not in self.limits:
+            return True
+        key = (provider, model)
+        ticket = object()
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        specs = self._specs(provider, model, tokens)
+        waited = False
+
+        with self._cond:
+            queue = self._queues[key]
+            queue.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    # 自分の番（先頭）になるまで待つ
+                    while queue[0] is not ticket:
+                        if cancelled is not None and cancelled.is_set():
+                            self._stats["cancelled"] += 1
+                            return False
+                        waited = True
+                        if on_queue:
+                            on_queue(queue.index(ticket) + 1)
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise RateLimitTimeout(f"{model} の送信待ちが {self.max_wait:.0f}秒を超えました")
+                        self._cond.wait(min(remaining, 1.0))
+
+                if cancelled is not None and cancelled.is_set():
+                    with self._cond:
+                        self._stats["cancelled"] += 1
+                    return False
+                wait = self.store.take(specs, time.time())
+                if wait == 0:
+                    break
+                if time.monotonic() + wait > deadline:
+                    raise RateLimitTimeout(f"{model} の送信枠が {wait:.0f}秒後まで空きません")
+                waited = True
+                if on_queue:
+                    on_queue(1)
+                if cancelled is not None:
+                    cancelled.wait(min(wait, 1.0))
+                else:
+                    time.sleep(min(wait, 1.0))
+        except RateLimitTimeout:
+            with self._cond:
+                self._stats["timeouts"] += 1
+            raise
+        finally:
+            with self._cond:
+                queue.remove(ticket)
+                self._cond.notify_all()
+
+        if on_queue:
+            on_queue(0)
+        with self._cond:
+            self._stats["acquired"] += 1
+            if waited:
+                self._stats["waited"] += 1
+                self._stats["wait_s"] += time.monotonic() - start
+        return True
+
+    def observe_headers(self, provider, model, headers):
+        """応答ヘッダー（x-ratelimit-*）から上限・残量・解除時刻を取り込む"""
+        if model not in self.limits or headers is None:
+            return
+        now = time.time()
+        for kind, limit_key in (("requests", "rpm"), ("tokens", "tpm")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            if limit:
+                try:
+                    self.limits[model][limit_key] = int(limit)
+                except ValueError:
+                    pass
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            try:
+                remaining = float(remaining)
+            except ValueError:
+                continue
+            capacity = self.limits[model][limit_key]
+            reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            self.store.update(
+                f"{provider}:{model}:{kind}", capacity, capacity / 60, now,
+                level=remaining,
+                blocked_until=now + reset if remaining <= 0 and reset else None,
+            )
+
+    def penalize(self, provider, model, retry_after=None):
+        """429 を受けたら retry-after（なければ既定の時間）の間、送信を止める"""
+        if model not in self.limits:
+            return
+        now = time.time()
+        until = now + (retry_after if retry_after is not None else RATE_LIMIT_DEFAULT_PENALTY_S)
+        for kind, limit_key in (("requests", "rpm"), ("tokens", "tpm")):
+            capacity = self.limits[model][limit_key]
+            self.store.update(f"{provider}:{model}:{kind}", capacity, capacity / 60, now, blocked_until=until)
+        with self._cond:
+            self._stats["penalties"] += 1
+
+    def stats(self):
+        """送信許可数・待った回数と合計時間・諦めた回数・429による停止回数"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queued"] = sum(len(queue) for queue in self._queues.values())
+        return stats
+
+def retry_after_seconds(error):
+    """429 の例外から retry-after（秒）を取り出す（なければ None）"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    return parse_reset_duration(headers.get("retry-after"))
+
+def _load_limits():
+    limits = dict(DEFAULT_RATE_LIMITS)
+    override = os.getenv("RATE_LIMITS")
+    if override:
+        limits.update(json.loads(override))
+    return limits
+
+@functools.lru_cache(maxsize=None)
+def get_rate_limiter():
+    """プロセス全体で共有するレート制限（RATE_LIMIT_DB があれば SQLite でプロセス間でも共有）"""
+    store = SQLiteBucketStore(RATE_LIMIT_DB) if RATE_LIMIT_DB else None
+    return RateLimiter(_load_limits(), store)
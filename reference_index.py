@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+参考資料（OCR結果の latex_code）の検索インデックス（BM25、NumPyのみ・ネットワーク不要）
+
+- 見出し（\\section・Markdownの #）・ページ区切り・空行で段落に分け、ディスプレイ数式は単独のチャンクにする
+- 語は英数字の単語・LaTeXのコマンド・日本語の文字バイグラム（分かち書きが不要）
+- 編集されたら分け直し、内容の変わらないブロック・チャンクはトークン数と語の数え上げを使い回す（変わった部分だけ数え直す）
+- 語の出現は語ごとの転置リスト（CSR 形式の NumPy 配列）で持ち、メモリは出現数に比例する（チャンク数 × 語彙数にならない）
+- 質問ごとに BM25 の上位 k 件のチャンクをトークン予算内で選び、文書の順に並べて返す
+"""
+import hashlib
+import re
+from collections import Counter
+
+import numpy as np
+
+from token_counter import count_tokens
+
+CHUNK_MAX_TOKENS = 400          # 段落をまとめる上限（これより長い段落はそのまま1チャンク）
+VOCAB_REBUILD_RATIO = 2         # 語彙が使われている語のこの倍を超えたら、語彙と数え上げを作り直す
+RETRIEVAL_TOP_K = 8             # 1回の質問で送るチャンクの数の上限
+BM25_K1 = 1.5
+BM25_B = 0.75
+CHUNK_SEPARATOR = "\n\n…\n\n"   # 選んだチャンクの間（連続しない部分の区切り）
+
+_HEADING = re.compile(r"^\s*(\\(?:sub)*section\*?\{.*\}|#{1,6}\s+\S.*)$")
+_PAGE_BREAK = re.compile(r"^\s*---+\s*$")
+_DISPLAY_MATH = re.compile(
+    r"(\$\$.+?\$\$|\\\[.+?\\\]|\\begin\{(equation|align|gather|multline|eqnarray)\*?\}.+?\\end\{\2\*?\})",
+    re.DOTALL,
+)
+_TERM = re.compile(r"\\[A-Za-z]+|[A-Za-z0-9]+|[\u3040-\u30ff\u3400-\u9fff]+")
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u9fff]")
+
+def tokenize(text):
+    """検索用の語の一覧（英数字は小文字の単語、日本語は文字バイグラム）"""
+    terms = []
+    for match in _TERM.finditer(text):
+        word = match.group()
+        if _CJK.match(word):
+            terms.extend(word[i:i + 2] for i in range(max(1, len(word) - 1)))
+        else:
+            terms.append(word.lower())
+    return terms
+
+def _blocks(text):
+    """見出し・ページ区切り・空行・ディスプレイ数式で分けたブロック [(見出し, 本文, 数式か)]"""
+    blocks = []
+    heading = ""
+    paragraph = []
+
+    def flush():
+        body = "\n".join(paragraph).strip()
+        paragraph.clear()
+        if not body:
+            return
+        # 段落中のディスプレイ数式は前後の文章と分ける
+        position = 0
+        for match in _DISPLAY_MATH.finditer(body):
+            before = body[position:match.start()].strip()
+            if before:
+                blocks.append((heading, before, False))
+            blocks.append((heading, match.group().strip(), True))
+            position = match.end()
+        rest = body[position:].strip()
+        if rest:
+            blocks.append((heading, rest, False))
+
+    in_math = False
+    for line in text.splitlines():
+        # ディスプレイ数式の途中の空行では区切らない
+        if line.count("$$") % 2:
+            in_math = not in_math
+        if in_math:
+            paragraph.append(line)
+            continue
+        if _HEADING.match(line) or _PAGE_BREAK.match(line):
+            flush()
+            if _HEADING.match(line):
+                heading = line.strip()
+            continue
+        if not line.strip():
+            flush()
+            continue
+        paragraph.append(line)
+    flush()
+    return blocks
+
+def chunk_reference(text, count=count_tokens):
+    """
+    参考資料をチャンクに分ける（同じ見出しの短い段落は CHUNK_MAX_TOKENS までまとめる）
+    count: ブロックのトークン数を数える関数（ReferenceIndex はハッシュごとに使い回す）
+    戻り値: [{"heading", "text", "tokens"}]（文書の順）
+    """
+    chunks = []
+    for heading, body, is_math in _blocks(text):
+        tokens = count(body)
+        last = chunks[-1] if chunks else None
+        if (last is not None and not is_math and not last["math"] and last["heading"] == heading
+                and last["tokens"] + tokens <= CHUNK_MAX_TOKENS):
+            last["text"] += "\n\n" + body
+            last["tokens"] += tokens
+        else:
+            chunks.append({"heading": heading, "text": body, "tokens": tokens, "math": is_math})
+    for chunk in chunks:
+        del chunk["math"]
+    return chunks
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+_EMPTY_IDS = np.zeros(0, dtype=np.int32)
+_EMPTY_COUNTS = np.zeros(0, dtype=np.float32)
+
+class ReferenceIndex:
+    """参考資料1件の BM25 インデックス（セッションごとに保持し、編集のたびに update する）"""
+
+    def __init__(self):
+        self.digest = None
+        self.chunks = []
+        self._token_counts = {}    # テキストのハッシュ → トークン数（ブロック・見出し）
+        self._term_counts = {}     # チャンク（見出し＋本文）のハッシュ → (語の番号, 出現数) の配列
+        self._vocab = {}           # 語 → 番号（作り直すまで番号は変えない）
+        # 語ごとの転置リスト（CSR）：語 t の出現は _rows / _tf の [_indptr[t], _indptr[t + 1]) の範囲
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._rows = _EMPTY_IDS
+        self._tf = _EMPTY_COUNTS
+        self._idf = _EMPTY_COUNTS
+        self._lengths = _EMPTY_COUNTS
+        self.stats = {"builds": 0, "chunks_reused": 0, "chunks_counted": 0, "vocab_rebuilds": 0}
+
+    def _count_tokens(self, text, token_counts):
+        key = _digest(text)
+        tokens = self._token_counts.get(key)
+        if tokens is None:
+            tokens = count_tokens(text)
+        token_counts[key] = tokens
+        return tokens
+
+    def _terms(self, chunk):
+        """チャンクの (語の番号, 出現数)（見出しの語も本文の一部として数え、節の題名で検索できるようにする）"""
+        counts = Counter(tokenize(chunk["heading"]) + tokenize(chunk["text"]))
+        if not counts:
+            return _EMPTY_IDS, _EMPTY_COUNTS
+        ids = np.fromiter((self._vocab.setdefault(term, len(self._vocab)) for term in counts),
+                          dtype=np.int32, count=len(counts))
+        return ids, np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+
+    def update(self, text):
+        """参考資料が変わっていれば索引を作り直す（変わっていないブロック・チャンクの数え上げは使い回す）"""
+        text = text or ""
+        digest = _digest(text)
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        token_counts = {}
+        self.chunks = chunk_reference(text, count=lambda body: self._count_tokens(body, token_counts))
+        separator_tokens = count_tokens(CHUNK_SEPARATOR)
+        for chunk in self.chunks:
+            # 抜粋に入れたときの量（見出し・区切りを含む）
+            chunk["cost"] = chunk["tokens"] + self._count_tokens(chunk["heading"], token_counts) + separator_tokens
+        self._token_counts = token_counts
+        self.stats["builds"] += 1
+
+        keys = [_digest(chunk["heading"] + "\n" + chunk["text"]) for chunk in self.chunks]
+        live_terms = sum(len(self._term_counts[key][0]) for key in set(keys) if key in self._term_counts)
+        if len(self._vocab) > VOCAB_REBUILD_RATIO * max(live_terms, 1) + 1000:
+            # 編集で使われなくなった語が溜まったら、語彙から作り直す
+            self._vocab = {}
+            self._term_counts = {}
+            self.stats["vocab_rebuilds"] += 1
+
+        term_counts = {}
+        postings = []
+        for key, chunk in zip(keys, self.chunks):
+            if key in self._term_counts:
+                self.stats["chunks_reused"] += 1
+                term_counts[key] = self._term_counts[key]
+            elif key not in term_counts:
+                self.stats["chunks_counted"] += 1
+                term_counts[key] = self._terms(chunk)
+            postings.append(term_counts[key])
+        self._term_counts = term_counts
+
+        # 語の番号順に並べ替えて CSR にする
+        sizes = np.array([len(ids) for ids, _ in postings], dtype=np.int64)
+        rows = np.repeat(np.arange(len(postings), dtype=np.int32), sizes)
+        terms = np.concatenate([ids for ids, _ in postings]) if postings else _EMPTY_IDS
+        tf = np.concatenate([counts for _, counts in postings]) if postings else _EMPTY_COUNTS
+        order = np.argsort(terms, kind="stable")
+        self._rows = rows[order]
+        self._tf = tf[order]
+        document_frequency = np.bincount(terms, minlength=len(self._vocab))
+        self._indptr = np.concatenate([[0], np.cumsum(document_frequency)])
+        self._lengths = np.array([counts.sum() for _, counts in postings], dtype=np.float32)
+        n = len(postings)
+        self._idf = np.log1p((n - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+        return True
+
+    def scores(self, query):
+        """各チャンクの BM25 スコア"""
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        columns = [self._vocab[term] for term in set(tokenize(query)) if term in self._vocab]
+        if not columns or not self.chunks:
+            return scores
+        average_length = max(float(self._lengths.mean()), 1.0)
+        for column in columns:
+            start, end = self._indptr[column], self._indptr[column + 1]
+            if start == end:
+                continue
+            rows = self._rows[start:end]
+            tf = self._tf[start:end]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[rows] / average_length)
+            # 1つの語の転置リストには同じチャンクは1回しか現れない
+            scores[rows] += self._idf[column] * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def memory_bytes(self):
+        """転置リストの配列のバイト数"""
+        return sum(array.nbytes for array in (self._indptr, self._rows, self._tf, self._idf, self._lengths))
+
+    def retrieve(self, query, max_tokens, top_k=RETRIEVAL_TOP_K):
+        """
+        質問に関係の深いチャンクを予算内で top_k 件まで選ぶ（スコアが0のチャンクは選ばない）
+        戻り値: (文書の順に並べたテキスト, 選んだチャンクの番号)
+        """
+        scores = self.scores(query)
+        selected = []
+        used = 0
+        for i in np.argsort(-scores, kind="stable"):
+            if scores[i] <= 0 or len(selected) >= top_k:
+                break
+            tokens = self.chunks[i]["cost"]
+            if used + tokens > max_tokens:
+                continue
+            selected.append(int(i))
+            used += tokens
+        selected.sort()
+        # 各チャンクに見出しを付けて、どの節の内容か分かるようにする
+        parts = []
+        for i in selected:
+            chunk = self.chunks[i]
+            parts.append(f"{chunk['heading']}\n{chunk['text']}" if chunk["heading"] else chunk["text"])
+        return CHUNK_SEPARATOR.join(parts), selected
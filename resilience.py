@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+外部API呼び出しの再試行とサーキットブレーカー（OpenAI・Gemini・Stripe で共有）
+
+- 一時的なエラー（429・408・5xx・接続断・タイムアウト）はジッター付きの指数バックオフで再試行する
+- 障害とみなすエラー（5xx・接続断・タイムアウト）が続いたサービスは一定時間呼び出さずに即座に失敗させ、
+  その後は1件ずつ試しに通して（半開）回復を確かめる（それ以外のエラーは連続障害の回数を変えない）
+- ストリームは最初の断片を返す前の失敗だけ再試行する（途中まで表示した内容を重複させない）
+"""
+import random
+import threading
+import time
+from collections import defaultdict
+
+from rate_limiter import retry_after_seconds
+
+RETRY_ATTEMPTS = 3                # 最初の1回を含む試行回数
+RETRY_BASE_DELAY_S = 0.5
+RETRY_MAX_DELAY_S = 8.0
+BREAKER_FAILURE_THRESHOLD = 5     # 連続でこの回数障害が起きたら遮断する
+BREAKER_RECOVERY_S = 30.0         # 遮断してから試しに通すまでの時間
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+class CircuitOpenError(Exception):
+    """サービスが遮断中のため呼び出さずに失敗した（別プロバイダへの切り替え対象）"""
+    status_code = 503
+
+def error_status_code(error):
+    """例外からHTTPステータスコードを取り出す（OpenAI: status_code / Google: code / Stripe: http_status）"""
+    for attr in ("status_code", "code", "http_status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+def _is_connection_error(error):
+    return (
+        isinstance(error, (TimeoutError, ConnectionError))
+        or type(error).__name__ in (
+            "APIConnectionError", "APITimeoutError", "DeadlineExceeded", "ServiceUnavailable",
+            "TimeoutException", "ConnectError", "ReadTimeout",
+        )
+    )
+
+def is_retryable(error):
+    """再試行すれば成功しうるエラーか"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    status = error_status_code(error)
+    if status is not None:
+        return status in (408, 429) or status >= 500
+    return _is_connection_error(error)
+
+def is_outage(error):
+    """サービス側の障害とみなすエラーか（429 や 4xx はサービスが応答しているので含めない）"""
+    status = error_status_code(error)
+    if status is not None:
+        return status >= 500
+    return _is_connection_error(error)
+
+def backoff_delay(attempt, retry_after=None):
+    """attempt 回目の失敗の後に待つ秒数（full jitter、retry-after があればそれ以上待つ）"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RETRY_MAX_DELAY_S))
+    return delay
+
+class CircuitBreaker:
+    """1つのサービスのサーキットブレーカー（閉 → 開 → 半開 → 閉）"""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, recovery_s=BREAKER_RECOVERY_S):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_s = recovery_s
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._stats = {"calls": 0, "rejected": 0, "failures": 0, "opened": 0}
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """呼び出してよいか判定（遮断中なら CircuitOpenError、半開なら1件だけ通す）"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.recovery_s:
+                self.state = HALF_OPEN
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+                self._stats["rejected"] += 1
+                remaining = max(0.0, self.recovery_s - (time.monotonic() - self.opened_at))
+                raise CircuitOpenError(f"{self.name} は障害のため遮断中です（約{remaining:.0f}秒後に再試行）")
+            if self.state == HALF_OPEN:
+                self._probing = True
+            self._stats["calls"] += 1
+
+    def check(self):
+        """遮断中（まだ試しに通す時刻でない）なら CircuitOpenError（半開の試行枠は使わない）"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at < self.recovery_s:
+                self._stats["rejected"] += 1
+                remaining = self.recovery_s - (time.monotonic() - self.opened_at)
+                raise CircuitOpenError(f"{self.name} は障害のため遮断中です（約{remaining:.0f}秒後に再試行）")
+
+    def record(self, error=None, finished=True):
+        """
+        呼び出しの結果を記録（error が None なら成功）
+        障害でないエラー（打ち切りによる 499・4xx）は成功とも障害とも数えない
+        （障害中にヘッジで打ち切った呼び出しが、連続障害の回数を戻さないようにする）
+        finished=False は結果が分からないまま打ち切った場合（半開の試行枠だけ返す）
+        """
+        with self._lock:
+            was_probe = self._probing
+            self._probing = False
+            if not finished:
+                return
+            if error is not None and is_outage(error):
+                self._stats["failures"] += 1
+                self.failures += 1
+                if was_probe or self.failures >= self.failure_threshold:
+                    if self.state != OPEN:
+                        self._stats["opened"] += 1
+                    self.state = OPEN
+                    self.opened_at = time.monotonic()
+            elif error is None:
+                self.failures = 0
+                self.state = CLOSED
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures, **self._stats}
+
+_breakers = {}
+_retry_counts = defaultdict(int)
+_registry_lock = threading.Lock()
+
+def get_breaker(name):
+    """サービス名ごとに共有するサーキットブレーカー（プロセス全体）"""
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+def _count_retry(name):
+    with _registry_lock:
+        _retry_counts[name] += 1
+
+def resilience_stats():
+    """サービスごとのブレーカーの状態と再試行回数"""
+    with _registry_lock:
+        breakers = dict(_breakers)
+        retries = dict(_retry_counts)
+    return {
+        name: {**breaker.snapshot(), "retries": retries.get(name, 0)}
+        for name, breaker in breakers.items()
+    }
+
+def call_with_retry(name, func, *args, attempts=RETRY_ATTEMPTS, **kwargs):
+    """サーキットブレーカーを通して func を呼び、一時的なエラーは待ってから再試行する"""
+    breaker = get_breaker(name)
+    for attempt in range(1, attempts + 1):
+        breaker.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            breaker.record(e)
+            if attempt == attempts or not is_retryable(e):
+                raise
+            _count_retry(name)
+            time.sleep(backoff_delay(attempt, retry_after_seconds(e)))
+            continue
+        breaker.record()
+        return result
+
+def retry_stream(name, open_stream, attempts=RETRY_ATTEMPTS, retryable=is_retryable):
+    """
+    open_stream() が返すストリームをサーキットブレーカーを通して流す
+    最初の断片を返す前の一時的なエラーだけ再試行する
+    """
+    breaker = get_breaker(name)
+    for attempt in range(1, attempts + 1):
+        breaker.before_call()
+        started = False
+        finished = False
+        try:
+            for chunk in open_stream():
+                started = True
+                yield chunk
+            finished = True
+            breaker.record()
+            return
+        except Exception as e:
+            finished = True
+            breaker.record(e)
+            if started or attempt == attempts or not retryable(e):
+                raise
+            _count_retry(name)
+            time.sleep(backoff_delay(attempt, retry_after_seconds(e)))
+        finally:
+            if not finished:
+                # 途中で読むのをやめた（ヘッジで打ち切られたなど）
+                breaker.record(finished=False)
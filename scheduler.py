@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+プラン別の重み付き公平スケジューリング（全てのプロバイダ呼び出しの手前で使う）
+
+- モデルごとに同時実行数の上限を設け、空いた枠をプラン間の重み付き公平キューイングで割り当てる
+  （プランごとの仮想時刻が最も小さいプランから出し、1件出すごとに 1/重み 進める）
+- 同じプランの中では利用者ごとのラウンドロビンで、1人の大量のリクエストが他の利用者を待たせない
+- 待ち時間が STARVATION_S を超えたリクエストはプランに関係なく先に出す（飢餓防止）
+- 呼び出し元（プラン・利用者）はジョブの開始時に caller_context で設定し、
+  ワーカースレッドへは contextvars のコピーで引き継ぐ
+"""
+import collections
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+from call_metrics import percentile
+
+# プランごとの重み（空き枠を割り当てる比率）
+PLAN_WEIGHTS = {"premium": 4, "free": 1}
+DEFAULT_PLAN = "free"
+
+# モデルごとの同時実行数の上限。MODEL_CONCURRENCY（JSON）で上書きできる
+DEFAULT_MODEL_CONCURRENCY = {
+    "gpt-4o": 8,
+    "gpt-4o-mini": 16,
+    "gemini-1.5-pro-latest": 8,
+    "gemini-1.5-flash-latest": 16,
+}
+DEFAULT_CONCURRENCY = 8        # 上記にないモデル
+STARVATION_S = 30.0            # これ以上待ったリクエストは重みに関係なく先に出す
+SCHEDULER_MAX_WAIT_S = 120.0   # これ以上待ったら諦める
+QUEUE_LATENCY_SAMPLES = 500    # プランごとに保持する待ち時間の記録数
+
+_caller = contextvars.ContextVar("caller", default=(DEFAULT_PLAN, None))
+
+class SchedulerTimeout(TimeoutError):
+    """待ち時間の上限までに実行枠が空かない（別プロバイダへの切り替え対象）"""
+
+@contextlib.contextmanager
+def caller_context(plan, user):
+    """この中（とコピーした contextvars）から行う呼び出しのプラン・利用者を設定"""
+    token = _caller.set((plan or DEFAULT_PLAN, user))
+    try:
+        yield
+    finally:
+        _caller.reset(token)
+
+def current_caller():
+    """現在の呼び出し元 (プラン, 利用者)"""
+    return _caller.get()
+
+class _Ticket:
+    def __init__(self, seq, model, plan, user):
+        self.seq = seq
+        self.model = model
+        self.plan = plan
+        self.user = user
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+class _ModelQueue:
+    """1モデル分の待ち行列：プラン → 利用者 → リクエスト"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.plans = collections.defaultdict(collections.OrderedDict)
+        self.vtime = collections.defaultdict(float)
+
+    def waiting(self):
+        return sum(len(tickets) for users in self.plans.values() for tickets in users.values())
+
+    def push(self, ticket):
+        users = self.plans[ticket.plan]
+        if not users:
+            # 待ちがなかったプランは、休んでいた間の分を貯めないよう現在の最小の仮想時刻に合わせる
+            active = [self.vtime[plan] for plan, other in self.plans.items() if other and plan != ticket.plan]
+            if active:
+                self.vtime[ticket.plan] = max(self.vtime[ticket.plan], min(active))
+        users.setdefault(ticket.user, collections.deque()).append(ticket)
+
+    def remove(self, ticket):
+        users = self.plans[ticket.plan]
+        tickets = users.get(ticket.user)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del users[ticket.user]
+
+    def _oldest(self):
+        heads = [tickets[0] for users in self.plans.values() for tickets in users.values()]
+        return min(heads, key=lambda t: t.seq, default=None)
+
+    def pop(self, now):
+        """次に実行するリクエスト（戻り値: (チケット, 飢餓防止で出したか)）"""
+        oldest = self._oldest()
+        if oldest is None:
+            return None, False
+        if now - oldest.enqueued_at >= STARVATION_S:
+            self.remove(oldest)
+            self.vtime[oldest.plan] += 1 / PLAN_WEIGHTS.get(oldest.plan, 1)
+            return oldest, True
+
+        plan = min((p for p, users in self.plans.items() if users), key=lambda p: (self.vtime[p], p))
+        users = self.plans[plan]
+        # 利用者のラウンドロビン：先頭の利用者から1件出し、まだ残っていれば末尾へ回す
+        user, tickets = next(iter(users.items()))
+        ticket = tickets.popleft()
+        if tickets:
+            users.move_to_end(user)
+        else:
+            del users[user]
+        self.vtime[plan] += 1 / PLAN_WEIGHTS.get(plan, 1)
+        return ticket, False
+
+class FairScheduler:
+    """モデルごとの同時実行数の上限の中で、プラン・利用者の間で公平に実行枠を割り当てる"""
+
+    def __init__(self, concurrency=None, max_wait=SCHEDULER_MAX_WAIT_S):
+        self.concurrency = dict(concurrency or DEFAULT_MODEL_CONCURRENCY)
+        self.max_wait = max_wait
+        self._models = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=QUEUE_LATENCY_SAMPLES))
+        self._stats = {"granted": 0, "starvation_promotions": 0, "timeouts": 0, "cancelled": 0}
+
+    def _queue(self, model):
+        if model not in self._models:
+            self._models[model] = _ModelQueue(self.concurrency.get(model, DEFAULT_CONCURRENCY))
+        return self._models[model]
+
+    def _dispatch(self, queue):
+        now = time.monotonic()
+        while queue.running < queue.limit:
+            ticket, promoted = queue.pop(now)
+            if ticket is None:
+                break
+            ticket.granted = True
+            queue.running += 1
+            self._stats["granted"] += 1
+            self._stats["starvation_promotions"] += promoted
+            self._latencies[ticket.plan].append(now - ticket.enqueued_at)
+        self._cond.notify_all()
+
+    def acquire(self, model, plan=None, user=None, cancelled=None):
+        """
+        実行枠を確保するまで待つ（plan・user を省略すると current_caller() を使う）
+        cancelled（threading.Event）が立ったら待つのをやめて None を返す
+        待ち時間の上限を超えたら SchedulerTimeout
+        """
+        if plan is None:
+            plan, user = current_caller()
+        with self._cond:
+            queue = self._queue(model)
+            ticket = _Ticket(next(self._seq), model, plan, user)
+            queue.push(ticket)
+            self._dispatch(queue)
+            deadline = ticket.enqueued_at + self.max_wait
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (cancelled is not None and cancelled.is_set()):
+                    queue.remove(ticket)
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise SchedulerTimeout(f"{model} の実行待ちが {self.max_wait:.0f}秒を超えました")
+                    self._stats["cancelled"] += 1
+                    return None
+                self._cond.wait(min(remaining, 1.0))
+            return ticket
+
+    def release(self, ticket):
+        """実行枠を返す"""
+        if ticket is None:
+            return
+        with self._cond:
+            queue = self._models[ticket.model]
+            queue.running -= 1
+            self._dispatch(queue)
+
+    @contextlib.contextmanager
+    def slot(self, model, plan=None, user=None, cancelled=None):
+        """実行枠を確保して実行する（キャンセルされた場合は None を渡す）"""
+        ticket = self.acquire(model, plan, user, cancelled)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        """モデルごとの実行中・待ち数と、プランごとの待ち時間のパーセンタイル"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["models"] = {
+                model: {"running": queue.running, "waiting": queue.waiting(), "limit": queue.limit}
+                for model, queue in self._models.items()
+            }
+            samples = {plan: list(latencies) for plan, latencies in self._latencies.items()}
+        stats["queue_latency"] = {
+            plan: {"count": len(values), **{f"p{q}_s": percentile(values, q) for q in (50, 95, 99)}}
+            for plan, values in samples.items()
+        }
+        return stats
+
+def _load_concurrency():
+    concurrency = dict(DEFAULT_MODEL_CONCURRENCY)
+    override = os.getenv("MODEL_CONCURRENCY")
+    if override:
+        concurrency.update(json.loads(override))
+    return concurrency
+
+@functools.lru_cache(maxsize=None)
+def get_scheduler():
+    """プロセス全体で共有するスケジューラ"""
+    return FairScheduler(_load_concurrency())
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+重複した実行中リクエストの統合（single-flight）
+
+同じキー（リクエストの指紋）の呼び出しが実行中なら、新たに実行せずその結果を待って共有する
+"""
+import hashlib
+import json
+import threading
+
+def fingerprint(*parts):
+    """リクエストの指紋（JSONに変換できる値の組のハッシュ）"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """キーごとに同時に1回だけ func を実行し、待っていた呼び出し元全員に同じ結果（例外）を返す"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._executed = 0
+        self._coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._executed += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """実際に実行した回数と、実行中の呼び出しに統合した回数"""
+        with self._lock:
+            return {"executed": self._executed, "coalesced": self._coalesced, "in_flight": len(self._calls)}
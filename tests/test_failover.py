@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""HedgedStream をローカルの偽プロバイダ（provider_for で差し替え）で試験する"""
+import itertools
+import threading
+import time
+
+import pytest
+
+from call_metrics import recent_call_timings
+from failover import HedgedStream
+from scheduler import FairScheduler
+
+_names = itertools.count()
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+class ClosedByClient(Exception):
+    """応答を閉じられたときのエラー（Google の Cancelled と同じ 499）"""
+    status_code = 499
+
+class FakeProvider:
+    """
+    first_token_s 秒後に chunks を返す偽プロバイダ（errors があれば呼び出しごとに順に投げる）
+    応答を閉じられたら、最初の断片を待っている間でもすぐ ClosedByClient で終わる
+    """
+
+    def __init__(self, chunks=("ok",), first_token_s=0.0, errors=()):
+        self.name = f"fake-{next(_names)}"
+        self.chunks = chunks
+        self.first_token_s = first_token_s
+        self.errors = list(errors)
+        self.calls = 0
+        self.prompts = []
+        self.closed = threading.Event()
+        self.exited = threading.Event()
+
+    def stream(self, model, system_prompt, user_text, images=(), max_tokens=3000, history=(), on_open=None):
+        self.calls += 1
+        self.prompts.append((system_prompt, user_text, tuple(history)))
+        try:
+            if self.errors:
+                raise self.errors.pop(0)
+            if on_open:
+                on_open(self.closed.set)
+            if self.closed.wait(self.first_token_s):
+                raise ClosedByClient("closed")
+            for chunk in self.chunks:
+                if self.closed.is_set():
+                    raise ClosedByClient("closed")
+                yield chunk
+        finally:
+            self.exited.set()
+
+class FakeLimiter:
+    def __init__(self):
+        self.penalized = []
+
+    def acquire(self, provider, model, tokens, on_queue=None, cancelled=None):
+        return True
+
+    def penalize(self, provider, model, retry_after=None):
+        self.penalized.append((provider, model))
+
+def _hedged(primary, fallback, delay=5.0, scheduler=None, limiter=None, fallback_request=None):
+    providers = {"primary-model": primary, "fallback-model": fallback}
+    return HedgedStream(
+        "chat", "primary-model", "system", "question",
+        fallback_model="fallback-model", provider_for=providers.__getitem__, delay=delay,
+        limiter=limiter or FakeLimiter(), scheduler=scheduler or FairScheduler(),
+        fallback_request=fallback_request,
+    )
+
+def test_primary_answers_before_deadline():
+    primary = FakeProvider(chunks=("a", "b"))
+    fallback = FakeProvider()
+    stream = _hedged(primary, fallback)
+
+    assert "".join(stream) == "ab"
+    assert stream.model == "primary-model"
+    assert not stream.hedged and not stream.failed_over
+    assert fallback.calls == 0
+
+def test_hedge_wins_when_primary_is_slow():
+    primary = FakeProvider(chunks=("slow",), first_token_s=30)
+    fallback = FakeProvider(chunks=("fast",))
+    stream = _hedged(primary, fallback, delay=0.05)
+
+    assert "".join(stream) == "fast"
+    assert stream.model == "fallback-model"
+    assert stream.hedged and stream.degraded
+
+def test_hedge_sends_the_fallback_request():
+    primary = FakeProvider(chunks=("slow",), first_token_s=30)
+    fallback = FakeProvider(chunks=("fast",))
+    history = [{"role": "user", "content": "q0"}, {"role": "assistant", "content": "a0"}]
+    stream = _hedged(primary, fallback, delay=0.05, fallback_request=("short system", "excerpt + question", history))
+
+    assert "".join(stream) == "fast"
+    # 主モデルには元の文脈、切り替え先にはその予算で作り直した文脈を送る
+    assert primary.prompts == [("system", "question", ())]
+    assert fallback.prompts == [("short system", "excerpt + question", tuple(history))]
+
+@pytest.mark.parametrize("status_code", [429, 503])
+def test_failover_on_provider_error(status_code):
+    primary = FakeProvider(errors=[FakeAPIError(status_code), FakeAPIError(status_code)])
+    fallback = FakeProvider(chunks=("backup",))
+    limiter = FakeLimiter()
+    stream = _hedged(primary, fallback, limiter=limiter)
+
+    start = time.monotonic()
+    assert "".join(stream) == "backup"
+    # 期限（5秒）を待たずに切り替える
+    assert time.monotonic() - start < 5.0
+    assert stream.model == "fallback-model"
+    assert stream.failed_over and not stream.hedged
+    if status_code == 429:
+        # 429 は同じプロバイダへ再試行せず、送信枠を絞る
+        assert primary.calls == 1
+        assert limiter.penalized == [(primary.name, "primary-model")]
+    else:
+        assert primary.calls == 2
+        assert limiter.penalized == []
+
+def test_error_without_failover_is_raised():
+    primary = FakeProvider(errors=[FakeAPIError(400)])
+    fallback = FakeProvider()
+    stream = _hedged(primary, fallback)
+
+    with pytest.raises(FakeAPIError):
+        "".join(stream)
+    assert fallback.calls == 0
+
+def test_loser_is_closed_while_waiting_for_first_chunk():
+    primary = FakeProvider(chunks=("slow",), first_token_s=30)
+    fallback = FakeProvider(chunks=("fast",))
+    scheduler = FairScheduler({"primary-model": 1}, max_wait=1.0)
+    stream = _hedged(primary, fallback, delay=0.05, scheduler=scheduler)
+
+    assert "".join(stream) == "fast"
+    # 最初の断片を待っている主モデルの応答を閉じ、読み取りスレッドを終わらせる
+    assert primary.closed.wait(1.0)
+    assert primary.exited.wait(1.0)
+    # 主モデルの実行枠（同時実行数1）も返されている
+    ticket = scheduler.acquire("primary-model", "free", "another-user", cancelled=threading.Event())
+    assert ticket is not None
+    scheduler.release(ticket)
+
+def test_hedged_away_primary_is_recorded_as_censored():
+    primary = FakeProvider(chunks=("slow",), first_token_s=30)
+    fallback = FakeProvider(chunks=("fast",))
+    stream = _hedged(primary, fallback, delay=0.05)
+
+    assert "".join(stream) == "fast"
+    assert primary.exited.wait(1.0)
+    deadline = time.monotonic() + 1.0
+    while time.monotonic() < deadline:
+        timings = [t for t in recent_call_timings() if t["provider"] == primary.name]
+        if timings:
+            break
+        time.sleep(0.01)
+    assert [t["censored"] for t in timings] == ["hedged_away"]
+    # 最初の断片は届いていないが、少なくともヘッジの期限までは待った
+    assert timings[0]["first_token_s"] is None
+    assert timings[0]["total_s"] >= 0.05
+
+def test_consumer_stopping_early_closes_the_stream():
+    primary = FakeProvider(chunks=("a", "b", "c"))
+    fallback = FakeProvider()
+    stream = iter(_hedged(primary, fallback))
+
+    assert next(stream) == "a"
+    stream.close()
+    assert primary.closed.wait(1.0)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""本文領域検出の傾き推定を、回転させた擬似ページで試験する"""
+import cv2
+import numpy as np
+import pytest
+
+from image_processing import crop_and_deskew, detect_text_region
+
+def _page(angle):
+    """本文の行を描いたページを angle 度（反時計回り）回転させる"""
+    page = np.full((1200, 900), 245, dtype=np.uint8)
+    for y in range(120, 1080, 40):
+        cv2.putText(page, "The derivative of f at x is the limit", (80, y),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.9, 30, 2, cv2.LINE_AA)
+    matrix = cv2.getRotationMatrix2D((450, 600), angle, 1.0)
+    return cv2.warpAffine(page, matrix, (900, 1200), borderValue=245)
+
+@pytest.mark.parametrize("angle", [-6.0, -3.0, 3.0, 6.0])
+def test_skew_is_detected_in_both_directions(angle):
+    box, skew = detect_text_region(_page(angle))
+    assert box is not None
+    # 補正は skew 度の回転なので、ページの回転と逆向きになる
+    assert skew == pytest.approx(-angle, abs=0.5)
+
+def test_straight_page_is_not_rotated():
+    _, report = crop_and_deskew(_page(0.0))
+    assert report["skew_degrees"] == 0.0
+
+@pytest.mark.parametrize("angle", [-3.0, 3.0])
+def test_deskewed_page_is_level(angle):
+    gray, _ = crop_and_deskew(_page(angle))
+    _, skew = detect_text_region(gray)
+    assert abs(skew) < 0.5
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""共有ページキャッシュが同じページだけを再利用するかを、描画した擬似ページで試験する"""
+import cv2
+import numpy as np
+from PIL import Image
+
+from phash_cache import (
+    DHASH_MAX_DISTANCE, PHASH_MAX_DISTANCE, SharedPageCache, difference_hash, hamming_distance, perceptual_hash
+)
+
+LINES = ["The derivative of f at x is the limit", "Let a, b and c be real coefficients"]
+OTHER_LINES = ["The integral of g over y is by parts", "Suppose p, q and r are rational too"]
+
+def _page(lines, changed_line=None):
+    """同じ割り付けで行を描いたページ（changed_line 行目だけ OTHER_LINES の文にする）"""
+    page = np.full((1400, 1000), 245, dtype=np.uint8)
+    for i, y in enumerate(range(120, 1300, 40)):
+        text = lines[i % 2] if i != changed_line else OTHER_LINES[i % 2]
+        cv2.putText(page, text, (80, y), cv2.FONT_HERSHEY_SIMPLEX, 1.0, 30, 2, cv2.LINE_AA)
+    return page
+
+def _recompressed(page):
+    """同じページを縮小・JPEG再圧縮・明るさ変更したもの"""
+    small = cv2.resize(page, (800, 1120), interpolation=cv2.INTER_AREA)
+    data = cv2.imencode(".jpg", small, [cv2.IMWRITE_JPEG_QUALITY, 70])[1]
+    return Image.fromarray(np.clip(cv2.imdecode(data, 0).astype(int) + 10, 0, 255).astype(np.uint8))
+
+def test_same_page_is_reused(tmp_path):
+    cache = SharedPageCache(str(tmp_path))
+    cache.store(Image.fromarray(_page(LINES)), "ns", "model", "page text")
+
+    assert cache.lookup(_recompressed(_page(LINES)), "ns", "model") == "page text"
+    # 別のモデルの結果・別の設定の結果は使わない
+    assert cache.lookup(_recompressed(_page(LINES)), "ns", "other-model") is None
+    assert cache.lookup(_recompressed(_page(LINES)), "other-ns", "model") is None
+
+def test_same_layout_with_different_text_is_rejected(tmp_path):
+    cache = SharedPageCache(str(tmp_path))
+    original = Image.fromarray(_page(LINES))
+    cache.store(original, "ns", "model", "page text")
+
+    for line in (0, 5, 20):
+        changed = Image.fromarray(_page(LINES, changed_line=line))
+        # 1行だけ違うページは 64ビットのハッシュでは見分けられない（検索・照合の距離の範囲内）
+        assert hamming_distance(perceptual_hash(original), perceptual_hash(changed)) <= PHASH_MAX_DISTANCE
+        assert hamming_distance(difference_hash(original), difference_hash(changed)) <= DHASH_MAX_DISTANCE
+        assert cache.lookup(changed, "ns", "model") is None
+    assert cache.stats()["rejected"] == 3
+    assert cache.stats()["hits"] == 0
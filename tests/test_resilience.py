@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""サーキットブレーカーが障害・成功・それ以外のエラーをどう数えるかを試験する"""
+import pytest
+
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+@pytest.mark.parametrize("status_code", [499, 400, 429])
+def test_non_outage_errors_do_not_reset_failures(status_code):
+    breaker = CircuitBreaker("test", failure_threshold=3)
+    for _ in range(2):
+        breaker.record(FakeAPIError(503))
+        # 打ち切った呼び出し（499）や 4xx は連続障害の回数を戻さない
+        breaker.record(FakeAPIError(status_code))
+    assert breaker.failures == 2
+    breaker.record(FakeAPIError(503))
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+def test_success_closes_the_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=3)
+    breaker.record(FakeAPIError(503))
+    breaker.record()
+    assert breaker.failures == 0 and breaker.state == CLOSED
+
+def test_cancelled_probe_keeps_the_breaker_half_open():
+    breaker = CircuitBreaker("test", failure_threshold=1, recovery_s=0.0)
+    breaker.record(FakeAPIError(503))
+    breaker.before_call()
+    breaker.record(FakeAPIError(499))
+    assert breaker.state == HALF_OPEN
+    # 試行枠は返されているので、次の呼び出しで回復を確かめられる
+    breaker.before_call()
+    breaker.record()
+    assert breaker.state == CLOSED
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+送信前のトークン数の計算（ネットワークを使わないトークナイザ）
+
+tiktoken の o200k_base（gpt-4o 系と同じ語彙）で数える。Gemini は語彙が異なるため近似値になる。
+語彙ファイルを読み込めない環境（初回ダウンロードができない場合など）では文字種からの概算に切り替える
+"""
+import functools
+import logging
+
+import tiktoken
+
+TOKENIZER_ENCODING = "o200k_base"
+ASCII_CHARS_PER_TOKEN = 4     # 概算：英数字は約4文字で1トークン、それ以外（日本語など）は1文字1トークン
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning("tokenizer %s unavailable (%s), falling back to estimation", TOKENIZER_ENCODING, e)
+        return None
+
+def _estimate(text):
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return -(-ascii_chars // ASCII_CHARS_PER_TOKEN) + len(text) - ascii_chars
+
+def count_tokens(text):
+    """テキストのトークン数"""
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return _estimate(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens, marker=""):
+    """先頭から max_tokens 以内に収まるよう、なるべく行の区切りで切り詰める（切り詰めたら marker を付ける）"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - count_tokens(marker))
+    encoding = _encoding()
+    if encoding is None:
+        # 概算では1文字あたり1トークン以下なので、文字数で切れば収まる
+        head = text[:budget]
+    else:
+        # 途中で切れたマルチバイト文字（置換文字）は落とす
+        head = encoding.decode(encoding.encode(text, disallowed_special=())[:budget]).rstrip("\ufffd")
+    cut = head.rfind("\n")
+    if cut > len(head) // 2:
+        head = head[:cut]
+    return head + marker
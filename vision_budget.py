@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import base64
+import math
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from image_encoder import encode_image
+
+# OpenAI Vision の画像トークン計算（detail=high）
+# 2048x2048 に収めた後、短辺を 768 に縮小し、512px タイル単位で課金される
+OPENAI_MAX_SIDE = 2048
+OPENAI_SHORT_SIDE = 768
+OPENAI_TILE_SIZE = 512
+OPENAI_TILE_TOKENS = 170
+OPENAI_BASE_TOKENS = 85
+OPENAI_LOW_DETAIL_SIDE = 512
+
+# 文字サイズの下限（縮小後の画素数）
+MIN_SUBSCRIPT_PX = 8          # 上付き・下付き文字がこれを下回らないようにする
+DENSE_MIN_SUBSCRIPT_PX = 10   # 文字が密集したページは余裕を持たせる
+SUBSCRIPT_RATIO = 0.6         # 添字の高さ ≒ 本文字高 × 0.6
+DENSE_INK_RATIO = 0.08        # これを超えるインク率は「密集」とみなす
+ANALYSIS_MAX_SIDE = 1600      # 文字サイズ推定用の縮小サイズ
+
+def estimate_openai_image_tokens(width, height, detail="high"):
+    """OpenAI Vision に送った場合の推定画像トークン数"""
+    if detail == "low":
+        return OPENAI_BASE_TOKENS
+
+    scale = min(1.0, OPENAI_MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, OPENAI_SHORT_SIDE / min(width, height))
+    width, height = width * scale, height * scale
+
+    tiles = math.ceil(width / OPENAI_TILE_SIZE) * math.ceil(height / OPENAI_TILE_SIZE)
+    return OPENAI_TILE_TOKENS * tiles + OPENAI_BASE_TOKENS
+
+def estimate_text_metrics(image):
+    """
+    インク率（文字密度）と本文字の高さ（元画像の画素数）を推定
+    縮小した二値画像の連結成分から求めるため、12MP画像でも数十ms程度
+    """
+    gray = np.asarray(image.convert('L'))
+    height, width = gray.shape
+    factor = min(1.0, ANALYSIS_MAX_SIDE / max(height, width))
+    if factor < 1.0:
+        gray = cv2.resize(gray, (int(width * factor), int(height * factor)), interpolation=cv2.INTER_AREA)
+
+    # 文字を白（255）とする二値化
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    ink_ratio = float(np.count_nonzero(mask)) / mask.size
+
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    # ノイズ点と罫線・写真などの巨大領域を除外
+    max_height = mask.shape[0] * 0.1
+    glyph_heights = heights[(areas >= 4) & (heights >= 3) & (heights <= max_height)]
+
+    if glyph_heights.size == 0:
+        glyph_px = None
+    else:
+        glyph_px = float(np.median(glyph_heights)) / factor
+
+    return {"ink_ratio": ink_ratio, "glyph_px": glyph_px}
+
+def plan_image(image):
+    """
+    画像ごとの縮小率と detail を決定
+    API側で縮小される解像度を上限に、添字が判読できる範囲で最小の解像度を選ぶ
+    """
+    width, height = image.size
+    metrics = estimate_text_metrics(image)
+
+    # API側が実際に使う解像度（これ以上大きく送っても帯域の無駄）
+    api_scale = min(1.0, OPENAI_MAX_SIDE / max(width, height))
+    api_scale *= min(1.0, OPENAI_SHORT_SIDE / (min(width, height) * api_scale))
+
+    min_subscript_px = DENSE_MIN_SUBSCRIPT_PX if metrics["ink_ratio"] > DENSE_INK_RATIO else MIN_SUBSCRIPT_PX
+    if metrics["glyph_px"]:
+        glyph_scale = min_subscript_px / (metrics["glyph_px"] * SUBSCRIPT_RATIO)
+    else:
+        # 文字が検出できない場合は縮小しすぎない
+        glyph_scale = api_scale
+
+    # 512px に収めても添字が読める疎なページは detail=low で十分
+    low_scale = min(1.0, OPENAI_LOW_DETAIL_SIDE / max(width, height))
+    if metrics["glyph_px"] and low_scale >= glyph_scale and metrics["ink_ratio"] <= DENSE_INK_RATIO:
+        return {"scale": low_scale, "detail": "low", **metrics}
+
+    return {"scale": min(api_scale, glyph_scale), "detail": "high", **metrics}
+
+def optimize_image_for_vision(image, original_bytes=None, original_mime=None):
+    """
+    OCR送信前に解像度と detail を最適化し、最小となる形式でエンコード
+    戻り値: (送信バイト列, MIMEタイプ, detail, レポート)
+    """
+    plan = plan_image(image)
+    width, height = image.size
+    scale = plan["scale"]
+
+    if original_bytes is not None:
+        # 再エンコードでEXIFの回転情報が失われるため、先に画素へ反映する
+        image = ImageOps.exif_transpose(image)
+        width, height = image.size
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+    # 縮小前の非圧縮サイズ（元解像度でのPNG再エンコードは重いので、これを基準にする）
+    raw_bytes = width * height * len(image.getbands())
+
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if scale < 0.999 and new_size != (width, height):
+        resized = cv2.resize(np.asarray(image), new_size, interpolation=cv2.INTER_AREA)
+        image = Image.fromarray(resized)
+    else:
+        new_size = (width, height)
+
+    encoded = encode_image(image)
+    data, mime_type, image_format = encoded["data"], encoded["mime_type"], encoded["format"]
+    if new_size == (width, height) and original_bytes is not None and len(original_bytes) <= len(data):
+        # 縮小不要で元ファイルの方が小さければ、アップロードされたバイト列をそのまま送る
+        data, mime_type, image_format = original_bytes, original_mime or "image/png", "original"
+
+    bytes_before = len(original_bytes) if original_bytes is not None else raw_bytes
+
+    report = {
+        "size_before": (width, height),
+        "size_after": new_size,
+        "detail": plan["detail"],
+        "format": image_format,
+        "glyph_px": plan["glyph_px"],
+        "ink_ratio": plan["ink_ratio"],
+        "bytes_before": bytes_before,
+        "bytes_after": len(data),
+        "tokens_before": estimate_openai_image_tokens(width, height, "high"),
+        "tokens_after": estimate_openai_image_tokens(*new_size, plan["detail"]),
+    }
+    return data, mime_type, plan["detail"], report
+
+def build_openai_image_part(image, original_bytes=None, original_mime=None):
+    """最適化済み画像から OpenAI の image_url コンテンツとレポートを作成"""
+    data, mime_type, detail, report = optimize_image_for_vision(image, original_bytes, original_mime)
+    image_base64 = base64.b64encode(data).decode('utf-8')
+    part = {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{mime_type};base64,{image_base64}",
+            "detail": detail
+        }
+    }
+    return part, report
+
+def summarize_reports(reports):
+    """複数画像のレポートを1行の要約にまとめる"""
+    bytes_before = sum(r["bytes_before"] for r in reports)
+    bytes_after = sum(r["bytes_after"] for r in reports)
+    tokens_before = sum(r["tokens_before"] for r in reports)
+    tokens_after = sum(r["tokens_after"] for r in reports)
+    formats = ", ".join(sorted({r["format"] for r in reports}))
+    return (
+        f"画像最適化: 送信サイズ {bytes_before / 1024:.0f}KB → {bytes_after / 1024:.0f}KB ({formats}), "
+        f"推定画像トークン {tokens_before} → {tokens_after}"
+    )